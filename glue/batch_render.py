@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import math
+import multiprocessing
+import os
+import time
+
+import ephem
+
+from clocks import SteppedClock
+from color_temperature import DaylightColorModel
+from frames import FrameFile, FrameSink
+from lights import RectangularPixelMatrix
+from skylight import WeatherSky
+from weather import WeatherUnderground
+
+
+__app_name__ = "skylight_batch"
+
+# Night frames are much cheaper to render than daylight ones so, unless
+# --chunk-frames says otherwise, each worker gets a few chunks to even out the
+# load.
+CHUNKS_PER_JOB = 4
+
+# +---------------------------------------------------------------------------+
+# | RENDERING
+# +---------------------------------------------------------------------------+
+def _render_chunk(args, first_frame, frame_count):
+    '''
+    Render frames [first_frame, first_frame + frame_count) into the output
+    file. Runs in a worker process so everything, including the ephemeris
+    observer, is built locally.
+    '''
+    frame_file = FrameFile(args.output, mode='r+')
+    chunk = frame_file.frames[first_frame:first_frame + frame_count]
+    sink = FrameSink(chunk, first_frame)
+    clock = SteppedClock(args.start, args.step, args.verbose)
+    clock.index = first_frame
+    panel = RectangularPixelMatrix(args, sink)
+    weather = WeatherUnderground(args) if args.weather is not None else None
+    sky = WeatherSky(args, clock, weather)
+    
+    start = time.time()
+    for index in range(first_frame, first_frame + frame_count):
+        clock.index = index
+        sink.index = index
+        sky(panel)
+    elapsed = time.time() - start
+    chunk.flush()
+    frame_file.close()
+    return frame_count, elapsed
+
+def _render_chunk_star(chunk_args):
+    return _render_chunk(*chunk_args)
+
+def render(args):
+    '''
+    Render args.frames frames, args.step seconds apart, starting at args.start
+    into a memory-mapped .npy file at args.output. Returns (frames, seconds).
+    '''
+    FrameFile.create(args.output, args.start, args.step, args.frames, args.pixel_count, args.city, args.brightness).close()
+    
+    chunk_frames = args.chunk_frames
+    if chunk_frames is None:
+        chunk_frames = max(1, int(math.ceil(args.frames / float(max(1, args.jobs) * CHUNKS_PER_JOB))))
+    chunks = [(args, first, min(chunk_frames, args.frames - first)) 
+              for first in range(0, args.frames, chunk_frames)]
+    
+    start = time.time()
+    if args.jobs > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(processes=args.jobs)
+        try:
+            results = pool.map(_render_chunk_star, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_render_chunk_star(chunk) for chunk in chunks]
+    elapsed = time.time() - start
+    
+    if args.verbose:
+        for chunk, result in zip(chunks, results):
+            print "frames {:>8} - {:>8}: {:.1f} frames per second".format(
+                chunk[1], chunk[1] + chunk[2] - 1, result[0] / result[1] if result[1] > 0 else 0)
+    return args.frames, elapsed
+
+# +---------------------------------------------------------------------------+
+# | MAIN
+# +---------------------------------------------------------------------------+
+
+def main():
+    parser = argparse.ArgumentParser(
+            prog=__app_name__, 
+            description="Renders the skylight over a fixed time grid as fast as possible and saves the frames to a .npy file.")
+    
+    parser.add_argument('--city', required=True, help="A city used to lookup ephemeris values.")
+    parser.add_argument('--start', default=str(ephem.now()), metavar="[%Y/%m/%d hh:mm:ss]", help="UTC time of the first frame.")
+    parser.add_argument('--step', default=60.0, type=float, help="Simulated seconds between frames.")
+    parser.add_argument('--days', default=1.0, type=float, help="Number of simulated days to render.")
+    parser.add_argument('--output', '-o', default="frames.npy", help="Where to write the frames.")
+    parser.add_argument('--jobs', '-j', default=multiprocessing.cpu_count(), type=int, help="Number of worker processes to render with.")
+    parser.add_argument('--chunk-frames', default=None, type=int, help="Number of frames rendered by each unit of work (default: enough for {} per job).".format(CHUNKS_PER_JOB))
+    parser.add_argument('--weather', default=None, help="Fixed weather conditions to render with.")
+    parser.add_argument('--library', default=None, metavar="DIR", help="Render whole UTC days into a frame library for the skylight's --playback mode instead of writing --output. Library frames are always rendered at full brightness.")
+    parser.add_argument('--profile', default="default", help="Name of the render profile when writing to a frame library.")
+    parser.add_argument('--verbose','-v', action='store_true', help="Spew debug stuff.")
+    parser.set_defaults(show_daylight_chart=False, wukey=None, weather_cache=None)
+    
+    RectangularPixelMatrix.on_visit_argparse(parser, None)
+    DaylightColorModel.on_visit_argparse(parser, None)
+    
+    args = parser.parse_args()
+    
+    if args.library is None:
+        args.frames = int(round(args.days * 24 * 60 * 60 / args.step))
+        outputs = [args]
+    else:
+        # one file per UTC day so playback can map just the day it needs.
+        if not os.path.isdir(args.library):
+            os.makedirs(args.library)
+        args.frames = int(round(24 * 60 * 60 / args.step))
+        first_day = FrameFile.day_start(args.start)
+        outputs = []
+        for day in range(int(math.ceil(args.days))):
+            day_args = argparse.Namespace(**vars(args))
+            day_args.start = ephem.date(first_day + day)
+            day_args.output = FrameFile.library_path(args.library, args.city, day_args.start, args.profile)
+            # Playback applies the panel's brightness itself.
+            day_args.brightness = 1.0
+            outputs.append(day_args)
+    
+    for output_args in outputs:
+        frames, elapsed = render(output_args)
+        print "Rendered {} frames to {} in {:.2f} seconds ({:.1f} frames per second)".format(
+            frames, output_args.output, elapsed, frames / elapsed if elapsed > 0 else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import ephem
+import numpy as np
+
+from clocks import SteppedClock, monotonic
+from curve_plot import bezier_curve, make_curve
+from lights import RectangularPixelMatrix
+import opc
+from skylight import WeatherSky
+from weather import WeatherProvider, WeatherUnderground
+
+
+__app_name__ = "skylight_benchmarks"
+
+# A fixed moment so every run does the same ephemeris work.
+BENCHMARK_NOW_UTC = "2017/6/21 19:00:00"
+BENCHMARK_CITY = "Seattle"
+
+# Every run times this first and stores each result relative to it too, so
+# runs on different machines can be compared.
+CALIBRATION = "calibration"
+
+# Checked-in results that --compare measures against.
+REFERENCE_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "reference.json")
+
+# Default --tolerance against a baseline from the same machine and against
+# the reference, which relative times only bring roughly into line.
+TOLERANCE = 0.25
+REFERENCE_TOLERANCE = 0.5
+
+# +---------------------------------------------------------------------------+
+# | FIXTURES
+# +---------------------------------------------------------------------------+
+class OpcSink(object):
+    '''
+    Minimal OPC server on the loopback interface that reads and discards
+    everything sent to it so the client's socket path can be timed without a
+    real fcserver.
+    '''
+    
+    def __init__(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(1)
+        self._running = True
+        self._thread = threading.Thread(group=None, target=self._drain, name="opc_sink")
+        self._thread.daemon = True
+        self._thread.start()
+    
+    @property
+    def port(self):
+        return self._server.getsockname()[1]
+    
+    def close(self):
+        self._running = False
+        self._server.close()
+    
+    def _drain(self):
+        while self._running:
+            try:
+                connection, _ = self._server.accept()
+            except socket.error:
+                return
+            try:
+                while connection.recv(1 << 16):
+                    pass
+            except socket.error:
+                pass
+            finally:
+                connection.close()
+
+
+class NullClient(object):
+    '''
+    Stands in for opc.Client when only the pixel math is being timed.
+    '''
+    
+    def put_pixels(self, pixels, channel=0):  # @UnusedVariable
+        return True
+
+
+def _make_args(sink, pixel_count=512):
+    return argparse.Namespace(city=BENCHMARK_CITY,
+                              verbose=False,
+                              show_daylight_chart=False,
+                              opc_debug=False,
+                              address="127.0.0.1",
+                              port=sink.port,
+                              channel=0,
+                              stride=32,
+                              pixel_count=pixel_count,
+                              brightness=0.8,
+                              wukey=None,
+                              weather="Overcast",
+                              weather_cache=None)
+
+# +---------------------------------------------------------------------------+
+# | BENCHMARKS
+# +---------------------------------------------------------------------------+
+# Each benchmark takes the OPC sink and returns the operation to time.
+
+def bench_calibration(sink):  # @UnusedVariable
+    # A fixed mix of interpreter and numpy work that doesn't touch any
+    # skylight code, standing in for how fast the machine is.
+    values = np.arange(4096, dtype=np.float64)
+    def calibrate():
+        total = 0
+        for i in xrange(256):
+            total += i * i
+        return total, np.multiply(values, 0.5).clip(0, 255).astype(np.uint8).tostring()
+    return calibrate
+
+def bench_put_pixels(pixel_count):
+    def setup(sink):
+        client = opc.Client(_make_args(sink, pixel_count))
+        client.can_connect()
+        pixels = np.random.RandomState(0).randint(0, 256, (pixel_count, 3)).astype(np.uint8)
+        return lambda: client.put_pixels(pixels, channel=0)
+    return setup
+
+def bench_matrix_fill(sink):
+    panel = RectangularPixelMatrix(_make_args(sink), NullClient())
+    return lambda: panel.fill((255, 128, 64))
+
+def bench_matrix_black(sink):
+    panel = RectangularPixelMatrix(_make_args(sink), NullClient())
+    return panel.black
+
+def bench_make_curve(sink):  # @UnusedVariable
+    return lambda: make_curve(0.0, 0.025, 0.750, 0.775)
+
+def bench_bezier_curve(sink):  # @UnusedVariable
+    control_points = [[0.0, 0.01], [0.025, 1.80], [0.3875, 0.30], [0.750, 1.80], [0.775, 0.01]]
+    return lambda: bezier_curve(control_points, 1000)
+
+def bench_update_ephemeris(sink):
+    args = _make_args(sink)
+    sky = WeatherSky(args, SteppedClock(BENCHMARK_NOW_UTC, 1), None)
+    now = ephem.date(BENCHMARK_NOW_UTC)
+    def update():
+        # Forget the current day so every call solves it again.
+        sky._current_daylight = None
+        sky._update_ephemeris(now)
+    return update
+
+def bench_weather_classification(sink):
+    # Times classify() as the sky calls it, so after the first call this is
+    # the memoized lookup rather than the pattern matching.
+    provider = WeatherUnderground(_make_args(sink))
+    conditions = [c.replace("(light|heavy) ", "Light ") for c in sorted(WeatherProvider.NOT_SUNNY_WEATHER)] + \
+                 sorted(WeatherProvider.SUNNY_WEATHER)
+    def classify():
+        for weather in conditions:
+            provider.classify(weather)
+    return classify
+
+def bench_sky_frame(sink):
+    args = _make_args(sink)
+    client = opc.Client(args)
+    client.can_connect()
+    panel = RectangularPixelMatrix(args, client)
+    # The clock stays put so every call draws the same frame.
+    sky = WeatherSky(args, SteppedClock(BENCHMARK_NOW_UTC, 1), WeatherUnderground(args))
+    return lambda: sky(panel)
+
+BENCHMARKS = [
+    (CALIBRATION,              bench_calibration),
+    ("put_pixels_512",         bench_put_pixels(512)),
+    ("put_pixels_4k",          bench_put_pixels(4096)),
+    ("put_pixels_20k",         bench_put_pixels(20480)),
+    ("matrix_fill",            bench_matrix_fill),
+    ("matrix_black",           bench_matrix_black),
+    ("make_curve",             bench_make_curve),
+    ("bezier_curve",           bench_bezier_curve),
+    ("update_ephemeris",       bench_update_ephemeris),
+    ("weather_classification", bench_weather_classification),
+    ("sky_frame",              bench_sky_frame),
+]
+
+# +---------------------------------------------------------------------------+
+# | RUNNER
+# +---------------------------------------------------------------------------+
+def _calibrate(operation, min_seconds):
+    '''
+    Number of calls to operation that take at least min_seconds.
+    '''
+    calls = 1
+    while True:
+        start = monotonic()
+        for _ in xrange(calls):
+            operation()
+        if monotonic() - start >= min_seconds:
+            return calls
+        calls *= 2
+
+def _time(operation, repeat, min_seconds):
+    calls = _calibrate(operation, min_seconds)
+    timings = []
+    for _ in range(repeat):
+        start = monotonic()
+        for _ in xrange(calls):
+            operation()
+        timings.append((monotonic() - start) / calls)
+    timings.sort()
+    return {'seconds': timings[0], 
+            'median': timings[len(timings) // 2], 
+            'calls': calls}
+
+def run(names, repeat, min_seconds, verbose=False):
+    '''
+    Returns {name: {'seconds': best seconds per call, 'median': median
+    seconds per call, 'calls': calls per repeat, 'relative': best seconds
+    per call over the calibration's}}. The calibration always runs, both
+    first and last, and the faster of the two is kept so a passing burst of
+    load on the machine doesn't skew every relative time.
+    '''
+    sink = OpcSink()
+    results = dict()
+    try:
+        for name, setup in BENCHMARKS + [(CALIBRATION, bench_calibration)]:
+            if names and name not in names and name != CALIBRATION:
+                continue
+            result = _time(setup(sink), repeat, min_seconds)
+            if name in results and results[name]['seconds'] <= result['seconds']:
+                continue
+            results[name] = result
+            if verbose:
+                print "{:<24} {:>12.3f} us".format(name, result['seconds'] * 1e6)
+    finally:
+        sink.close()
+    calibration = results[CALIBRATION]['seconds']
+    for result in results.values():
+        result['relative'] = result['seconds'] / calibration
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the names of benchmarks that got slower than the baseline by more
+    than tolerance (a fraction). The times relative to the calibration are
+    compared, which factors out the speed of the machine each run was made
+    on.
+    '''
+    regressions = []
+    for name in sorted(results.keys()):
+        if name == CALIBRATION:
+            continue
+        if name not in baseline:
+            print "{:<24} {:>12} -> {:>12.3f} us {:>8} (not in baseline)".format(name, "", results[name]['seconds'] * 1e6, "")
+            continue
+        if 'relative' not in baseline[name]:
+            raise ValueError("The baseline for {} has no time relative to the calibration. Record it again with --save.".format(name))
+        before = baseline[name]['relative']
+        after = results[name]['relative']
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "REGRESSION"
+        print "{:<24} {:>12.3f} us -> {:>12.3f} us {:>+8.1%} {}".format(name, baseline[name]['seconds'] * 1e6, results[name]['seconds'] * 1e6, change, flag)
+    return regressions
+
+# +---------------------------------------------------------------------------+
+# | MAIN
+# +---------------------------------------------------------------------------+
+
+def main():
+    parser = argparse.ArgumentParser(
+            prog=__app_name__, 
+            description="Times the hot paths of the skylight and compares them against a baseline.")
+    
+    parser.add_argument('benchmarks', nargs='*', help="Names of the benchmarks to run (default: all of them).")
+    parser.add_argument('--list', action='store_true', help="List the benchmarks and exit.")
+    parser.add_argument('--repeat', default=5, type=int, help="Number of timed repeats of each benchmark. The best is reported.")
+    parser.add_argument('--min-time', default=0.2, type=float, help="Minimum seconds each repeat runs for.")
+    parser.add_argument('--baseline', default=None, help="JSON results to compare against. Exits non-zero on regressions.")
+    parser.add_argument('--compare', action='store_true', help="Compare against the checked-in baseline ({}).".format(os.path.relpath(REFERENCE_BASELINE)))
+    parser.add_argument('--tolerance', default=None, type=float, help="Fraction a benchmark may slow down by before it counts as a regression (default {} or {} with --compare).".format(TOLERANCE, REFERENCE_TOLERANCE))
+    parser.add_argument('--save', default=None, help="Write the results to this JSON file (e.g. to update the baseline).")
+    parser.add_argument('--history', default=None, help="Append the results with a timestamp to this file (one JSON object per line).")
+    
+    args = parser.parse_args()
+    
+    if args.compare and args.baseline is None:
+        args.baseline = REFERENCE_BASELINE
+    if args.tolerance is None:
+        args.tolerance = REFERENCE_TOLERANCE if args.baseline == REFERENCE_BASELINE else TOLERANCE
+    
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print name
+        return
+    
+    baseline = None
+    if args.baseline is not None:
+        # Check the baseline before spending time on the benchmarks.
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        unusable = sorted(name for name, result in baseline.items() if 'relative' not in result)
+        if unusable:
+            parser.error("{} has no times relative to the calibration for {}. Record it again with --save.".format(args.baseline, ", ".join(unusable)))
+    
+    results = run(args.benchmarks, args.repeat, args.min_time, verbose=(args.baseline is None))
+    
+    if args.save is not None:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=4, sort_keys=True, separators=(',', ': '))
+    
+    if args.history is not None:
+        with open(args.history, 'a') as history_file:
+            history_file.write(json.dumps({'time': time.time(), 'results': results}, sort_keys=True) + "\n")
+    
+    if baseline is not None:
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -19,11 +19,52 @@
 #  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
 # |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
 #                                                     |___/     |___/
+import ctypes
+import ctypes.util
 import datetime
+import math
+import os
 import time
 
 import ephem
 
+from session import SessionReplay
+
+
+# +---------------------------------------------------------------------------+
+# | MONOTONIC TIME
+# +---------------------------------------------------------------------------+
+def _make_monotonic():
+    '''
+    time.monotonic() is only available in python 3.3+. On older pythons we go
+    to clock_gettime(CLOCK_MONOTONIC) directly and, failing that, fall back to
+    time.time().
+    '''
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    
+    CLOCK_MONOTONIC = 1
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    except (OSError, AttributeError):
+        return time.time
+    
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    
+    return monotonic
+
+monotonic = _make_monotonic()
+
 
 class HyperClock(object):
     '''
@@ -44,7 +85,9 @@ class HyperClock(object):
     
     def __init__(self, args):
         self._hyper_now = ephem.date(args.now_utc)
-        self._last_tick = time.time()
+        # Elapsed time is measured on the monotonic clock so NTP adjustments
+        # to the system clock don't make simulated time jump.
+        self._last_tick = monotonic()
         self._multiplier = args.multiplier
         self._verbose = args.verbose
         if self._verbose:
@@ -52,7 +95,7 @@ class HyperClock(object):
             print "Using HyperClock ({} X).".format(self._multiplier)
     
     def now(self):
-        real_now = time.time()
+        real_now = monotonic()
         elapsed = real_now - self._last_tick
         self._last_tick = real_now
         self._hyper_now += (elapsed * self._multiplier) / (60 * 60 * 24)
@@ -62,6 +105,90 @@ class HyperClock(object):
                 self._last_hour = hour
             
         return self._hyper_now
+    
+    def wall_time(self):
+        return time.time()
+    
+    def get_rate(self):
+        '''
+        Simulated seconds per real second or None if the clock doesn't advance
+        in step with real time.
+        '''
+        return float(self._multiplier)
+
+
+class ReplayClock(HyperClock):
+    '''
+    HyperClock that hands out the clock samples from a recorded session instead
+    of measuring elapsed time. The replay runs as fast as it is polled.
+    '''
+    
+    @staticmethod
+    def create_replay_clock(args):
+        return ReplayClock(args)
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        subparser = subparsers.add_parser("replay", help="Replays the clock and weather from a recorded session as fast as possible.")
+        subparser.add_argument('session', help="A session file written with --record.")
+        subparser.set_defaults(func=cls.create_replay_clock, unpaced=True)
+    
+    def __init__(self, args):
+        self._session = SessionReplay(args.session)
+        self._verbose = args.verbose
+        self._multiplier = None
+        self._hyper_now = None
+        if self._verbose:
+            print "Replaying session {}.".format(args.session)
+    
+    @property
+    def session(self):
+        return self._session
+    
+    def now(self):
+        self._hyper_now = ephem.date(self._session.next_clock())
+        return self._hyper_now
+    
+    def wall_time(self):
+        return self._session.wall_time()
+    
+    def get_rate(self):
+        return None
+
+
+class SteppedClock(object):
+    '''
+    Clock that reports the time of a frame index on a fixed time grid. Used to
+    render the sky without waiting for real time to pass.
+    '''
+    
+    def __init__(self, start, step_seconds, verbose=False):
+        self._start = ephem.date(start)
+        self._step_days = step_seconds / (60.0 * 60 * 24)
+        self._verbose = verbose
+        self._index = 0
+    
+    @property
+    def index(self):
+        return self._index
+    
+    @index.setter
+    def index(self, index):
+        self._index = index
+    
+    def time_at(self, index):
+        return ephem.date(self._start + index * self._step_days)
+    
+    def now(self):
+        return self.time_at(self._index)
+    
+    def wall_time(self):
+        # Simulated time stands in for wall time so weather metering follows
+        # the render instead of the host.
+        return (self.now() - ephem.date('1970/1/1')) * 60 * 60 * 24
+    
+    def get_rate(self):
+        return None
 
 
 class WallClock(object):
@@ -84,4 +211,137 @@ class WallClock(object):
 
     def now(self):
         return ephem.now()
-    
\ No newline at end of file
+    
+    def wall_time(self):
+        return time.time()
+    
+    def get_rate(self):
+        return 1.0
+    
+
+# +---------------------------------------------------------------------------+
+# | FRAME SCHEDULING
+# +---------------------------------------------------------------------------+
+class FrameScheduler(object):
+    '''
+    Paces the render loop against deadlines on the monotonic clock. Frame n is
+    due at start + n * period so sleep error never accumulates. When a frame
+    overruns the scheduler either skips the deadlines it missed or catches up
+    by running late frames back-to-back (up to max_catch_up frames behind,
+    after which it resynchronises). Lateness of every frame is recorded.
+    '''
+    
+    POLICY_SKIP = "skip"
+    POLICY_CATCH_UP = "catch-up"
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        parser.add_argument("--overrun-policy", default=cls.POLICY_SKIP, choices=(cls.POLICY_SKIP, cls.POLICY_CATCH_UP), help="What to do when a frame takes longer than the frame period: drop the frames that were missed or render them late until caught up.")
+        parser.add_argument("--max-catch-up", default=5, type=int, help="Most frames the catch-up policy will fall behind before giving up and resynchronising.")
+    
+    def __init__(self, args, frame_rate=None):
+        self._frame_rate = float(frame_rate if frame_rate is not None else args.frame_rate)
+        self._period = 1.0 / self._frame_rate
+        self._policy = getattr(args, "overrun_policy", self.POLICY_SKIP)
+        self._max_catch_up = getattr(args, "max_catch_up", 5)
+        self._paced = not getattr(args, "unpaced", False)
+        self._deadline = None
+        self.reset_statistics()
+    
+    @property
+    def period(self):
+        return self._period
+    
+    @period.setter
+    def period(self, period):
+        '''
+        Change the interval before the next frame. The next deadline is moved
+        relative to the last one but never into the past so shortening the
+        period after an idle stretch doesn't count as lateness.
+        '''
+        if period == self._period:
+            return
+        if self._deadline is not None:
+            self._deadline = max(self._deadline + (period - self._period), monotonic())
+        self._period = period
+    
+    def wait(self):
+        '''
+        Block until the next frame is due. Returns the lateness in seconds of
+        the frame that is now due (0 or more).
+        '''
+        now = monotonic()
+        if self._deadline is None or not self._paced:
+            self._deadline = now
+        else:
+            # sleep can return early when a signal arrives (e.g. the sampling
+            # profiler's) so keep going until the deadline has really passed.
+            while now < self._deadline:
+                time.sleep(self._deadline - now)
+                now = monotonic()
+        
+        lateness = max(0.0, now - self._deadline)
+        self._record(now, lateness)
+        
+        self._deadline += self._period
+        if self._deadline <= now:
+            missed = int(math.ceil((now - self._deadline) / self._period))
+            if self._policy == self.POLICY_SKIP or missed > self._max_catch_up:
+                self._deadline += missed * self._period
+                self._skipped += missed
+        return lateness
+    
+    # +------------------------------------------------------------------------+
+    # | STATISTICS
+    # +------------------------------------------------------------------------+
+    def reset_statistics(self):
+        self._frames = 0
+        self._skipped = 0
+        self._lateness_sum = 0.0
+        self._lateness_max = 0.0
+        self._interval_error_sum = 0.0
+        self._interval_error_squared_sum = 0.0
+        self._last_frame_time = None
+    
+    def get_statistics(self):
+        '''
+        Returns a dictionary of frames, skipped frames, mean and max lateness
+        and jitter (standard deviation of frame-to-frame intervals from the
+        frame period), all times in seconds.
+        '''
+        intervals = self._frames - 1
+        if intervals > 0:
+            mean_error = self._interval_error_sum / intervals
+            variance = max(0.0, self._interval_error_squared_sum / intervals - mean_error ** 2)
+        else:
+            variance = 0.0
+        return {'frames': self._frames,
+                'skipped': self._skipped,
+                'lateness_mean': self._lateness_sum / self._frames if self._frames > 0 else 0.0,
+                'lateness_max': self._lateness_max,
+                'jitter': math.sqrt(variance)}
+    
+    def format_statistics(self):
+        return "{frames} frames ({skipped} skipped) | lateness mean {lateness_mean_ms:.2f} ms max {lateness_max_ms:.2f} ms | jitter {jitter_ms:.2f} ms".format(
+            **dict(self._ms(self.get_statistics())))
+    
+    # +------------------------------------------------------------------------+
+    # | PRIVATE
+    # +------------------------------------------------------------------------+
+    def _record(self, now, lateness):
+        self._frames += 1
+        self._lateness_sum += lateness
+        if lateness > self._lateness_max:
+            self._lateness_max = lateness
+        if self._last_frame_time is not None:
+            error = (now - self._last_frame_time) - self._period
+            self._interval_error_sum += error
+            self._interval_error_squared_sum += error * error
+        self._last_frame_time = now
+    
+    @staticmethod
+    def _ms(statistics):
+        for key, value in statistics.items():
+            yield key, value
+            if isinstance(value, float):
+                yield key + "_ms", value * 1000.0
@@ -0,0 +1,127 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import math
+
+import numpy as np
+
+from weather import WeatherProvider
+
+
+def kelvin_to_rgb(kelvin):
+    '''
+    Approximate RGB (0 - 255) of a black body at the given colour temperature.
+    Takes a scalar or a numpy array of temperatures. See
+    http://www.tannerhelland.com/4435/convert-temperature-rgb-algorithm-code/
+    '''
+    t = np.asarray(kelvin, dtype=np.float64) / 100.0
+    warm = t <= 66
+    red = np.where(warm, 255.0, 329.698727446 * np.power(np.maximum(t - 60, 1e-6), -0.1332047592))
+    green = np.where(warm,
+                     99.4708025861 * np.log(np.maximum(t, 1e-6)) - 161.1195681661,
+                     288.1221695283 * np.power(np.maximum(t - 60, 1e-6), -0.0755148492))
+    blue = np.where(t >= 66, 255.0,
+                    np.where(t <= 19, 0.0, 138.5177312231 * np.log(np.maximum(t - 10, 1e-6)) - 305.0447927307))
+    return np.clip(np.stack([red, green, blue], axis=-1), 0, 255)
+
+
+class DaylightColorModel(object):
+    '''
+    Colour of daylight by solar altitude and weather. Altitude and cloud cover
+    give a correlated colour temperature (warm near the horizon, bluer
+    overhead, flatter and cooler under cloud) which is converted to RGB. Every
+    combination is worked out once into a table so the sky's colour costs one
+    lookup per frame.
+    '''
+    
+    COLOR_CLASSIC = "classic"
+    COLOR_TEMPERATURE = "temperature"
+    
+    # Lowest and highest altitudes (degrees) in the table and its resolution.
+    MIN_ALTITUDE = -10.0
+    MAX_ALTITUDE = 90.0
+    ALTITUDE_STEP = 0.25
+    
+    # Clear sky colour temperature rises from TWILIGHT_KELVIN with the sun at
+    # TWILIGHT_ALTITUDE towards CLEAR_KELVIN overhead. It's most of the way
+    # there ALTITUDE_SCALE degrees up.
+    TWILIGHT_ALTITUDE = -7.0
+    TWILIGHT_KELVIN = 1850.0
+    CLEAR_KELVIN = 6500.0
+    ALTITUDE_SCALE = 20.0
+    
+    # Fully overcast skies sit at OVERCAST_KELVIN whatever the altitude.
+    OVERCAST_KELVIN = 6800.0
+    
+    # cloud cover (0 - 1) and a tint for each class of weather.
+    CONDITIONS = { WeatherProvider.WEATHER_CLASS_SUNNY     : (0.0, (1.0, 1.0, 1.0)),
+                   WeatherProvider.WEATHER_CLASS_CLOUDY    : (0.8, (1.0, 1.0, 1.0)),
+                   # Green like the classic snow colour so snow can still
+                   # be told apart from overcast.
+                   WeatherProvider.WEATHER_CLASS_SNOWING   : (1.0, (0.55, 1.0, 0.65)),
+                   # Still needs to stand out.
+                   WeatherProvider.WEATHER_CLASS_EMERGENCY : (1.0, (1.0, 0.3, 0.3)) }
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        parser.add_argument('--daylight-color', default=cls.COLOR_CLASSIC, choices=(cls.COLOR_CLASSIC, cls.COLOR_TEMPERATURE), help="Colour the daylight with one fixed colour per weather condition or by the colour temperature of the sun's altitude and the cloud cover.")
+    
+    def __init__(self):
+        self._condition_index = dict()
+        altitudes = np.arange(self.MIN_ALTITUDE, self.MAX_ALTITUDE + self.ALTITUDE_STEP, self.ALTITUDE_STEP)
+        self._table = np.empty((len(self.CONDITIONS), len(altitudes), 3), dtype=np.float64)
+        for index, (weather_class, (cloud_cover, tint)) in enumerate(sorted(self.CONDITIONS.items())):
+            self._condition_index[weather_class] = index
+            kelvin = self.kelvin_at(altitudes, cloud_cover)
+            self._table[index] = kelvin_to_rgb(kelvin) * np.array(tint)
+    
+    @classmethod
+    def kelvin_at(cls, altitude, cloud_cover=0.0):
+        '''
+        Correlated colour temperature for the sun at the given altitude
+        (degrees, scalar or numpy array) under the given cloud cover (0 - 1).
+        '''
+        above_twilight = np.maximum(np.asarray(altitude, dtype=np.float64) - cls.TWILIGHT_ALTITUDE, 0.0)
+        clear = cls.TWILIGHT_KELVIN + (cls.CLEAR_KELVIN - cls.TWILIGHT_KELVIN) * (1.0 - np.exp(-above_twilight / cls.ALTITUDE_SCALE))
+        return clear + (cls.OVERCAST_KELVIN - clear) * cloud_cover
+    
+    def color(self, weather_class, altitude):
+        '''
+        RGB (0 - 255) for the sun at the given altitude in degrees under the
+        given WeatherProvider.WEATHER_CLASS_*.
+        '''
+        index = int(round((min(max(altitude, self.MIN_ALTITUDE), self.MAX_ALTITUDE) - self.MIN_ALTITUDE) / self.ALTITUDE_STEP))
+        return tuple(self._table[self._condition_index[weather_class], index])
+
+
+def sun_altitudes(observer, sun, start, end, step_seconds=60.0):
+    '''
+    The sun's altitude in degrees every step_seconds from start to end
+    (ephem dates) as seen by observer. Lets the sky look the altitude up for
+    a time of day instead of solving for it every frame.
+    '''
+    count = max(2, int((end - start) * 24 * 60 * 60 / step_seconds) + 1)
+    altitudes = np.empty(count, dtype=np.float64)
+    for index, date in enumerate(np.linspace(float(start), float(end), count)):
+        observer.date = date
+        sun.compute(observer)
+        altitudes[index] = math.degrees(sun.alt)
+    return altitudes
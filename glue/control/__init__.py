@@ -0,0 +1,205 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import json
+import Queue
+import threading
+
+from diagnostics import debug_log
+
+
+def _is_number(value):
+    # JSON true and false load as bools, which are ints to isinstance.
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+class ControlServer(object):
+    '''
+    Loopback HTTP endpoint for changing the skylight while it runs. GET
+    /config returns the current settings as JSON, GET /log the recent debug
+    messages (see diagnostics.DiagnosticLog) and POST /config takes a JSON
+    object with any of:
+    
+        brightness  0.0 - 1.0
+        channel     OPC channel, 0 - 255
+        weather     fake weather conditions or null for the real weather
+        twilight    horizon in degrees the sun rises through at first light
+        curve       the daylight curve's five control point levels
+    
+    Requests are checked on the server thread and queued. The render loop
+    applies them between frames through apply_pending() so nothing it owns is
+    touched from another thread. Each setting only invalidates the state that
+    depends on it (e.g. a new curve doesn't re-solve the ephemeris).
+    '''
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        control_args = parser.add_argument_group('control options')
+        control_args.add_argument('--control-port', default=None, type=int, help="Accept setting changes as JSON on this loopback port while running.")
+    
+    def __init__(self, args, panel, sky, weather):
+        self._port = args.control_port
+        self._verbose = args.verbose
+        self._panel = panel
+        self._sky = sky
+        self._weather = weather
+        self._pending = Queue.Queue()
+        self._server = None
+        self._thread = None
+    
+    def start(self):
+        if self._port is None:
+            return
+        import BaseHTTPServer
+        self._server = BaseHTTPServer.HTTPServer(("127.0.0.1", self._port), _make_request_handler(BaseHTTPServer))
+        self._server.control = self
+        self._thread = threading.Thread(group=None, target=self._server.serve_forever, name="control")
+        self._thread.daemon = True
+        self._thread.start()
+        if self._verbose:
+            print "Accepting control requests on 127.0.0.1:{}".format(self._port)
+    
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._thread.join()
+    
+    def get_settings(self):
+        return {'brightness': float(self._panel.brightness),
+                'channel': self._panel.channel,
+                'weather': self._sky.get_sky_weather(),
+                'twilight': self._sky.twilight,
+                'curve': list(self._sky.curve_levels)}
+    
+    def submit(self, settings):
+        '''
+        Check a dictionary of settings and queue it for the render loop.
+        Raises ValueError if anything in it can't be applied.
+        '''
+        if not isinstance(settings, dict):
+            raise ValueError("expected a JSON object")
+        unknown = set(settings.keys()) - set(self.get_settings().keys())
+        if len(unknown) > 0:
+            raise ValueError("unknown settings: {}".format(", ".join(sorted(unknown))))
+        if 'brightness' in settings:
+            brightness = settings['brightness']
+            if not _is_number(brightness) or brightness < 0 or brightness > 1:
+                raise ValueError("brightness must be a value from 0 to 1")
+        if 'channel' in settings:
+            channel = settings['channel']
+            if not isinstance(channel, (int, long)) or isinstance(channel, bool) or channel < 0 or channel > 255:
+                raise ValueError("channel must be a value from 0 to 255")
+        if 'weather' in settings:
+            if self._weather is None:
+                raise ValueError("there is no weather provider")
+            if settings['weather'] is not None and not isinstance(settings['weather'], basestring):
+                raise ValueError("weather must be a string or null")
+            self._weather.check_fake_weather(settings['weather'])
+        if 'twilight' in settings:
+            try:
+                if isinstance(settings['twilight'], bool):
+                    raise ValueError()
+                float(settings['twilight'])
+            except (TypeError, ValueError):
+                raise ValueError("twilight must be an angle in degrees")
+        if 'curve' in settings:
+            curve = settings['curve']
+            if not isinstance(curve, list) or len(curve) != len(self._sky.curve_levels) or \
+                    not all(_is_number(level) for level in curve):
+                raise ValueError("curve must be a list of {} numbers".format(len(self._sky.curve_levels)))
+        self._pending.put(settings)
+    
+    def apply_pending(self):
+        '''
+        Apply every queued change. Call from the render loop between frames.
+        Returns True if anything was applied.
+        '''
+        applied = False
+        while True:
+            try:
+                settings = self._pending.get_nowait()
+            except Queue.Empty:
+                return applied
+            try:
+                self._apply(settings)
+                applied = True
+            except (AttributeError, ValueError) as e:
+                debug_log.emit("Unable to apply {}: {}", settings, str(e))
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _apply(self, settings):
+        if self._verbose:
+            debug_log.emit("Applying {}", settings)
+        if 'brightness' in settings:
+            self._panel.brightness = float(settings['brightness'])
+        if 'channel' in settings:
+            self._panel.channel = settings['channel']
+        if 'weather' in settings:
+            self._weather.set_fake_weather(settings['weather'])
+        if 'twilight' in settings:
+            self._sky.twilight = str(float(settings['twilight']))
+        if 'curve' in settings:
+            self._sky.curve_levels = settings['curve']
+
+
+def _make_request_handler(BaseHTTPServer):
+    '''
+    The HTTP server is only imported if the control port is used.
+    '''
+    
+    class _ControlRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        
+        def do_GET(self):
+            if self.path == "/config":
+                self._reply(200, self.server.control.get_settings())
+            elif self.path == "/log":
+                self._reply(200, debug_log.get_lines())
+            else:
+                self._reply(404, {'error': "not found"})
+        
+        def do_POST(self):
+            if self.path != "/config":
+                self._reply(404, {'error': "not found"})
+                return
+            try:
+                length = int(self.headers.getheader('content-length', 0))
+                self.server.control.submit(json.loads(self.rfile.read(length)))
+            except ValueError as e:
+                self._reply(400, {'error': str(e)})
+                return
+            self._reply(202, {'status': "queued"})
+        
+        def _reply(self, status, value):
+            body = json.dumps(value) + "\n"
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):  # @ReservedAssignment
+            pass
+    
+    return _ControlRequestHandler
@@ -21,6 +21,9 @@
 #  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
 # |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
 #                                                     |___/     |___/
+import Queue
+import time
+
 import numpy as np
 
 pascals_triangle = [
@@ -63,16 +66,17 @@ def bezier_curve(control_points, nTimes):
 
     return xvals, yvals
 
-def make_curve(morning_twilight, dawn, dusk, dark):
+# Bezier control point levels at twilight, dawn, noon, dusk and dark.
+DEFAULT_CURVE_LEVELS = (0.01, 1.80, 0.30, 1.80, 0.01)
+
+def make_curve(morning_twilight, dawn, dusk, dark, levels=DEFAULT_CURVE_LEVELS):
     noon = dawn + ((dusk - dawn) / 2.0)
-    # TODO: this shouldn't be buried in this method. Break out into
-    # some sort of configuration.
     control_points = [
-        [ morning_twilight, 0.01], 
-        [ dawn            , 1.80], 
-        [ noon            , 0.30], 
-        [ dusk            , 1.80], 
-        [ dark            , 0.01]
+        [ morning_twilight, levels[0]], 
+        [ dawn            , levels[1]], 
+        [ noon            , levels[2]], 
+        [ dusk            , levels[3]], 
+        [ dark            , levels[4]]
         ]
     return bezier_curve(control_points,
                         round((dark - morning_twilight) * 3600))
@@ -105,6 +109,86 @@ def plot_curve(xy, dawn=None, dusk=None):
         plt.grid(False)
         plt.show()
 
+class DaylightChart(object):
+    '''
+    Live plot of the daylight curve in a separate process. The curve is sent
+    whenever it changes and a marker for the current time, intensity and
+    weather colour at most max_updates_per_second times a second. Messages go
+    over a bounded queue and are dropped when it is full so a slow (or closed)
+    chart window can never hold up the caller.
+    '''
+    
+    def __init__(self, max_updates_per_second=2.0):
+        self._min_update_interval = 1.0 / max_updates_per_second
+        self._last_update = 0
+        self._curve = None
+        # Only needed with --show-daylight-chart so keep it off of the startup path.
+        import multiprocessing
+        self._queue = multiprocessing.Queue(maxsize=8)
+        self._process = multiprocessing.Process(target=_chart_routine, args=(self._queue,), name="daylight_chart")
+        self._process.daemon = True
+        self._process.start()
+    
+    def update(self, xy, dawn, dusk, now, intensity, color):
+        if not self._process.is_alive():
+            return
+        if xy is not self._curve:
+            # Decimate the curve: the chart is a few hundred pixels wide.
+            step = max(1, len(xy[0]) // 500)
+            if self._send(("curve", xy[0][::step], xy[1][::step], float(dawn), float(dusk))):
+                self._curve = xy
+        now_seconds = time.time()
+        if now_seconds - self._last_update >= self._min_update_interval:
+            self._last_update = now_seconds
+            self._send(("marker", float(now), float(intensity), tuple(c / 255.0 for c in color)))
+    
+    def close(self):
+        self._send(None)
+        self._process.join(1)
+    
+    def _send(self, message):
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except Queue.Full:
+            return False
+
+def _chart_routine(queue):
+    import matplotlib.pyplot as plt
+    
+    plt.ion()
+    figure = plt.figure()
+    axes = figure.add_subplot(1, 1, 1)
+    axes.set_xlabel('time (day)')
+    axes.set_ylabel('intensity')
+    axes.set_title('daylight')
+    curve, = axes.plot([], [], color="blue")
+    dawn_line, = axes.plot([], [], linestyle="dashed", color="grey")
+    dusk_line, = axes.plot([], [], linestyle="dashed", color="grey")
+    marker, = axes.plot([], [], marker="o", markersize=12, linestyle="none")
+    
+    while plt.fignum_exists(figure.number):
+        try:
+            message = queue.get(timeout=0.1)
+        except Queue.Empty:
+            message = False
+        if message is None:
+            break
+        elif message and message[0] == "curve":
+            _, x, y, dawn, dusk = message
+            curve.set_data(x, y)
+            dawn_line.set_data([dawn, dawn], [0, 1.0])
+            dusk_line.set_data([dusk, dusk], [0, 1.0])
+            axes.set_xlim(x[0], x[-1])
+            axes.set_ylim(0, max(1.0, max(y)) * 1.05)
+        elif message and message[0] == "marker":
+            _, now, intensity, color = message
+            marker.set_data([now], [intensity])
+            marker.set_color(color)
+            marker.set_markeredgecolor("black")
+        plt.pause(0.05)
+    plt.close(figure)
+
 def main():
     twi  = 0.000
     dawn = 0.025
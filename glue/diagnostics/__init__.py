@@ -0,0 +1,166 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import collections
+import signal
+import sys
+import threading
+import time
+import Queue
+
+
+class DiagnosticLog(object):
+    '''
+    Debug output that stays off the render loop. emit() only queues the
+    message format and its arguments. A writer thread formats them, keeps the
+    last buffer_size lines in memory and prints them, at most rate_limit
+    times a second for any one message format (the lines in between are
+    counted and mentioned with the next one that is printed). The in-memory
+    lines can be dumped at any time, e.g. on SIGUSR1.
+    '''
+    
+    QUEUE_SIZE = 4096
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        log_args = parser.add_argument_group('logging options')
+        log_args.add_argument('--log-rate', default=1.0, type=float, help="Most times a second any one debug message is printed. 0 prints every one.")
+        log_args.add_argument('--log-buffer', default=1024, type=int, help="Number of recent debug messages kept in memory and written out on SIGUSR1.")
+        log_args.add_argument('--log-dump', default=None, help="File SIGUSR1 writes the recent debug messages to. Defaults to stderr.")
+    
+    def __init__(self, buffer_size=1024, rate_limit=None):
+        self._rate_limit = rate_limit
+        self._lines = collections.deque(maxlen=buffer_size)
+        self._lines_lock = threading.Lock()
+        self._queue = Queue.Queue(self.QUEUE_SIZE)
+        self._dropped = 0
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._dump_path = None
+    
+    def configure(self, args):
+        '''
+        Apply the commandline options and dump on SIGUSR1. Call from the main
+        thread.
+        '''
+        self._rate_limit = args.log_rate if args.log_rate > 0 else None
+        with self._lines_lock:
+            self._lines = collections.deque(self._lines, maxlen=max(1, args.log_buffer))
+        self._dump_path = args.log_dump
+        signal.signal(signal.SIGUSR1, self._on_dump_signal)
+    
+    def emit(self, message, *args, **fields):
+        '''
+        Queue message.format(*args, **fields), or just message if there is
+        nothing to format, to be printed. Never blocks: if the writer has
+        fallen that far behind the message is dropped.
+        '''
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), message, args, fields))
+        except Queue.Full:
+            self._dropped += 1
+    
+    def get_lines(self):
+        with self._lines_lock:
+            return list(self._lines)
+    
+    def dump(self, out=None):
+        out = out if out is not None else sys.stderr
+        for line in self.get_lines():
+            out.write(line + "\n")
+        out.flush()
+    
+    def stop(self):
+        '''
+        Print whatever is still queued and stop the writer.
+        '''
+        thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+            self._thread = None
+    
+    def reset_after_fork(self):
+        '''
+        Call first thing in a child process; the writer thread doesn't survive
+        the fork.
+        '''
+        self._queue = Queue.Queue(self.QUEUE_SIZE)
+        self._lines_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(group=None, target=self._writer_routine, name="diagnostics")
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+    
+    def _writer_routine(self):
+        last_printed = dict()
+        suppressed = collections.defaultdict(int)
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            timestamp, message, args, fields = record
+            try:
+                text = message.format(*args, **fields) if len(args) > 0 or len(fields) > 0 else message
+            except (IndexError, KeyError, ValueError) as e:
+                text = "{} (unable to format: {})".format(message, str(e))
+            with self._lines_lock:
+                self._lines.append("{}.{:03d} {}".format(time.strftime("%H:%M:%S", time.localtime(timestamp)),
+                                                         int((timestamp % 1) * 1000), text))
+            
+            if self._rate_limit is not None:
+                last = last_printed.get(message)
+                if last is not None and timestamp - last < 1.0 / self._rate_limit:
+                    suppressed[message] += 1
+                    continue
+                last_printed[message] = timestamp
+            skipped = suppressed.pop(message, 0)
+            if skipped > 0:
+                text += " ({} similar skipped)".format(skipped)
+            if self._dropped > 0:
+                text += " ({} dropped)".format(self._dropped)
+                self._dropped = 0
+            print text
+    
+    def _on_dump_signal(self, signum, frame):  # @UnusedVariable
+        if self._dump_path is None:
+            self.dump()
+            return
+        try:
+            with open(self._dump_path, 'w') as dump_file:
+                self.dump(dump_file)
+        except (IOError, OSError) as e:
+            print "Unable to dump debug messages to {}: {}".format(self._dump_path, str(e))
+
+
+# The log shared by every part of the skylight.
+debug_log = DiagnosticLog()
@@ -0,0 +1,252 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import os
+import threading
+import time
+
+import numpy as np
+
+
+# +---------------------------------------------------------------------------+
+# | LAYOUT
+# +---------------------------------------------------------------------------+
+# The bus is a file (normally on tmpfs under /dev/shm) laid out as a 64 byte
+# header followed by a ring of slots:
+#
+#   header: magic, version, slot count, pixel count, slot size, latest sequence
+#   slot:   sequence (u64) | timestamp (f64) | pixel_count * 3 bytes of RGB
+#
+# Frame n goes in slot n % slot count. While the writer is filling a slot its
+# sequence is odd (2n + 1) and once the frame is complete it becomes 2n + 2,
+# then the header's latest sequence is set to n. A reader that sees the same
+# even sequence before and after looking at a slot saw a complete frame.
+#
+# That only holds if the sequence stores and the pixel stores are seen in
+# program order, which weakly ordered CPUs like the ARM boards don't promise.
+# Python has no fences of its own so both sides take and release a private
+# lock between the steps (see _fence).
+
+_MAGIC = 0x3130535542594b53  # "SKYBUS01"
+_VERSION = 1
+_HEADER_BYTES = 64
+_SLOT_HEADER_BYTES = 16
+
+_HEADER_MAGIC = 0
+_HEADER_VERSION = 1
+_HEADER_SLOT_COUNT = 2
+_HEADER_PIXEL_COUNT = 3
+_HEADER_SLOT_BYTES = 4
+_HEADER_LATEST = 5
+
+_FENCE_LOCK = threading.Lock()
+
+def _fence():
+    '''
+    A full memory barrier. Taking and releasing a lock goes through the
+    platform's atomic operations, which order every load and store before
+    them against every one after. Nobody else uses this lock so it is never
+    contended.
+    '''
+    _FENCE_LOCK.acquire()
+    _FENCE_LOCK.release()
+
+def _slot_bytes(pixel_count):
+    # keep every slot 8 byte aligned.
+    return _SLOT_HEADER_BYTES + ((pixel_count * 3 + 7) // 8) * 8
+
+
+class _FrameBus(object):
+    
+    def __init__(self, path, raw):
+        self._path = path
+        self._raw = raw
+        self._header = raw[:_HEADER_BYTES].view('<u8')
+        self._slot_count = int(self._header[_HEADER_SLOT_COUNT])
+        self._pixel_count = int(self._header[_HEADER_PIXEL_COUNT])
+        slot_bytes = int(self._header[_HEADER_SLOT_BYTES])
+        self._sequences = []
+        self._timestamps = []
+        self._frames = []
+        for slot in range(self._slot_count):
+            offset = _HEADER_BYTES + slot * slot_bytes
+            self._sequences.append(raw[offset:offset + 8].view('<u8'))
+            self._timestamps.append(raw[offset + 8:offset + 16].view('<f8'))
+            frame_offset = offset + _SLOT_HEADER_BYTES
+            self._frames.append(raw[frame_offset:frame_offset + self._pixel_count * 3].reshape((self._pixel_count, 3)))
+    
+    @property
+    def path(self):
+        return self._path
+    
+    @property
+    def pixel_count(self):
+        return self._pixel_count
+    
+    @property
+    def slot_count(self):
+        return self._slot_count
+    
+    def close(self):
+        self._sequences = self._timestamps = self._frames = None
+        self._header = None
+        self._raw = None
+
+
+class FrameBusWriter(_FrameBus):
+    '''
+    Publishes frames into a shared-memory ring buffer so other processes can
+    watch the skylight without any cost to the render loop beyond a copy of
+    the frame. The writer never waits for readers; a reader can always tell if
+    the writer lapped it (see FrameBusReader). The bus file is removed by
+    close().
+    '''
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        bus_args = parser.add_argument_group('frame bus options')
+        bus_args.add_argument('--frame-bus', default=None, metavar="PATH", help="Publish every frame to a shared-memory ring buffer at this path (e.g. /dev/shm/skylight) for other processes to read.")
+        bus_args.add_argument('--frame-bus-slots', default=4, type=int, help="Number of frames the frame bus ring buffer holds.")
+    
+    def __init__(self, path, pixel_count, slot_count=4):
+        slot_bytes = _slot_bytes(pixel_count)
+        size = _HEADER_BYTES + slot_count * slot_bytes
+        # Build the new bus next to the old one and swap it in so readers
+        # never map a half-initialised file.
+        temp_path = "{}.{}".format(path, os.getpid())
+        raw = np.memmap(temp_path, dtype=np.uint8, mode='w+', shape=(size,))
+        header = raw[:_HEADER_BYTES].view('<u8')
+        header[_HEADER_VERSION] = _VERSION
+        header[_HEADER_SLOT_COUNT] = slot_count
+        header[_HEADER_PIXEL_COUNT] = pixel_count
+        header[_HEADER_SLOT_BYTES] = slot_bytes
+        header[_HEADER_LATEST] = 0
+        header[_HEADER_MAGIC] = _MAGIC
+        raw.flush()
+        os.rename(temp_path, path)
+        super(FrameBusWriter, self).__init__(path, raw)
+        self._inode = os.stat(path).st_ino
+        self._next = 1
+    
+    def publish(self, pixels):
+        sequence = self._next
+        slot = sequence % self._slot_count
+        self._sequences[slot][0] = 2 * sequence + 1
+        _fence()
+        self._timestamps[slot][0] = time.time()
+        count = min(len(pixels), self._pixel_count)
+        frame = self._frames[slot]
+        frame[:count] = pixels[:count]
+        # The slot still holds an older frame. Don't let readers see the
+        # rest of it.
+        frame[count:] = 0
+        _fence()
+        self._sequences[slot][0] = 2 * sequence + 2
+        _fence()
+        self._header[_HEADER_LATEST] = sequence
+        self._next = sequence + 1
+        return sequence
+    
+    def close(self):
+        if self._raw is None:
+            return
+        super(FrameBusWriter, self).close()
+        try:
+            # Leave the file alone if another writer has replaced it since.
+            if os.stat(self._path).st_ino == self._inode:
+                os.remove(self._path)
+        except OSError:
+            pass
+
+
+class FrameBusReader(_FrameBus):
+    '''
+    Reads frames published by a FrameBusWriter in another process.
+    '''
+    
+    def __init__(self, path):
+        with open(path, 'rb') as bus_file:
+            inode = os.fstat(bus_file.fileno()).st_ino
+            raw = np.memmap(bus_file, dtype=np.uint8, mode='r')
+        header = raw[:_HEADER_BYTES].view('<u8')
+        if header[_HEADER_MAGIC] != _MAGIC or header[_HEADER_VERSION] != _VERSION:
+            raise ValueError("{} is not a version {} frame bus.".format(path, _VERSION))
+        super(FrameBusReader, self).__init__(path, raw)
+        self._inode = inode
+    
+    @property
+    def latest_sequence(self):
+        return int(self._header[_HEADER_LATEST])
+    
+    def is_replaced(self):
+        '''
+        True if the bus at path is no longer the one this reader mapped: the
+        writer was restarted (possibly with another pixel or slot count) or
+        has stopped. Open a new reader to follow a restarted writer.
+        '''
+        try:
+            return os.stat(self._path).st_ino != self._inode
+        except OSError:
+            return True
+    
+    def read(self, sequence=None, copy=True):
+        '''
+        Returns (sequence, timestamp, frame) for the given frame (default the
+        latest) or None if it isn't available: either nothing has been
+        published yet or the writer has already reused its slot.
+        
+        With copy=False the frame is a view straight into shared memory. It is
+        only guaranteed to be intact if is_intact(sequence) is still True
+        after you are done with it.
+        '''
+        if sequence is None:
+            sequence = self.latest_sequence
+        if sequence == 0:
+            return None
+        slot = sequence % self._slot_count
+        if self._sequences[slot][0] != 2 * sequence + 2:
+            return None
+        _fence()
+        timestamp = float(self._timestamps[slot][0])
+        frame = self._frames[slot]
+        if copy:
+            frame = frame.copy()
+            if not self.is_intact(sequence):
+                return None
+        return sequence, timestamp, frame
+    
+    def is_intact(self, sequence):
+        _fence()
+        return self._sequences[sequence % self._slot_count][0] == 2 * sequence + 2
+    
+    def wait_for_next(self, sequence, timeout=None, poll_seconds=0.005):
+        '''
+        Poll until a frame newer than sequence is published. Returns its
+        sequence or None on timeout.
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            latest = self.latest_sequence
+            if latest > sequence:
+                return latest
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(poll_seconds)
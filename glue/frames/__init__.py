@@ -0,0 +1,152 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import json
+import os
+
+import ephem
+import numpy as np
+
+
+class FrameSink(object):
+    '''
+    Stands in for opc.Client and copies each frame the panel sends into a row
+    of a (frames, pixels, 3) uint8 array, typically a memory-mapped .npy file.
+    '''
+    
+    def __init__(self, frames, first_frame=0):
+        self._frames = frames
+        self._first_frame = first_frame
+        self.index = first_frame
+    
+    def put_pixels(self, pixels, channel=0):  # @UnusedVariable
+        self._frames[self.index - self._first_frame] = pixels
+        return True
+    
+    def disconnect(self):
+        pass
+
+
+class FrameFile(object):
+    '''
+    A memory-mapped .npy file of pre-rendered frames plus a small JSON sidecar
+    recording the time grid, pixel count and brightness they were rendered
+    with.
+    '''
+    
+    @staticmethod
+    def library_path(directory, city, date, profile):
+        '''
+        Where the frames for a given UTC date, city and render profile live in a
+        frame library directory.
+        '''
+        year, month, day = ephem.date(date).tuple()[:3]
+        return os.path.join(directory, "{}_{:04d}-{:02d}-{:02d}_{}.npy".format(
+            city.replace(" ", "_"), year, month, day, profile))
+    
+    @staticmethod
+    def day_start(date):
+        '''
+        00:00 UTC on the day containing date.
+        '''
+        year, month, day = ephem.date(date).tuple()[:3]
+        return ephem.date((year, month, day))
+    
+    @classmethod
+    def create(cls, path, start, step_seconds, frame_count, pixel_count, city=None, brightness=1.0):
+        frames = np.lib.format.open_memmap(path, 
+                                           mode='w+', 
+                                           dtype=np.uint8, 
+                                           shape=(frame_count, pixel_count, 3))
+        del frames
+        with open(cls._metadata_path(path), 'w') as metadata_file:
+            json.dump({'start': float(ephem.date(start)),
+                       'step': step_seconds,
+                       'frames': frame_count,
+                       'pixels': pixel_count,
+                       'brightness': brightness,
+                       'city': city}, metadata_file)
+        return cls(path)
+    
+    def __init__(self, path, mode='r'):
+        self._path = path
+        with open(self._metadata_path(path), 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+        self._start = ephem.date(metadata['start'])
+        self._step_days = metadata['step'] / (60.0 * 60 * 24)
+        for key in ('pixels', 'brightness'):
+            if key not in metadata:
+                raise ValueError("{} has no '{}' in its metadata.".format(self._metadata_path(path), key))
+        self._brightness = float(metadata['brightness'])
+        if self._brightness <= 0:
+            raise ValueError("{} was rendered at brightness {} so there is nothing to play.".format(path, self._brightness))
+        self._frames = np.load(path, mmap_mode=mode)
+        if metadata['pixels'] != self.pixel_count:
+            raise ValueError("{} holds {} pixel frames but its metadata says {}.".format(path, self.pixel_count, metadata['pixels']))
+    
+    @property
+    def frames(self):
+        return self._frames
+    
+    @property
+    def pixel_count(self):
+        return self._frames.shape[1]
+    
+    @property
+    def brightness(self):
+        '''
+        The panel brightness the frames were rendered with.
+        '''
+        return self._brightness
+    
+    @property
+    def start(self):
+        return self._start
+    
+    @property
+    def end(self):
+        return ephem.date(self._start + len(self._frames) * self._step_days)
+    
+    def time_of(self, index):
+        '''
+        The time at which the frame at index starts being shown.
+        '''
+        return ephem.date(self._start + index * self._step_days)
+    
+    def index_at(self, now):
+        '''
+        Index of the frame covering the given time or None if it is outside of
+        this file.
+        '''
+        index = int((now - self._start) / self._step_days)
+        if index < 0 or index >= len(self._frames):
+            return None
+        return index
+    
+    def close(self):
+        self._frames = None
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    @staticmethod
+    def _metadata_path(path):
+        return path + ".json"
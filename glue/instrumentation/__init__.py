@@ -0,0 +1,284 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import os
+import threading
+import time
+
+from clocks import monotonic
+
+
+# Fallback for seconds_since_process_start() where /proc isn't available.
+_IMPORTED_AT = time.time()
+
+def seconds_since_process_start():
+    '''
+    How long ago this process was started, including interpreter startup and
+    imports, from /proc on linux. Elsewhere this measures from when this
+    module was imported.
+    '''
+    try:
+        with open("/proc/self/stat", 'r') as stat_file:
+            # The command name can contain spaces so split after it.
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", 'r') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        start_ticks = float(fields[19])
+        return uptime - start_ticks / os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+    except (IOError, OSError, IndexError, KeyError, ValueError):
+        return time.time() - _IMPORTED_AT
+
+
+
+class _NullTimer(object):
+    '''
+    What StageMetrics.timer hands out while metrics are disabled.
+    '''
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _StageTimer(object):
+    
+    __slots__ = ('_window', '_start')
+    
+    def __init__(self, window):
+        self._window = window
+        self._start = None
+    
+    def __enter__(self):
+        self._start = monotonic()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._window.add(monotonic() - self._start)
+        return False
+
+
+class _RollingWindow(object):
+    '''
+    The last N samples of a stage plus running totals.
+    '''
+    
+    def __init__(self, size):
+        self._samples = [0.0] * size
+        self._next = 0
+        self._filled = 0
+        self.count = 0
+        self.total = 0.0
+    
+    def add(self, seconds):
+        self._samples[self._next] = seconds
+        self._next = (self._next + 1) % len(self._samples)
+        if self._filled < len(self._samples):
+            self._filled += 1
+        self.count += 1
+        self.total += seconds
+    
+    @property
+    def latest(self):
+        return self._samples[self._next - 1]
+    
+    def summary(self):
+        samples = sorted(self._samples[:self._filled])
+        if len(samples) == 0:
+            return None
+        return {'count': self.count,
+                'sum': self.total,
+                'p50': samples[int(0.50 * (len(samples) - 1))],
+                'p99': samples[int(0.99 * (len(samples) - 1))],
+                'max': samples[-1]}
+
+
+class StageMetrics(object):
+    '''
+    Times named stages of the frame (e.g. "ephemeris", "encode", "send") into
+    rolling windows and exports their p50/p99/max in the Prometheus text
+    format, either by rewriting a file periodically or by serving it over HTTP
+    on the loopback interface. While disabled, timer() returns a shared no-op
+    context manager so instrumented code costs next to nothing.
+    '''
+    
+    NULL_TIMER = _NullTimer()
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        metrics_args = parser.add_argument_group('metrics options')
+        metrics_args.add_argument('--metrics-file', default=None, help="Periodically write per-stage frame timings to this file in the Prometheus text format.")
+        metrics_args.add_argument('--metrics-port', default=None, type=int, help="Serve per-stage frame timings in the Prometheus text format on this loopback port.")
+        metrics_args.add_argument('--metrics-interval', default=10.0, type=float, help="Seconds between writes of --metrics-file.")
+        metrics_args.add_argument('--metrics-window', default=1024, type=int, help="Number of recent samples per stage the quantiles are computed over.")
+    
+    def __init__(self, window_size=1024):
+        self._window_size = window_size
+        self._windows = dict()
+        self._timers = dict()
+        self._lock = threading.Lock()
+        self._enabled = False
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._server = None
+    
+    @property
+    def enabled(self):
+        return self._enabled
+    
+    def enable(self, window_size=None):
+        if window_size is not None:
+            self._window_size = window_size
+        self._enabled = True
+    
+    def timer(self, stage):
+        '''
+        Context manager that records the time spent in the with block against
+        the given stage. Timers are not re-entrant for the same stage.
+        '''
+        if not self._enabled:
+            return self.NULL_TIMER
+        timer = self._timers.get(stage)
+        if timer is None:
+            timer = _StageTimer(self._window(stage))
+            self._timers[stage] = timer
+        return timer
+    
+    def record(self, stage, seconds):
+        if self._enabled:
+            self._window(stage).add(seconds)
+    
+    def latest(self, stage):
+        '''
+        (count, seconds) of the most recent sample of the given stage, or None
+        if it hasn't been timed.
+        '''
+        window = self._windows.get(stage)
+        if window is None or window.count == 0:
+            return None
+        return window.count, window.latest
+    
+    def snapshot(self):
+        with self._lock:
+            windows = list(self._windows.items())
+        snapshot = dict()
+        for stage, window in windows:
+            summary = window.summary()
+            if summary is not None:
+                snapshot[stage] = summary
+        return snapshot
+    
+    def format_prometheus(self):
+        snapshot = self.snapshot()
+        lines = ["# HELP skylight_stage_seconds Time spent in each stage of a skylight frame.",
+                 "# TYPE skylight_stage_seconds summary"]
+        for stage in sorted(snapshot.keys()):
+            summary = snapshot[stage]
+            lines.append('skylight_stage_seconds{{stage="{}",quantile="0.5"}} {:.9f}'.format(stage, summary['p50']))
+            lines.append('skylight_stage_seconds{{stage="{}",quantile="0.99"}} {:.9f}'.format(stage, summary['p99']))
+            lines.append('skylight_stage_seconds_sum{{stage="{}"}} {:.9f}'.format(stage, summary['sum']))
+            lines.append('skylight_stage_seconds_count{{stage="{}"}} {}'.format(stage, summary['count']))
+        lines.append("# HELP skylight_stage_seconds_max Slowest recent sample of each stage of a skylight frame.")
+        lines.append("# TYPE skylight_stage_seconds_max gauge")
+        for stage in sorted(snapshot.keys()):
+            lines.append('skylight_stage_seconds_max{{stage="{}"}} {:.9f}'.format(stage, snapshot[stage]['max']))
+        return "\n".join(lines) + "\n"
+    
+    # +-----------------------------------------------------------------+
+    # | EXPORT
+    # +-----------------------------------------------------------------+
+    def start_export(self, args):
+        '''
+        Enable metrics and start whichever exporters were asked for on the
+        commandline. Does nothing if none were.
+        '''
+        if args.metrics_file is None and args.metrics_port is None:
+            return
+        self.enable(args.metrics_window)
+        if args.metrics_file is not None:
+            self._start_thread(self._file_routine, args.metrics_file, args.metrics_interval)
+        if args.metrics_port is not None:
+            import BaseHTTPServer
+            self._server = BaseHTTPServer.HTTPServer(("127.0.0.1", args.metrics_port), _make_request_handler(BaseHTTPServer))
+            self._server.metrics = self
+            self._start_thread(self._server.serve_forever)
+    
+    def stop_export(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _window(self, stage):
+        window = self._windows.get(stage)
+        if window is None:
+            with self._lock:
+                window = self._windows.setdefault(stage, _RollingWindow(self._window_size))
+        return window
+    
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(group=None, target=target, args=args, name="metrics")
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+    
+    def _file_routine(self, path, interval):
+        temp_path = path + ".tmp"
+        while not self._stop_event.wait(interval):
+            try:
+                with open(temp_path, 'w') as metrics_file:
+                    metrics_file.write(self.format_prometheus())
+                os.rename(temp_path, path)
+            except (IOError, OSError) as e:
+                print "Unable to write metrics to {}: {}".format(path, str(e))
+
+
+def _make_request_handler(BaseHTTPServer):
+    '''
+    The HTTP server is only imported if the metrics port is used.
+    '''
+    
+    class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        
+        def do_GET(self):
+            body = self.server.metrics.format_prometheus()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):  # @ReservedAssignment
+            pass
+    
+    return _MetricsRequestHandler
+
+
+# The metrics shared by every stage of the skylight.
+stage_metrics = StageMetrics()
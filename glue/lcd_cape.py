@@ -15,10 +15,18 @@
 #   limitations under the License.
 
 import argparse
-import os
+import array
+import errno
+import fcntl
 import re
+import socket
+import struct
+import threading
 import time
 
+from diagnostics import debug_log
+from instrumentation import stage_metrics
+
 
 __app_name__ = "lcd_cape"
 
@@ -42,6 +50,131 @@ lcd_rows    = 2
 lcd_backlight_on = 0.0
 lcd_backlight_off = 1.0
 
+# +---------------------------------------------------------------------+
+class NetworkInfo(object):
+    '''
+    Answers the questions the LCD cape asks about the network (interface
+    address, wireless SSID, address used for outbound traffic) with ioctls
+    and sockets instead of forking shell pipelines. Answers are cached until
+    the kernel reports a link or address change over netlink, or until
+    max_age_seconds have passed where netlink isn't available.
+    '''
+    
+    SIOCGIFADDR = 0x8915
+    SIOCGIWESSID = 0x8B1B
+    IW_ESSID_MAX_SIZE = 32
+    IFNAMSIZ = 16
+    
+    NETLINK_ROUTE = 0
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    
+    def __init__(self, max_age_seconds=60):
+        self._max_age_seconds = max_age_seconds
+        self._cache = dict()
+        self._cached_at = time.time()
+        self._lock = threading.Lock()
+        self._netlink = self._open_netlink()
+    
+    def interface_address(self, interface):
+        return self._cached(("address", interface), self._query_interface_address, interface)
+    
+    def ssid(self, interface):
+        return self._cached(("ssid", interface), self._query_ssid, interface)
+    
+    def outbound_address(self):
+        return self._cached(("outbound",), self._query_outbound_address)
+    
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+            self._cached_at = time.time()
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _cached(self, key, query, *args):
+        if self._is_stale():
+            self.invalidate()
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = query(*args)
+            return self._cache[key]
+    
+    def _is_stale(self):
+        if self._netlink is None:
+            return time.time() - self._cached_at > self._max_age_seconds
+        changed = False
+        try:
+            while True:
+                self._netlink.recv(65536)
+                changed = True
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Lost the netlink socket (e.g. ENOBUFS after an overrun).
+                # Start over and treat it as a change.
+                self._netlink.close()
+                self._netlink = self._open_netlink()
+                changed = True
+        return changed
+    
+    @classmethod
+    def _open_netlink(cls):
+        if not hasattr(socket, "AF_NETLINK"):
+            return None
+        try:
+            netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, cls.NETLINK_ROUTE)
+            netlink.bind((0, cls.RTMGRP_LINK | cls.RTMGRP_IPV4_IFADDR | cls.RTMGRP_IPV4_ROUTE))
+            netlink.setblocking(False)
+            return netlink
+        except socket.error:
+            return None
+    
+    @classmethod
+    def _query_interface_address(cls, interface):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            request = struct.pack('256s', interface[:cls.IFNAMSIZ - 1])
+            result = fcntl.ioctl(sock.fileno(), cls.SIOCGIFADDR, request)
+            return socket.inet_ntoa(result[20:24])
+        except IOError:
+            return ""
+        finally:
+            sock.close()
+    
+    @classmethod
+    def _query_ssid(cls, interface):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            essid = array.array('B', b'\0' * (cls.IW_ESSID_MAX_SIZE + 1))
+            essid_address, essid_length = essid.buffer_info()
+            # struct iwreq: ifname followed by struct iw_point {pointer, length, flags}
+            request = array.array('B', struct.pack('{}sPHH'.format(cls.IFNAMSIZ), 
+                                                   interface[:cls.IFNAMSIZ - 1],
+                                                   essid_address,
+                                                   essid_length,
+                                                   0))
+            fcntl.ioctl(sock.fileno(), cls.SIOCGIWESSID, request, True)
+            return essid.tostring().split(b'\0', 1)[0]
+        except IOError:
+            return ""
+        finally:
+            sock.close()
+    
+    @staticmethod
+    def _query_outbound_address():
+        # Connecting a UDP socket sends nothing but makes the kernel pick the
+        # route (and so the source address) it would use.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect(("1.0.0.1", 53))
+            return sock.getsockname()[0]
+        except socket.error:
+            return ""
+        finally:
+            sock.close()
+
 # +---------------------------------------------------------------------+
 class LCDCape(object):
     
@@ -61,6 +194,10 @@ class LCDCape(object):
         self._page_delay_seconds = 5
         self._is_wlan = True if re.match("^eth", self._interface) is None else False
         self._sky = sky
+        self._network = NetworkInfo()
+        self._shadow = None
+        self._worker = None
+        self._stop_event = threading.Event()
         
         try:
             import Adafruit_CharLCD as LCD
@@ -86,13 +223,38 @@ class LCDCape(object):
             self._lcd = None
             
     def __call__(self):
-        if self._lcd is None:
+        '''
+        Starts the display worker the first time it is called. Pages are
+        rendered and written to the display on the worker so calling this from
+        the render loop costs nothing.
+        '''
+        if self._lcd is None or self._worker is not None:
             return
-
-        now = time.time()
-        if now - self._last_refresh < self._page_delay_seconds:
-            return
-        self._last_refresh = now
+        self._worker = threading.Thread(group=None, target=self._worker_routine, name="lcd_cape")
+        self._worker.daemon = True
+        self._worker.start()
+    
+    def stop(self):
+        self._stop_event.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+    
+    # +-----------------------------------------------------------------+
+    # | DISPLAY
+    # +-----------------------------------------------------------------+
+    def _worker_routine(self):
+        while not self._stop_event.is_set():
+            try:
+                with stage_metrics.timer("lcd"):
+                    self._show_next_page()
+            except Exception as e:
+                # Never let a bad page take the display down for good.
+                debug_log.emit("LCD cape update failed: {}", str(e))
+            self._stop_event.wait(self._page_delay_seconds)
+    
+    def _show_next_page(self):
+        self._last_refresh = time.time()
         
         self._page += 1
         if self._page == self.PAGE_COUNT:
@@ -102,13 +264,36 @@ class LCDCape(object):
         
         message = page_method()
         if self._verbose:
-            print "LCD CAPE PAGE {}:".format(self._page)
-            print "----------------"
-            print message
-            print "----------------"
+            debug_log.emit("LCD CAPE PAGE {}:\n----------------\n{}\n----------------", self._page, message)
+        
+        self._write(message)
+    
+    def _write(self, message):
+        '''
+        Writes only the characters that differ from what is already on the
+        display. Every character costs several transactions on the I2C port
+        expander so clearing and redrawing the whole display is slow.
+        '''
+        lines = message.split("\n")
+        rows = [(lines[row] if row < len(lines) else "").ljust(lcd_columns)[:lcd_columns] for row in range(lcd_rows)]
+        if self._shadow is None:
+            self._lcd.clear()
+            self._shadow = [" " * lcd_columns for _ in range(lcd_rows)]
         
-        self._lcd.clear()
-        self._lcd.message(message)
+        for row in range(lcd_rows):
+            shown = self._shadow[row]
+            wanted = rows[row]
+            column = 0
+            while column < lcd_columns:
+                if shown[column] == wanted[column]:
+                    column += 1
+                    continue
+                # write the run of changed characters after one cursor move.
+                self._lcd.set_cursor(column, row)
+                while column < lcd_columns and shown[column] != wanted[column]:
+                    self._lcd.write8(ord(wanted[column]), True)
+                    column += 1
+            self._shadow[row] = wanted
     
     def _show_page0(self):
         if self._is_wlan:
@@ -129,13 +314,13 @@ class LCDCape(object):
             return "{}\n{:.0%}".format(self._sky.get_sky_phase(), self._sky.get_sky_progress())
     
     def _ethernet_address(self, interface):
-        return os.popen("ip addr show " + interface + " | awk '$1 == \"inet\" {gsub(/\/.*$/, \"\", $2); print $2}'").read()
+        return self._network.interface_address(interface)
     
     def _wlan_ssid(self, interface):
-        return os.popen("iwconfig " + interface + " | awk -F '\"' '{print $2;exit}'").read()
+        return self._network.ssid(interface)
     
     def _wlan_address(self, interface):  # @UnusedVariable
-        return os.popen("ip route get 1 | awk '{print $NF;exit}'").read()
+        return self._network.outbound_address()
         
     
 # +---------------------------------------------------------------------+
@@ -153,9 +338,12 @@ def main():
      
     cape = LCDCape(args)
     
-    while(True):
-        cape()
-        time.sleep(1)
+    try:
+        while(True):
+            cape()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        cape.stop()
 
 if __name__ == "__main__":
     main()
@@ -22,6 +22,8 @@
 import math
 import numpy as np
 
+from framebus import FrameBusWriter
+
 class RectangularPixelMatrix(object):
     '''
     Square matrix of pixels.
@@ -31,19 +33,29 @@ class RectangularPixelMatrix(object):
         pixel_args = parser.add_argument_group('Pixel Options')
         #0, 32, 512
         pixel_args.add_argument("--brightness", "-b", type=float, default=1.0, help="Maximum brightness of any given pixel.", metavar="[0.0 - 1.0]")
-        pixel_args.add_argument("--channel", default=0, help="OPC channel to use.")
-        pixel_args.add_argument("--stride", default=32, help="Number of pixels in a row for the attached matrix")
-        pixel_args.add_argument("--pixel-count", default=512, help="Total number of pixels in the attached matrix") 
+        pixel_args.add_argument("--channel", default=0, type=int, help="OPC channel to use.")
+        pixel_args.add_argument("--stride", default=32, type=int, help="Number of pixels in a row for the attached matrix")
+        pixel_args.add_argument("--pixel-count", default=512, type=int, help="Total number of pixels in the attached matrix") 
+        FrameBusWriter.on_visit_argparse(parser, subparsers)
         
     def __init__(self, args, opc_client):
         super(RectangularPixelMatrix, self).__init__()
         self._opc_client = opc_client
+        # Clients that scale frames themselves (the FramePipeline) are handed
+        # the brightness instead of a scaled copy of every frame.
+        self._client_scales = getattr(opc_client, 'SCALES_BRIGHTNESS', False)
         self._channel = args.channel
         self._pixels = None
         self.stride = args.stride
         self.pixel_count = args.pixel_count
         self.rows = self.stride
         self.brightness = args.brightness
+        frame_bus_path = getattr(args, "frame_bus", None)
+        self._frame_bus = FrameBusWriter(frame_bus_path, self.pixel_count, args.frame_bus_slots) \
+            if frame_bus_path is not None else None
+        # Where frames the client scales are scaled again for the bus.
+        self._bus_pixels = np.empty((self.pixel_count, 3), dtype=np.float) \
+            if self._frame_bus is not None and self._client_scales else None
         
     @property
     def brightness(self):
@@ -71,10 +83,21 @@ class RectangularPixelMatrix(object):
             self.black()
         else:
             self._pixels = pixels
+        if self._client_scales:
+            self._send(self.brightness)
+            return
         if self._brightness is not None:
             self._pixels = np.multiply(self._brightness, self._pixels)
         self._send()
     
+    def put_frame(self, frame):
+        '''
+        Send a frame that is already scaled for this matrix (e.g. one
+        pre-rendered through it) without re-applying brightness.
+        '''
+        self._pixels = frame
+        self._send()
+    
     def fill(self, pixel):
         self.pixels = np.full((self.pixel_count, 3),
                    pixel, 
@@ -96,5 +119,41 @@ class RectangularPixelMatrix(object):
                                dtype=np.uint8)
         self._send()
 
-    def _send(self):
+    @staticmethod
+    def grid(pixels, stride):
+        '''
+        View a (pixel_count, 3) frame as (rows, stride, 3) without copying it.
+        A partial last row is left off.
+        '''
+        rows = len(pixels) // stride
+        return pixels[:rows * stride].reshape((rows, stride, 3))
+    
+    @property
+    def channel(self):
+        return self._channel
+    
+    @channel.setter
+    def channel(self, channel):
+        if channel < 0 or channel > 255:
+            raise AttributeError("channel must be a value from 0 to 255")
+        self._channel = channel
+    
+    @property
+    def frame_bus(self):
+        return self._frame_bus
+    
+    def close(self):
+        if self._frame_bus is not None:
+            self._frame_bus.close()
+            self._frame_bus = None
+    
+    def _send(self, brightness=1.0):
+        if brightness != 1.0:
+            self._opc_client.put_pixels(self._pixels, channel=self._channel, brightness=brightness)
+            if self._frame_bus is not None:
+                # Readers of the bus expect what the lights are showing.
+                self._frame_bus.publish(np.multiply(self._brightness, self._pixels, out=self._bus_pixels))
+            return
         self._opc_client.put_pixels(self._pixels, channel=self._channel)
+        if self._frame_bus is not None:
+            self._frame_bus.publish(self._pixels)
@@ -33,16 +33,42 @@ Recommended use:
 
 """
 
+import json
 import socket
+import struct
+import threading
+import time
+
+from diagnostics import debug_log
+from instrumentation import stage_metrics
 
 class Client(object):
 
+    # OPC command for system exclusive messages. The payload starts with a
+    # 16 bit system ID followed by a system specific command.
+    SYSTEM_EXCLUSIVE = 0xFF
+
+    FADECANDY_SYSTEM_ID = 0x0001
+    FADECANDY_SET_COLOR_CORRECTION = 0x0001
+    FADECANDY_SET_FIRMWARE_CONFIGURATION = 0x0002
+
+    FADECANDY_DISABLE_DITHERING = 0x01
+    FADECANDY_DISABLE_INTERPOLATION = 0x02
+    FADECANDY_MANUAL_LED_CONTROL = 0x04
+    FADECANDY_LED_ON = 0x08
+
     @classmethod
     def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
         opc_args = parser.add_argument_group('OPC options')
         opc_args.add_argument('--address', default="127.0.0.1", help="IP address to connect to.")
         opc_args.add_argument('-p', '--port', help="TCP port to connect to OPC server on.", default=7890, type=int)
         opc_args.add_argument('--opc-debug', action='store_true', help="Emit verbose logs from the OPC client.")
+        fc_args = parser.add_argument_group('FadeCandy options')
+        fc_args.add_argument('--fadecandy-setup', action='store_true', help="Configure FadeCandy firmware on every connection so it interpolates and dithers between frames, and upload the colour correction below.")
+        fc_args.add_argument('--fadecandy-gamma', default=2.5, type=float, help="Gamma for the FadeCandy colour correction tables.")
+        fc_args.add_argument('--fadecandy-whitepoint', default=[1.0, 1.0, 1.0], type=float, nargs=3, metavar=("R", "G", "B"), help="Whitepoint for the FadeCandy colour correction tables.")
+        fc_args.add_argument('--fadecandy-no-dither', action='store_true', help="Leave FadeCandy dithering off.")
+        fc_args.add_argument('--fadecandy-no-interpolate', action='store_true', help="Leave FadeCandy frame interpolation off.")
    
     
     def __init__(self, args, long_connection=True):
@@ -75,10 +101,20 @@ class Client(object):
         self._port = args.port
 
         self._socket = None  # will be None when we're not connected
+        self._fadecandy_setup = None
+        if getattr(args, 'fadecandy_setup', False):
+            self._fadecandy_setup = {
+                'color_correction': {'gamma': args.fadecandy_gamma,
+                                     'whitepoint': list(args.fadecandy_whitepoint)},
+                'dithering': not args.fadecandy_no_dither,
+                'interpolation': not args.fadecandy_no_interpolate}
+        self._connect_thread = None
+        self._pending_message = None
+        self._send_lock = threading.Lock()
 
     def _debug(self, m):
         if self.verbose:
-            print('    %s' % str(m))
+            debug_log.emit('    %s' % str(m))
 
     def _ensure_connected(self):
         """Set up a connection if one doesn't already exist.
@@ -96,12 +132,118 @@ class Client(object):
             self._socket.settimeout(1)
             self._socket.connect((self._ip, self._port))
             self._debug('_ensure_connected:    ...success')
-            return True
+            self._on_connected()
+            # Setting up the device can lose the connection again.
+            return self._socket is not None
         except socket.error:
             self._debug('_ensure_connected:    ...failure')
             self._socket = None
             return False
 
+    def connect_in_background(self, retry_seconds=1):
+        """Keep trying to connect to the server on a background thread.
+
+        Returns immediately. Until the connection is made put_pixels drops
+        frames without blocking; the most recent one is sent as soon as the
+        connection comes up.
+
+        """
+        if self._connect_thread is not None:
+            return
+        self._connect_thread = threading.Thread(group=None, target=self._connect_routine, args=[retry_seconds], name="opc_connect")
+        self._connect_thread.daemon = True
+        self._connect_thread.start()
+
+    def _connect_routine(self, retry_seconds):
+        while True:
+            connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            connection.settimeout(1)
+            try:
+                connection.connect((self._ip, self._port))
+                break
+            except socket.error:
+                connection.close()
+                self._debug('connect_in_background: waiting for %s:%d' % (self._ip, self._port))
+                time.sleep(retry_seconds)
+        with self._send_lock:
+            self._socket = connection
+            self._connect_thread = None
+            debug_log.emit('connected to OPC server on %d' % self._port)
+            self._on_connected()
+            if self._pending_message is not None and self._socket is not None:
+                try:
+                    self._socket.send(self._pending_message)
+                except socket.error:
+                    self._socket = None
+                self._pending_message = None
+
+    def _on_connected(self):
+        """Configure the device behind a fresh connection."""
+        if self._fadecandy_setup is None:
+            return
+        setup = self._fadecandy_setup
+        self.set_color_correction(**setup['color_correction'])
+        self.set_firmware_configuration(dithering=setup['dithering'],
+                                        interpolation=setup['interpolation'])
+
+    def send_system_exclusive(self, system_id, command_id, payload='', channel=0):
+        """Send an OPC system exclusive message.
+
+        Return True on success or False on failure. Unlike put_pixels this
+        does not try to connect.
+
+        """
+        data = struct.pack('>HH', system_id, command_id) + payload
+        message = struct.pack('>BBH', channel, self.SYSTEM_EXCLUSIVE, len(data)) + data
+        if self._socket is None:
+            return False
+        try:
+            self._socket.send(message)
+            return True
+        except socket.error:
+            self._debug('send_system_exclusive: connection lost.')
+            self._socket = None
+            return False
+
+    def set_color_correction(self, gamma=2.5, whitepoint=(1.0, 1.0, 1.0), linear_slope=None, linear_cutoff=None):
+        """Upload FadeCandy's colour correction (gamma and whitepoint).
+
+        The firmware applies these in its lookup tables so the host can send
+        uncorrected values.
+
+        """
+        correction = {'gamma': gamma, 'whitepoint': list(whitepoint)}
+        if linear_slope is not None:
+            correction['linearSlope'] = linear_slope
+        if linear_cutoff is not None:
+            correction['linearCutoff'] = linear_cutoff
+        self._debug('set_color_correction: %s' % correction)
+        return self.send_system_exclusive(self.FADECANDY_SYSTEM_ID,
+                                          self.FADECANDY_SET_COLOR_CORRECTION,
+                                          json.dumps(correction))
+
+    def set_firmware_configuration(self, dithering=True, interpolation=True, manual_led=False, led_on=False):
+        """Set FadeCandy's firmware configuration byte.
+
+        With interpolation on the firmware fades smoothly between the frames
+        it receives, so frames can be sent at a low rate. Dithering adds
+        temporal dithering for smooth fades at low brightness.
+
+        """
+        flags = 0
+        if not dithering:
+            flags |= self.FADECANDY_DISABLE_DITHERING
+        if not interpolation:
+            flags |= self.FADECANDY_DISABLE_INTERPOLATION
+        if manual_led:
+            flags |= self.FADECANDY_MANUAL_LED_CONTROL
+        if led_on:
+            flags |= self.FADECANDY_LED_ON
+        self._debug('set_firmware_configuration: 0x%02x' % flags)
+        return self.send_system_exclusive(self.FADECANDY_SYSTEM_ID,
+                                          self.FADECANDY_SET_FIRMWARE_CONFIGURATION,
+                                          chr(flags))
+
     def disconnect(self):
         """Drop the connection to the server, if there is one."""
         self._debug('disconnecting')
@@ -146,30 +288,53 @@ class Client(object):
         LED at a clocks (unless it's the first one).
 
         """
-        self._debug('put_pixels: connecting')
-        is_connected = self._ensure_connected()
-        if not is_connected:
-            self._debug('put_pixels: not connected.  ignoring these pixels.')
-            return False
+        waiting_for_connection = self._connect_thread is not None
+        if not waiting_for_connection:
+            self._debug('put_pixels: connecting')
+            is_connected = self._ensure_connected()
+            if not is_connected:
+                self._debug('put_pixels: not connected.  ignoring these pixels.')
+                return False
 
         # build OPC message
-        len_hi_byte = int(len(pixels)*3 / 256)
-        len_lo_byte = (len(pixels)*3) % 256
-        header = chr(channel) + chr(0) + chr(len_hi_byte) + chr(len_lo_byte)
-        pieces = [header]
-        for r, g, b in pixels:
-            r = min(255, max(0, int(r)))
-            g = min(255, max(0, int(g)))
-            b = min(255, max(0, int(b)))
-            pieces.append(chr(r) + chr(g) + chr(b))
-        if bytes is str:
-            message = ''.join(pieces)
-        else:
-            message = bytes(map(ord, ''.join(pieces)))
+        with stage_metrics.timer("encode"):
+            len_hi_byte = int(len(pixels)*3 / 256)
+            len_lo_byte = (len(pixels)*3) % 256
+            header = chr(channel) + chr(0) + chr(len_hi_byte) + chr(len_lo_byte)
+            if hasattr(pixels, 'astype'):
+                # numpy arrays: clamp and convert in one pass instead of per pixel.
+                if pixels.dtype.name == 'uint8':
+                    data = pixels.tostring()
+                else:
+                    data = pixels.clip(0, 255).astype('uint8').tostring()
+                message = header + data if bytes is str else bytes(map(ord, header)) + data
+            else:
+                pieces = [header]
+                for r, g, b in pixels:
+                    r = min(255, max(0, int(r)))
+                    g = min(255, max(0, int(g)))
+                    b = min(255, max(0, int(b)))
+                    pieces.append(chr(r) + chr(g) + chr(b))
+                if bytes is str:
+                    message = ''.join(pieces)
+                else:
+                    message = bytes(map(ord, ''.join(pieces)))
+
+        if waiting_for_connection:
+            with self._send_lock:
+                if self._connect_thread is not None:
+                    self._debug('put_pixels: still connecting.  holding on to these pixels.')
+                    self._pending_message = message
+                    return False
+
+        connection = self._socket
+        if connection is None:
+            return False
 
         self._debug('put_pixels: sending pixels to server')
         try:
-            self._socket.send(message)
+            with stage_metrics.timer("send"):
+                connection.send(message)
         except socket.error:
             self._debug('put_pixels: connection lost.  could not send pixels.')
             self._socket = None
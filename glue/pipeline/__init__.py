@@ -0,0 +1,273 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import ctypes
+
+import numpy as np
+
+from clocks import monotonic
+from diagnostics import debug_log
+from instrumentation import stage_metrics
+import opc
+
+
+# Stages the transmit process times for each frame. It has no exporter of its
+# own so the timings go back through shared memory and the render process
+# records them (see FramePipeline._record_transmit_timings).
+TRANSMIT_STAGES = ("scale", "encode", "send")
+
+# Per-slot values passed along with the frame.
+_META_CHANNEL = 0
+_META_BRIGHTNESS = 1
+
+# A frame on this channel tells the transmit process to stop.
+_STOP_CHANNEL = -1
+
+
+class FramePipeline(object):
+    '''
+    Moves brightness scaling, OPC encoding and transmission into a separate
+    process. Stands in for opc.Client in the render process: put_pixels copies
+    the unscaled uint8 frame into the next slot of a shared-memory ring along
+    with the brightness to apply and the transmit process takes it from there.
+    
+    Slots are used in order, so each side works out the next slot from its own
+    count of frames; the only things shared are two semaphores counting free
+    and ready slots. When every slot is in flight the renderer either waits
+    for one (backpressure) or, with drop_when_full, drops the frame.
+    
+    This is a fixed split into two processes, one rendering and one
+    transmitting. Live frames depend on the ones before them (weather blends,
+    the solved daylight, control changes) so they can't be handed out to
+    several render workers; batch_render renders a time grid over every core
+    instead. There is one producer: only call put_pixels from the process
+    that created the pipeline. If the transmit process dies the pipeline sends
+    frames itself from then on.
+    '''
+    
+    # Lets RectangularPixelMatrix hand over brightness with the frame instead
+    # of scaling it on the render thread.
+    SCALES_BRIGHTNESS = True
+    
+    # How long put_pixels waits for a slot before checking the transmit
+    # process is still there.
+    SLOT_TIMEOUT_SECONDS = 1.0
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        pipeline_args = parser.add_argument_group('pipeline options')
+        pipeline_args.add_argument('--pipeline', action='store_true', help="Scale, encode and send frames from a separate process so rendering and transmission run on different cores.")
+        pipeline_args.add_argument('--pipeline-slots', default=4, type=int, help="Number of frames that can be in flight between the render and transmit processes.")
+        pipeline_args.add_argument('--pipeline-drop', action='store_true', help="Drop frames when the transmit process falls behind instead of waiting for it.")
+    
+    def __init__(self, args, pixel_count=None):
+        self._args = args
+        self._pixel_count = pixel_count if pixel_count is not None else args.pixel_count
+        self._slot_count = args.pipeline_slots
+        self._drop_when_full = args.pipeline_drop
+        # Only needed with --pipeline so keep it off of the startup path.
+        import multiprocessing
+        self._buffer = multiprocessing.RawArray(ctypes.c_uint8, self._slot_count * self._pixel_count * 3)
+        self._frames = np.ctypeslib.as_array(self._buffer).reshape((self._slot_count, self._pixel_count, 3))
+        self._meta_buffer = multiprocessing.RawArray(ctypes.c_double, self._slot_count * 2)
+        self._meta = np.ctypeslib.as_array(self._meta_buffer).reshape((self._slot_count, 2))
+        self._timing_buffer = multiprocessing.RawArray(ctypes.c_double, self._slot_count * len(TRANSMIT_STAGES))
+        self._timings = np.ctypeslib.as_array(self._timing_buffer).reshape((self._slot_count, len(TRANSMIT_STAGES)))
+        self._timings[:] = np.nan
+        self._free_slots = multiprocessing.Semaphore(self._slot_count)
+        self._ready_slots = multiprocessing.Semaphore(0)
+        # frames sent and seconds spent scaling, encoding and sending them.
+        # Only the transmit process writes these.
+        self._transmit_frames = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self._transmit_seconds = multiprocessing.RawValue(ctypes.c_double, 0)
+        self._written = 0
+        self._render_frames = 0
+        self._dropped_frames = 0
+        self._backpressure_seconds = 0.0
+        self._fallback_client = None
+        self._started_at = monotonic()
+        self._transmitter = multiprocessing.Process(target=_transmit_routine, 
+                                                    args=(args, self._slot_count, self._pixel_count,
+                                                          self._buffer, self._meta_buffer, self._timing_buffer,
+                                                          self._free_slots, self._ready_slots,
+                                                          self._transmit_frames, self._transmit_seconds),
+                                                    name="opc_transmit")
+        self._transmitter.daemon = True
+        self._transmitter.start()
+    
+    # +-----------------------------------------------------------------+
+    # | OPC CLIENT
+    # +-----------------------------------------------------------------+
+    def put_pixels(self, pixels, channel=0, brightness=1.0):
+        if self._fallback_client is None and not self._transmitter.is_alive():
+            self._fall_back()
+        if self._fallback_client is not None:
+            self._render_frames += 1
+            if brightness != 1.0:
+                pixels = pixels * brightness
+            return self._fallback_client.put_pixels(pixels, channel=channel)
+        
+        slot = self._take_slot()
+        if slot is None:
+            if self._fallback_client is not None:
+                return self.put_pixels(pixels, channel, brightness)
+            self._dropped_frames += 1
+            return False
+        if stage_metrics.enabled:
+            self._record_transmit_timings(slot)
+        count = min(len(pixels), self._pixel_count)
+        frame = self._frames[slot]
+        if pixels.dtype == np.uint8:
+            frame[:count] = pixels[:count]
+        else:
+            np.copyto(frame[:count], np.clip(pixels[:count], 0, 255), casting='unsafe')
+        if count < self._pixel_count:
+            # The slot still holds an older frame. Don't send what's left of it.
+            frame[count:] = 0
+        meta = self._meta[slot]
+        meta[_META_CHANNEL] = channel
+        meta[_META_BRIGHTNESS] = brightness
+        self._written += 1
+        self._ready_slots.release()
+        self._render_frames += 1
+        return True
+    
+    def can_connect(self):
+        return self._transmitter.is_alive() or self._fallback_client is not None
+    
+    def connect_in_background(self):
+        pass
+    
+    def disconnect(self):
+        if self._transmitter.is_alive():
+            # Queued behind any frames still in flight so those are sent first.
+            if self._free_slots.acquire(True, self.SLOT_TIMEOUT_SECONDS):
+                self._meta[self._written % self._slot_count][_META_CHANNEL] = _STOP_CHANNEL
+                self._written += 1
+                self._ready_slots.release()
+                self._transmitter.join(2)
+            if self._transmitter.is_alive():
+                self._transmitter.terminate()
+        if self._fallback_client is not None:
+            self._fallback_client.disconnect()
+    
+    # +-----------------------------------------------------------------+
+    # | STATISTICS
+    # +-----------------------------------------------------------------+
+    def get_statistics(self):
+        elapsed = monotonic() - self._started_at
+        sent = self._transmit_frames.value
+        return {'rendered': self._render_frames,
+                'sent': sent,
+                'dropped': self._dropped_frames,
+                'render_fps': self._render_frames / elapsed if elapsed > 0 else 0.0,
+                'transmit_fps': sent / elapsed if elapsed > 0 else 0.0,
+                'transmit_busy': self._transmit_seconds.value / elapsed if elapsed > 0 else 0.0,
+                'backpressure_seconds': self._backpressure_seconds}
+    
+    def format_statistics(self):
+        return "render {render_fps:.1f} fps | transmit {transmit_fps:.1f} fps ({transmit_busy:.0%} busy) | {dropped} dropped | {backpressure_seconds:.2f} s waiting on transmit".format(
+            **self.get_statistics())
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _take_slot(self):
+        '''
+        The next slot once it is free, or None if the frame should be dropped
+        or the transmit process has gone (in which case the fallback client
+        is set up).
+        '''
+        if self._drop_when_full:
+            if not self._free_slots.acquire(False):
+                return None
+            return self._written % self._slot_count
+        waited_from = monotonic()
+        try:
+            while not self._free_slots.acquire(True, self.SLOT_TIMEOUT_SECONDS):
+                if not self._transmitter.is_alive():
+                    self._fall_back()
+                    return None
+            return self._written % self._slot_count
+        finally:
+            self._backpressure_seconds += monotonic() - waited_from
+    
+    def _record_transmit_timings(self, slot):
+        '''
+        Record how long the transmit process took over the frame that was last
+        in this slot. Slots come back in order so these lag the frame being
+        rendered by at most the number of slots.
+        '''
+        timings = self._timings[slot]
+        for stage, seconds in zip(TRANSMIT_STAGES, timings):
+            if not np.isnan(seconds):
+                stage_metrics.record(stage, seconds)
+        timings[:] = np.nan
+    
+    def _fall_back(self):
+        debug_log.emit("OPC transmit process exited ({}). Sending frames from the render process.", self._transmitter.exitcode)
+        self._fallback_client = opc.Client(self._args)
+        if not getattr(self._args, 'opc_dont_connect', False):
+            self._fallback_client.connect_in_background()
+
+
+def _transmit_routine(args, slot_count, pixel_count, buffer, meta_buffer, timing_buffer, free_slots, ready_slots, transmit_frames, transmit_seconds):
+    debug_log.reset_after_fork()
+    frames = np.ctypeslib.as_array(buffer).reshape((slot_count, pixel_count, 3))
+    metas = np.ctypeslib.as_array(meta_buffer).reshape((slot_count, 2))
+    timings = np.ctypeslib.as_array(timing_buffer).reshape((slot_count, len(TRANSMIT_STAGES)))
+    # Time the stages here only if the render process is exporting them. Only
+    # the latest sample of each is needed.
+    export = getattr(args, 'metrics_file', None) is not None or getattr(args, 'metrics_port', None) is not None
+    if export:
+        stage_metrics.enable(1)
+    sample_counts = dict()
+    client = opc.Client(args)
+    if not getattr(args, 'opc_dont_connect', False):
+        client.connect_in_background()
+    
+    read = 0
+    while True:
+        ready_slots.acquire()
+        slot = read % slot_count
+        read += 1
+        channel = int(metas[slot][_META_CHANNEL])
+        if channel == _STOP_CHANNEL:
+            break
+        brightness = metas[slot][_META_BRIGHTNESS]
+        start = monotonic()
+        frame = frames[slot]
+        with stage_metrics.timer("scale"):
+            if brightness != 1.0:
+                frame = np.multiply(frame, brightness)
+        client.put_pixels(frame, channel=channel)
+        transmit_seconds.value += monotonic() - start
+        transmit_frames.value += 1
+        if export:
+            for index, stage in enumerate(TRANSMIT_STAGES):
+                latest = stage_metrics.latest(stage)
+                # encode and send aren't timed for frames dropped while the
+                # client is disconnected.
+                if latest is not None and latest[0] != sample_counts.get(stage):
+                    sample_counts[stage] = latest[0]
+                    timings[slot][index] = latest[1]
+        free_slots.release()
+    client.disconnect()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from framebus import FrameBusReader
+from lights import RectangularPixelMatrix
+
+__app_name__ = "skylight_preview"
+
+# +---------------------------------------------------------------------------+
+# | FRAMES
+# +---------------------------------------------------------------------------+
+class PreviewSource(object):
+    '''
+    Downsampled frames from a skylight's frame bus (see --frame-bus) at no
+    more than max_fps. Runs in its own process so the lights never wait on
+    it: each call to next_frame() takes whatever frame is newest, and frames
+    published in between or overwritten while being read are dropped. If the
+    skylight is restarted, and so replaces the bus, the source follows it.
+    '''
+    
+    def __init__(self, bus_path, stride, scale=1, max_fps=5.0, timeout=1.0):
+        self._bus_path = bus_path
+        self._stride = stride
+        self._scale = max(1, scale)
+        self._period = 1.0 / max_fps
+        self._timeout = timeout
+        self._last_frame_time = 0.0
+        self.dropped = 0
+        self._open(FrameBusReader(bus_path))
+    
+    def _open(self, bus):
+        self._bus = bus
+        # Start from the newest frame. The ones before it were published
+        # before we were watching so they don't count as dropped.
+        self._sequence = max(0, bus.latest_sequence - 1)
+    
+    def _reopen(self):
+        '''
+        Follow the skylight to a new bus if it was restarted. Keeps the old
+        one if the new one isn't there (yet).
+        '''
+        try:
+            bus = FrameBusReader(self._bus_path)
+        except (IOError, OSError, ValueError):
+            return
+        self._bus.close()
+        self._open(bus)
+    
+    def next_frame(self):
+        '''
+        Block until a new frame is due and published. Returns it as a
+        (rows, columns, 3) uint8 array.
+        '''
+        while True:
+            delay = self._last_frame_time + self._period - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sequence = self._bus.wait_for_next(self._sequence, self._timeout)
+            if sequence is None:
+                if self._bus.is_replaced():
+                    self._reopen()
+                continue
+            self.dropped += max(0, sequence - self._sequence - 1)
+            self._sequence = sequence
+            frame = self._bus.read(sequence, copy=False)
+            if frame is None:
+                self.dropped += 1
+                continue
+            image = RectangularPixelMatrix.grid(frame[2], self._stride)[::self._scale, ::self._scale].copy()
+            if not self._bus.is_intact(sequence):
+                self.dropped += 1
+                continue
+            self._last_frame_time = time.time()
+            return image
+
+def encode_png(image):
+    '''
+    Minimal 8-bit RGB PNG of a (rows, columns, 3) uint8 array.
+    '''
+    height, width = image.shape[:2]
+    raw = b''.join(b'\x00' + image[row].tostring() for row in range(height))
+    
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 1)) + \
+        chunk(b'IEND', b'')
+
+# +---------------------------------------------------------------------------+
+# | TERMINAL
+# +---------------------------------------------------------------------------+
+_UPPER_HALF_BLOCK = u'\u2580'.encode('utf-8')
+
+def format_terminal(image):
+    '''
+    Two rows of pixels per line of text using 24-bit colour escapes: the
+    upper half block takes the top pixel as its foreground and the bottom one
+    as its background.
+    '''
+    lines = []
+    for row in range(0, len(image), 2):
+        top = image[row]
+        bottom = image[row + 1] if row + 1 < len(image) else top * 0
+        cells = ["\x1b[38;2;{};{};{}m\x1b[48;2;{};{};{}m".format(t[0], t[1], t[2], b[0], b[1], b[2]) + _UPPER_HALF_BLOCK
+                 for t, b in zip(top, bottom)]
+        lines.append("".join(cells) + "\x1b[0m")
+    return "\x1b[H" + "\n".join(lines) + "\n"
+
+def run_terminal(source):
+    sys.stdout.write("\x1b[2J")
+    try:
+        while True:
+            sys.stdout.write(format_terminal(source.next_frame()))
+            sys.stdout.flush()
+    finally:
+        sys.stdout.write("\x1b[0m\n")
+
+# +---------------------------------------------------------------------------+
+# | HTTP
+# +---------------------------------------------------------------------------+
+_BOUNDARY = "skylightframe"
+
+_PAGE = '''<html><head><title>skylight</title></head>
+<body style="background:#000;margin:0">
+<img src="/stream" style="width:100%;image-rendering:pixelated;image-rendering:crisp-edges">
+</body></html>
+'''
+
+class PreviewStream(object):
+    '''
+    Encodes the newest frame once for however many clients are watching and
+    hands it to them as it changes.
+    '''
+    
+    def __init__(self, source):
+        self._source = source
+        self._condition = threading.Condition()
+        self._png = None
+        self._count = 0
+    
+    def run(self):
+        while True:
+            png = encode_png(self._source.next_frame())
+            with self._condition:
+                self._png = png
+                self._count += 1
+                self._condition.notify_all()
+    
+    def wait_for_frame(self, count):
+        '''
+        Returns (count, png) for the first frame after count.
+        '''
+        with self._condition:
+            while self._count <= count:
+                self._condition.wait()
+            return self._count, self._png
+
+
+def _make_request_handler(BaseHTTPServer):
+    
+    class _PreviewRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        
+        def do_GET(self):
+            if self.path == "/":
+                self._reply("text/html", _PAGE)
+            elif self.path == "/frame.png":
+                self._reply("image/png", self.server.stream.wait_for_frame(0)[1])
+            elif self.path == "/stream":
+                self._stream()
+            else:
+                self.send_error(404)
+        
+        def _reply(self, content_type, body):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def _stream(self):
+            # Browsers show a multipart/x-mixed-replace stream of images as
+            # one moving picture (as for MJPEG).
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=" + _BOUNDARY)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            count = 0
+            try:
+                while True:
+                    count, png = self.server.stream.wait_for_frame(count)
+                    self.wfile.write("--{}\r\nContent-Type: image/png\r\nContent-Length: {}\r\n\r\n".format(_BOUNDARY, len(png)))
+                    self.wfile.write(png)
+                    self.wfile.write("\r\n")
+                    self.wfile.flush()
+            except IOError:
+                # the viewer went away.
+                pass
+        
+        def log_message(self, format, *args):  # @ReservedAssignment
+            pass
+    
+    return _PreviewRequestHandler
+
+def run_http(source, port):
+    import BaseHTTPServer
+    import SocketServer
+    
+    class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+    
+    stream = PreviewStream(source)
+    server = _Server(("127.0.0.1", port), _make_request_handler(BaseHTTPServer))
+    server.stream = stream
+    thread = threading.Thread(group=None, target=stream.run, name="preview")
+    thread.daemon = True
+    thread.start()
+    print "Serving the preview on http://127.0.0.1:{}/".format(port)
+    server.serve_forever()
+
+# +---------------------------------------------------------------------------+
+# | MAIN
+# +---------------------------------------------------------------------------+
+
+def main():
+    parser = argparse.ArgumentParser(
+            prog=__app_name__, 
+            description="Shows what a running skylight is sending to its lights, in the terminal or on a loopback web page.")
+    
+    parser.add_argument('--frame-bus', required=True, metavar="PATH", help="Frame bus the skylight was started with (its --frame-bus).")
+    parser.add_argument('--stride', default=32, type=int, help="Number of pixels in a row for the attached matrix.")
+    parser.add_argument('--scale', default=1, type=int, help="Only show every Nth pixel of every Nth row.")
+    parser.add_argument('--fps', default=5.0, type=float, help="Most preview frames per second.")
+    parser.add_argument('--port', default=None, type=int, help="Serve the preview on this loopback port instead of drawing it in the terminal.")
+    parser.add_argument('--verbose','-v', action='store_true', help="Report dropped frames on exit.")
+    
+    args = parser.parse_args()
+    
+    source = PreviewSource(args.frame_bus, args.stride, args.scale, args.fps)
+    try:
+        if args.port is not None:
+            run_http(source, args.port)
+        else:
+            run_terminal(source)
+    except KeyboardInterrupt:
+        pass
+    if args.verbose:
+        print "Skipped {} frames".format(source.dropped)
+
+if __name__ == "__main__":
+    main()
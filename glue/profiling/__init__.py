@@ -0,0 +1,160 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import os
+import sys
+import threading
+import time
+
+from clocks import monotonic
+
+
+class LoopProfiler(object):
+    '''
+    Profiles a window of the render loop, either a number of frames or a
+    number of seconds, and writes the results when the window closes.
+    
+    The deterministic mode uses cProfile and writes pstats output. The
+    sampling mode runs a thread that wakes every few milliseconds and records
+    the current stack of the thread that started the profile. It writes
+    "collapsed" stacks (one "frame;frame;frame count" line per unique stack)
+    which flamegraph.pl and speedscope read directly. Samples are taken on
+    wall-clock time so time the loop spends waiting for the next frame shows
+    up too. Sampling is cheap enough to leave on in the field.
+    '''
+    
+    MODE_DETERMINISTIC = "deterministic"
+    MODE_SAMPLING = "sampling"
+    
+    # Fewer samples than this are too few to read anything into.
+    MIN_SAMPLES = 100
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        profile_args = parser.add_argument_group('profiling options')
+        profile_args.add_argument('--profile-loop', default=None, choices=(cls.MODE_DETERMINISTIC, cls.MODE_SAMPLING), help="Profile the render loop.")
+        profile_args.add_argument('--profile-frames', default=None, type=int, help="Number of frames to profile.")
+        profile_args.add_argument('--profile-seconds', default=None, type=float, help="Number of seconds to profile for (default 60 if --profile-frames isn't given).")
+        profile_args.add_argument('--profile-output', default=None, help="Where to write the profile (default skylight.pstats or skylight.folded).")
+        profile_args.add_argument('--profile-interval', default=5.0, type=float, help="Milliseconds between samples in sampling mode.")
+        profile_args.add_argument('--profile-then', default="exit", choices=("exit", "continue"), help="Whether to exit or keep running once the profile is written.")
+    
+    def __init__(self, args):
+        self._mode = args.profile_loop
+        self._frames_left = args.profile_frames
+        self._seconds = args.profile_seconds
+        if self._frames_left is None and self._seconds is None:
+            self._seconds = 60.0
+        self._interval = args.profile_interval / 1000.0
+        self._exit_when_done = (args.profile_then == "exit")
+        self._output = args.profile_output
+        if self._output is None and self._mode is not None:
+            self._output = "skylight.pstats" if self._mode == self.MODE_DETERMINISTIC else "skylight.folded"
+        self._profile = None
+        self._samples = None
+        self._sample_count = 0
+        self._sampler = None
+        self._stop_event = threading.Event()
+        self._started_at = None
+        self._running = False
+    
+    @property
+    def is_running(self):
+        return self._running
+    
+    def start(self):
+        if self._mode is None:
+            return
+        if self._mode == self.MODE_DETERMINISTIC:
+            # Only needed for --profile-loop deterministic so keep it off of
+            # the startup path.
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._samples = dict()
+            self._sample_count = 0
+            self._stop_event.clear()
+            self._sampler = threading.Thread(group=None, target=self._sample_routine, args=[threading.current_thread().ident], name="profiler")
+            self._sampler.daemon = True
+            self._sampler.start()
+        self._started_at = monotonic()
+        self._running = True
+        print "Profiling the render loop ({}).".format(self._mode)
+    
+    def frame_done(self):
+        '''
+        Call once per frame. Returns True if the loop should exit because the
+        profile is complete.
+        '''
+        if not self._running:
+            return False
+        if self._frames_left is not None:
+            self._frames_left -= 1
+            if self._frames_left > 0:
+                return False
+        elif monotonic() - self._started_at < self._seconds:
+            return False
+        self.stop()
+        return self._exit_when_done
+    
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        elapsed = monotonic() - self._started_at
+        if self._mode == self.MODE_DETERMINISTIC:
+            self._profile.disable()
+            self._profile.dump_stats(self._output)
+            self._profile = None
+        else:
+            self._stop_event.set()
+            self._sampler.join()
+            self._sampler = None
+            with open(self._output, 'w') as folded_file:
+                for stack, count in sorted(self._samples.items()):
+                    folded_file.write("{} {}\n".format(stack, count))
+            self._samples = None
+            if self._sample_count < self.MIN_SAMPLES:
+                print "Only {} samples were taken. Profile for longer or lower --profile-interval.".format(self._sample_count)
+        print "Wrote a {:.1f} second profile to {}".format(elapsed, self._output)
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _sample_routine(self, thread_id):
+        # Event.wait polls on python 2 so sleep for a steadier interval.
+        while not self._stop_event.is_set():
+            time.sleep(self._interval)
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                self._record(frame)
+    
+    def _record(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{}:{}".format(code.co_name, os.path.basename(code.co_filename)))
+            frame = frame.f_back
+        stack.reverse()
+        key = ";".join(stack)
+        self._samples[key] = self._samples.get(key, 0) + 1
+        self._sample_count += 1
@@ -0,0 +1,166 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import gzip
+import json
+import threading
+import time
+from collections import deque
+
+
+class SessionRecorder(object):
+    '''
+    Writes the stream of clock samples and weather conditions seen by a running
+    skylight to a gzipped file (one JSON array per line) so the session can be
+    replayed later with SessionReplay.
+    '''
+    
+    FORMAT_VERSION = 1
+    
+    RECORD_CLOCK = "c"
+    RECORD_WEATHER = "w"
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        group = parser.add_argument_group("session options")
+        group.add_argument('--record', default=None, metavar="FILE", help="Record clock samples and weather conditions to a file for later replay.")
+    
+    def __init__(self, path, city=None, provider=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wb')
+        self._write({'version': self.FORMAT_VERSION, 'city': city, 'provider': provider, 'started': time.time()})
+    
+    def record_clock(self, wall_seconds, sky_now):
+        self._write([self.RECORD_CLOCK, wall_seconds, float(sky_now)])
+    
+    def record_weather(self, wall_seconds, conditions):
+        self._write([self.RECORD_WEATHER, wall_seconds, conditions])
+    
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+
+
+class RecordingClock(object):
+    '''
+    Wraps any clock and records every sample it hands out.
+    '''
+    
+    def __init__(self, clock, recorder):
+        self._clock = clock
+        self._recorder = recorder
+    
+    def now(self):
+        now = self._clock.now()
+        self._recorder.record_clock(self._clock.wall_time(), now)
+        return now
+    
+    def wall_time(self):
+        return self._clock.wall_time()
+    
+    def get_rate(self):
+        return self._clock.get_rate()
+
+
+class SessionReplay(object):
+    '''
+    Reads a file written by SessionRecorder. Clock samples are handed out one
+    at a time in the order they were recorded and any weather recorded between
+    them is queued until a consumer asks for it.
+    '''
+    
+    def __init__(self, path):
+        self._path = path
+        self._file = gzip.open(path, 'rb')
+        header = json.loads(self._file.readline())
+        if header.get('version') != SessionRecorder.FORMAT_VERSION:
+            raise ValueError("{} is not a version {} session recording.".format(path, SessionRecorder.FORMAT_VERSION))
+        if 'provider' not in header:
+            raise ValueError("{} doesn't say which weather provider recorded it.".format(path))
+        self._city = header.get('city')
+        self._provider = header['provider']
+        self._wall_time = header.get('started')
+        self._weather = deque()
+        self._clock_samples = 0
+    
+    @property
+    def city(self):
+        return self._city
+    
+    @property
+    def provider(self):
+        '''
+        Name of the weather provider whose responses are in the recording.
+        '''
+        return self._provider
+    
+    @property
+    def clock_samples(self):
+        return self._clock_samples
+    
+    def wall_time(self):
+        '''
+        The wall-clock time at which the current clock sample was recorded.
+        '''
+        return self._wall_time
+    
+    def next_clock(self):
+        '''
+        Returns the next recorded clock sample. Raises EOFError when the
+        recording is exhausted.
+        '''
+        for line in self._file:
+            record = json.loads(line)
+            if record[0] == SessionRecorder.RECORD_WEATHER:
+                self._weather.append((record[1], record[2]))
+            elif record[0] == SessionRecorder.RECORD_CLOCK:
+                self._wall_time = record[1]
+                self._clock_samples += 1
+                return record[2]
+        raise EOFError("End of session recording {}".format(self._path))
+    
+    def pop_weather(self):
+        '''
+        Returns the most recent conditions recorded at or before the current
+        wall time or None if no new conditions arrived since the last call.
+        '''
+        conditions = None
+        while len(self._weather) > 0 and self._weather[0][0] <= self._wall_time:
+            conditions = self._weather.popleft()[1]
+        return conditions
+    
+    def has_weather(self):
+        return len(self._weather) > 0 and self._weather[0][0] <= self._wall_time
+    
+    def close(self):
+        self._file.close()
@@ -22,32 +22,89 @@
 #                                                     |___/     |___/
 #
 import argparse
+import json
+import math
+import os
+import signal
+import threading
 import time
 
 import ephem
+import numpy as np
 
-from clocks import HyperClock, WallClock
-from curve_plot import plot_curve, make_curve
+from clocks import FrameScheduler, HyperClock, ReplayClock, WallClock, monotonic
+from color_temperature import DaylightColorModel, sun_altitudes
+from control import ControlServer
+from curve_plot import DEFAULT_CURVE_LEVELS, DaylightChart, make_curve
+from diagnostics import DiagnosticLog, debug_log
+from frames import FrameFile
+from instrumentation import StageMetrics, seconds_since_process_start, stage_metrics
 from lcd_cape import LCDCape
 from lights import RectangularPixelMatrix
+from profiling import LoopProfiler
 import opc
-from weather import WeatherUnderground
+from pipeline import FramePipeline
+from session import RecordingClock, SessionRecorder
+from weather import WeatherProvider, create_replay_weather, create_weather_provider
 
 
 __app_name__ = "skylight"
 __standard_datetime_format_for_debug__ = "%Y/%m/%d %I:%M:%S %p"
 
+# +----------------------------------------------------------------------------+
+# | STATE
+# +----------------------------------------------------------------------------+
+class SkyState(object):
+    '''
+    What the sky was showing when it last saved (the daylight times and the
+    weather colour) so the first frame after a restart can be drawn without
+    solving the ephemeris or waiting for the weather.
+    '''
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        parser.add_argument('--state-file', default="~/.skylight_state.json", help="File the sky saves its state to so restarts can show light right away. Set to an empty string to disable.")
+        parser.add_argument('--state-interval', default=60.0, type=float, help="Seconds between saves of --state-file.")
+    
+    def __init__(self, args):
+        self._path = os.path.expanduser(args.state_file) if args.state_file else None
+        self._interval = args.state_interval
+        self._saved_at = time.time()
+        self.values = dict()
+        if self._path is not None and os.path.isfile(self._path):
+            try:
+                with open(self._path, 'r') as state_file:
+                    self.values = json.load(state_file)
+            except (IOError, ValueError) as e:
+                print "Ignoring unreadable sky state {}: {}".format(self._path, str(e))
+    
+    def is_due(self):
+        return self._path is not None and time.time() - self._saved_at > self._interval
+    
+    def save(self):
+        if self._path is None:
+            return
+        self._saved_at = time.time()
+        temp_path = self._path + ".tmp"
+        try:
+            with open(temp_path, 'w') as state_file:
+                json.dump(self.values, state_file)
+            os.rename(temp_path, self._path)
+        except (IOError, OSError) as e:
+            print "Unable to write sky state {}: {}".format(self._path, str(e))
+
 # +----------------------------------------------------------------------------+
 # | SKYS
 # +----------------------------------------------------------------------------+
 class Daylight(object):
     
-    def __init__(self, twilight, dawn, dusk, dark, xy):
+    def __init__(self, twilight, dawn, dusk, dark, xy, altitudes=None):
         self._twilight = twilight
         self._dawn = dawn
         self._dusk = dusk
         self._dark = dark
         self._xy = xy
+        self._altitudes = altitudes
     
     @property
     def twilight(self):
@@ -73,6 +130,14 @@ class Daylight(object):
     def day_curve(self):
         return self._xy
     
+    @property
+    def altitudes(self):
+        '''
+        The sun's altitude through the day (see color_temperature.sun_altitudes)
+        if it was solved along with the day, otherwise None.
+        '''
+        return self._altitudes
+    
     def progress(self, now):
         if self.is_daylight(now):
             return (now - self._twilight) / (self._dark - self._twilight)
@@ -94,24 +159,180 @@ class Daylight(object):
         else:
             return "night"
 
+def solve_daylight(observer, sun, twilight, next_dark, curve_levels=DEFAULT_CURVE_LEVELS, with_altitudes=False):
+    '''
+    Build the Daylight for the day ending at next_dark: when the sun rose
+    through the twilight horizon that morning, dawn, dusk and the daylight
+    curve. Leaves observer.horizon at 0.
+    '''
+    observer.horizon = twilight
+    morning_twilight = observer.previous_rising(sun, start=next_dark)
+    
+    observer.horizon = '0'
+    dawn = observer.next_rising(sun, start=morning_twilight)
+    dusk = observer.next_setting(sun, start=morning_twilight)
+    xy = make_curve(float(morning_twilight), float(dawn), float(dusk), float(next_dark), curve_levels)
+    altitudes = sun_altitudes(observer, sun, morning_twilight, next_dark) if with_altitudes else None
+    return Daylight(morning_twilight, dawn, dusk, next_dark, xy, altitudes)
+
+
+class DaylightPrefetcher(object):
+    '''
+    Solves upcoming days on a background thread so the sky doesn't stall on
+    the ephemeris when the simulated clock rolls over into a new day. Days
+    are solved back to back from the last time the sky asked for one, as many
+    as the clock will get through in LOOKAHEAD_SECONDS of real time (at least
+    one, at most max_days). Anything affecting the solution (pressure,
+    temperature, the twilight horizon or the curve) has to be passed to
+    reset() which throws away what was solved with the old values.
+    '''
+    
+    PREFETCH_AUTO = "auto"
+    PREFETCH_ON = "on"
+    PREFETCH_OFF = "off"
+    
+    # Real seconds of simulated time to keep solved ahead of the clock.
+    LOOKAHEAD_SECONDS = 2.0
+    
+    # Chained days start this long after the previous dark so the next
+    # solve doesn't find the same sunset again.
+    ONE_SECOND = 1.0 / (60 * 60 * 24)
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        parser.add_argument('--ephemeris-prefetch', default=cls.PREFETCH_AUTO, choices=(cls.PREFETCH_AUTO, cls.PREFETCH_ON, cls.PREFETCH_OFF), help="Solve upcoming days in the background. auto does so when the clock runs faster than real time.")
+        parser.add_argument('--prefetch-days', default=8, type=int, help="Most days the ephemeris prefetch keeps solved ahead of the clock.")
+    
+    def __init__(self, city, rate, max_days=8, with_altitudes=False):
+        self._observer = ephem.city(city)
+        self._sun = ephem.Sun()  # @UndefinedVariable
+        self._target_days = min(max_days, max(1, int(math.ceil((rate or 1.0) * self.LOOKAHEAD_SECONDS / (60 * 60 * 24))) + 1))
+        self._with_altitudes = with_altitudes
+        self._condition = threading.Condition()
+        # (start, Daylight) in order. Each day is the one that ends at the
+        # first dark after its start.
+        self._days = []
+        self._wanted = None
+        self._generation = 0
+        self._settings = None
+        self._stopped = False
+        self._thread = threading.Thread(group=None, target=self._prefetch_routine, name="ephemeris")
+        self._thread.daemon = True
+    
+    def start(self, observer, twilight, curve_levels):
+        self.reset(observer, twilight, curve_levels)
+        self._thread.start()
+    
+    def stop(self, timeout=2.0):
+        '''
+        Stop prefetching and wait (up to timeout seconds) for a solve in
+        progress to finish so it doesn't outlive the interpreter.
+        '''
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+    
+    def reset(self, observer, twilight, curve_levels):
+        with self._condition:
+            self._generation += 1
+            self._settings = (observer.pressure, observer.temp, twilight, curve_levels)
+            del self._days[:]
+    
+    def get(self, now):
+        '''
+        The Daylight for the day ending at the first dark after now if it has
+        been solved, otherwise None. Either way prefetching carries on from
+        now.
+        '''
+        with self._condition:
+            self._wanted = now
+            while len(self._days) > 0 and self._days[0][1].dark < now:
+                self._days.pop(0)
+            if len(self._days) > 0 and self._days[0][0] > now:
+                # The clock went backwards.
+                del self._days[:]
+            self._condition.notify()
+            return self._days[0][1] if len(self._days) > 0 else None
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _prefetch_routine(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (self._wanted is None or len(self._days) >= self._target_days):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                start = self._days[-1][1].dark + self.ONE_SECOND if len(self._days) > 0 else self._wanted
+                generation = self._generation
+                pressure, temp, twilight, curve_levels = self._settings
+            
+            try:
+                self._observer.pressure = pressure
+                self._observer.temp = temp
+                self._observer.horizon = twilight
+                next_dark = self._observer.next_setting(self._sun, start=start)
+                if self._stopped:
+                    return
+                daylight = solve_daylight(self._observer, self._sun, twilight, next_dark, curve_levels, self._with_altitudes)
+            except Exception as e:
+                # The sky solves days itself whenever there's nothing here.
+                debug_log.emit("Ephemeris prefetch stopped: {}", str(e))
+                return
+            
+            with self._condition:
+                if self._stopped:
+                    return
+                if generation == self._generation:
+                    self._days.append((ephem.date(start), daylight))
+
+
 class WeatherSky(object):
     '''
     Pixel controller that represents the sky according to the time of day and
     weather conditions reported by an external weather service.
     '''
     
+    WEATHER_COLORS = { WeatherProvider.WEATHER_CLASS_SUNNY     : (255,255,255),
+                       # TODO: strobe or other animation for "alert, bad weather!"
+                       WeatherProvider.WEATHER_CLASS_EMERGENCY : (255,0,0),
+                       # TODO: something more festive for snow.
+                       WeatherProvider.WEATHER_CLASS_SNOWING   : (0,255,0),
+                       WeatherProvider.WEATHER_CLASS_CLOUDY    : (0,0,255) }
+    
+    # How long before a forecast change in conditions we start blending
+    # towards the colour for the new conditions.
+    WEATHER_TRANSITION_SECONDS = 20 * 60
+    
     def __init__(self, args, wallclock, weather_service):
         self._twilight = "-7"
+        self._curve_levels = DEFAULT_CURVE_LEVELS
         self._clock = wallclock
         self._city = args.city
         self._weather = weather_service
         self._observer = None
         self._sun = ephem.Sun()  # @UndefinedVariable
         self._verbose = args.verbose
-        self._show_daylight_chart = args.show_daylight_chart
-        self._weather_timer = None
+        self._chart = DaylightChart() if args.show_daylight_chart else None
+        self._color_model = DaylightColorModel() \
+            if getattr(args, 'daylight_color', None) == DaylightColorModel.COLOR_TEMPERATURE else None
+        self._altitudes = None
+        self._altitudes_dark = None
+        self._altitude = None
+        self._prefetcher = None
+        # When the weather service kept its last response on disk we can pick
+        # up the metering where the previous run left off instead of
+        # spending an API call on every restart.
+        self._weather_timer = weather_service.get_last_update_time() \
+            if weather_service is not None else None
         self._current_daylight = None
+        self._daylight_is_stale = False
         self._pixel_color = (255,255,255)
+        self._weather_color = self._pixel_color
+        self._weather_description = None
         self._last_clock_time = self._clock.now()
         
         self._update_period_seconds =  (3600 * 24) / weather_service.get_max_updates_per_day() \
@@ -128,6 +349,15 @@ class WeatherSky(object):
         except Exception as e:
             print str(e)
             print "pyephem is not working correctly."
+        
+        prefetch = getattr(args, 'ephemeris_prefetch', DaylightPrefetcher.PREFETCH_OFF)
+        rate = self._clock.get_rate()
+        if self._observer is not None and (prefetch == DaylightPrefetcher.PREFETCH_ON or \
+                (prefetch == DaylightPrefetcher.PREFETCH_AUTO and rate is not None and rate > 1)):
+            self._prefetcher = DaylightPrefetcher(self._city, rate, args.prefetch_days, self._color_model is not None)
+            self._prefetcher.start(self._observer, self._twilight, self._curve_levels)
+            if self._verbose:
+                print "Prefetching up to {} days of ephemeris".format(args.prefetch_days)
     
     # +------------------------------------------------------------------------+
     # | PYTHON DATAMODEL
@@ -136,13 +366,34 @@ class WeatherSky(object):
     def __call__(self, panel):
         now = self._clock.now()
         
+        self._update_weather()
+        self._render_sky(panel, now)
+        
+        self._last_clock_time = now
+        
+        self._draw_debug()
+    
+    def close(self):
+        '''
+        Shut down the daylight chart and the ephemeris prefetcher, if running.
+        '''
+        if self._chart is not None:
+            self._chart.close()
+            self._chart = None
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+
+    # +------------------------------------------------------------------------+
+    # | WEATHER
+    # +------------------------------------------------------------------------+
+    def _update_weather(self):
         if self._weather is not None:
             # We have to ensure we are always using wall-clock time for the
             # weather update since this API is metered.
-            actually_now_seconds = time.time()
+            actually_now_seconds = self._clock.wall_time()
             if self._weather_timer is None or actually_now_seconds - self._weather_timer > self._update_period_seconds:
                 if self._verbose:
-                    print "About to request new weather (The next request will be in {:.2f} minutes)".format(self._update_period_seconds / 60.00)
+                    debug_log.emit("About to request new weather (The next request will be in {:.2f} minutes)", self._update_period_seconds / 60.00)
                 # once per period send a request for new weather conditions
                 self._weather.start_weather_update()
                 self._weather_timer = actually_now_seconds
@@ -150,43 +401,76 @@ class WeatherSky(object):
             if self._weather.has_new_weather():
                 self._observer.pressure = self._weather.get_pressure_mb(self._observer.pressure)
                 self._observer.temp = self._weather.get_temperature_c(self._observer.temp)
-                if self._weather.is_sunny:
-                    self._pixel_color = (255,255,255)
-                elif self._weather.is_emergency:
-                    # TODO: strobe or other animation for "alert, bad weather!"
-                    self._pixel_color = (255,0,0)
-                elif self._weather.is_snowing:
-                    # TODO: something more festive for snow.
-                    self._pixel_color = (0,255,0)
-                else:
-                    self._pixel_color = (0,0,255)
+                self._weather_description = self._weather.get_current_weather()
+                self._weather_color = self._color_for(self._weather_description)
                 
-                self._current_daylight = None
+                # Pressure and temperature move twilight a little. Re-solve
+                # after this frame rather than holding this one up.
+                self._daylight_is_stale = True
                 if self._verbose:
-                    print "Updating weather" 
-        
-        self._update_ephemeris(now)
-        
-        intensities = self._current_daylight.intensities
+                    debug_log.emit("Updating weather")
+            
+            self._pixel_color = self._blend_upcoming_weather(self._weather_color, self._color_for)
+    
+    def _color_for(self, weather):
+        return self.WEATHER_COLORS[self._weather.classify(weather)]
+    
+    def _blend_upcoming_weather(self, color, color_for):
+        upcoming = self._weather.get_upcoming_weather()
+        if upcoming is None or upcoming[1] > self.WEATHER_TRANSITION_SECONDS:
+            return color
+        next_color = color_for(upcoming[0])
+        t = 1.0 - (max(0, upcoming[1]) / float(self.WEATHER_TRANSITION_SECONDS))
+        return tuple(int(a + (b - a) * t) for a, b in zip(color, next_color))
 
-        progress = self._current_daylight.progress(now)
-        
-        if self._current_daylight.is_daylight(now):
+    # +------------------------------------------------------------------------+
+    # | LIGHTS
+    # +------------------------------------------------------------------------+
+    def _render_sky(self, panel, now):
+        if self._daylight_is_stale:
+            # New weather was shown on the last frame with the old daylight.
+            # Re-solve for this one.
+            self._current_daylight = None
+            self._daylight_is_stale = False
+            self._reset_prefetch()
         
-            intensity_index = int(len(intensities) * progress)
-            self._render_daylight(panel, intensities[intensity_index if intensity_index < len(intensities) else len(intensities) - 1])
-        else:
-            self._render_night(panel, progress)
+        with stage_metrics.timer("ephemeris"):
+            self._update_ephemeris(now)
         
-        self._last_clock_time = now
+        with stage_metrics.timer("curve"):
+            intensities = self._current_daylight.intensities
+    
+            progress = self._current_daylight.progress(now)
+            
+            is_daylight = self._current_daylight.is_daylight(now)
+            if is_daylight:
+                intensity_index = int(len(intensities) * progress)
+                intensity = intensities[intensity_index if intensity_index < len(intensities) else len(intensities) - 1]
+                if self._color_model is not None:
+                    altitudes = self._altitudes_for(self._current_daylight)
+                    self._altitude = altitudes[min(int(round(progress * (len(altitudes) - 1))), len(altitudes) - 1)]
         
-        self._draw_debug()
+        # includes scaling, encoding and sending the frame.
+        with stage_metrics.timer("render"):
+            if is_daylight:
+                self._render_daylight(panel, intensity)
+            else:
+                self._render_night(panel, progress)
 
-    # +------------------------------------------------------------------------+
-    # | LIGHTS
-    # +------------------------------------------------------------------------+
+    def _weather_class(self, weather):
+        if self._weather is None or weather is None:
+            return WeatherProvider.WEATHER_CLASS_SUNNY
+        return self._weather.classify(weather)
+    
     def _weather_correct_sky_pixel(self):
-        return self._pixel_color
+        if self._color_model is None or self._altitude is None:
+            return self._pixel_color
+        def color_at(weather):
+            return self._color_model.color(self._weather_class(weather), self._altitude)
+        color = color_at(self._weather_description)
+        if self._weather is None:
+            return color
+        return self._blend_upcoming_weather(color, color_at)
 
     def _render_night(self, panel, progress):  # @UnusedVariable
         # FUTURE: Render moon phase on a clear night
@@ -195,25 +479,162 @@ class WeatherSky(object):
     def _render_daylight(self, panel, intensity):
         panel.fill(tuple(x * (intensity if intensity <= 1.0 else 1.0) for x in self._weather_correct_sky_pixel()))
     
+    # +------------------------------------------------------------------------+
+    # | FRAME RATE
+    # +------------------------------------------------------------------------+
+    def get_frame_interval(self, min_interval, max_interval):
+        '''
+        How long the sky can go before it next needs to be drawn. Uses the slope
+        of the daylight curve at the last rendered time to estimate how long
+        until the output changes by one step (of 255) and clamps that to the
+        given interval range. With the colour temperature model the colour
+        changes with the sun's altitude too and that rate is added to the
+        curve's. Returns min_interval whenever the sky is
+        animating something else (i.e. blending between weather colours) or
+        when the rate of the clock isn't known.
+        '''
+        rate = self._clock.get_rate()
+        if rate is None or self._current_daylight is None or self._pixel_color != self._weather_color:
+            return min_interval
+        
+        now = self._last_clock_time
+        daylight = self._current_daylight
+        if not daylight.is_daylight(now):
+            # Black until twilight.
+            seconds_to_change = (daylight.twilight - now) * 60 * 60 * 24
+        else:
+            intensities = daylight.intensities
+            progress = daylight.progress(now)
+            index = int(len(intensities) * progress)
+            if index + 1 >= len(intensities):
+                return min_interval
+            day_seconds = (daylight.dark - daylight.twilight) * 60 * 60 * 24
+            color = self._pixel_color
+            steps_per_second = 0.0
+            if self._color_model is not None:
+                altitudes = self._altitudes_for(daylight)
+                altitude_index = min(int(round(progress * (len(altitudes) - 1))), len(altitudes) - 2)
+                weather_class = self._weather_class(self._weather_description)
+                color = self._color_model.color(weather_class, altitudes[altitude_index])
+                next_color = self._color_model.color(weather_class, altitudes[altitude_index + 1])
+                color_step = max(abs(b - a) for a, b in zip(color, next_color)) * min(intensities[index], 1.0)
+                steps_per_second += color_step / (day_seconds / (len(altitudes) - 1))
+            step = abs(min(intensities[index + 1], 1.0) - min(intensities[index], 1.0)) * max(color)
+            steps_per_second += step / (day_seconds / len(intensities))
+            if steps_per_second == 0:
+                return max_interval
+            seconds_to_change = 1.0 / steps_per_second
+        return min(max_interval, max(min_interval, seconds_to_change / rate))
+    
     # +------------------------------------------------------------------------+
     # | EPHEMERIS
     # +------------------------------------------------------------------------+
     def _update_ephemeris(self, now):
         
+        if self._current_daylight is not None and self._current_daylight.is_daylight(now):
+            # Still inside the current day so the next dark can't have moved.
+            return
+        
+        if self._prefetcher is not None:
+            daylight = self._prefetcher.get(now)
+            if daylight is not None:
+                if self._verbose and daylight is not self._current_daylight:
+                    debug_log.emit("It's a new day ({} - {}, prefetched)", daylight.twilight, daylight.dark)
+                self._current_daylight = daylight
+                return
+        
         self._observer.horizon = self._twilight
         next_dark = self._observer.next_setting(self._sun, start=now)
         
         if self._current_daylight is None or int(next_dark) != int(self._current_daylight.dark):
-            
-            twilight = self._observer.previous_rising(self._sun, start=next_dark)
-            
-            self._observer.horizon = '0'
-            dawn = self._observer.next_rising(self._sun, start=twilight)
-            dusk = self._observer.next_setting(self._sun, start=twilight)
-            xy = make_curve(float(twilight), float(dawn), float(dusk), float(next_dark))
+            daylight = solve_daylight(self._observer, self._sun, self._twilight, next_dark, self._curve_levels)
             if self._verbose:
-                print "It's a new day ({} - {})".format(twilight, next_dark)
-            self._current_daylight = Daylight(twilight, dawn, dusk, next_dark, xy)            
+                debug_log.emit("It's a new day ({} - {})", daylight.twilight, next_dark)
+            self._current_daylight = daylight
+    
+    def _reset_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetcher.reset(self._observer, self._twilight, self._curve_levels)
+    
+    def _altitudes_for(self, daylight):
+        '''
+        The sun's altitude through the given day, solved once a day for the
+        colour model.
+        '''
+        if daylight.altitudes is not None:
+            return daylight.altitudes
+        if self._altitudes is None or self._altitudes_dark != float(daylight.dark):
+            self._altitudes = sun_altitudes(self._observer, self._sun, daylight.twilight, daylight.dark)
+            self._altitudes_dark = float(daylight.dark)
+        return self._altitudes
+    
+    # +------------------------------------------------------------------------+
+    # | CONFIGURATION
+    # +------------------------------------------------------------------------+
+    @property
+    def twilight(self):
+        return self._twilight
+    
+    @twilight.setter
+    def twilight(self, twilight):
+        '''
+        Horizon (in degrees, as a string pyephem understands) the sun has to
+        reach before the light starts to come up. Changing it moves twilight
+        and dark so the ephemeris is solved again on the next frame.
+        '''
+        ephem.degrees(twilight)
+        self._twilight = twilight
+        self._current_daylight = None
+        self._reset_prefetch()
+    
+    @property
+    def curve_levels(self):
+        return self._curve_levels
+    
+    @curve_levels.setter
+    def curve_levels(self, levels):
+        '''
+        Change the daylight curve's control point levels (see
+        curve_plot.make_curve). The day's times don't change so only the
+        curve is rebuilt.
+        '''
+        if len(levels) != len(DEFAULT_CURVE_LEVELS):
+            raise ValueError("curve needs {} levels".format(len(DEFAULT_CURVE_LEVELS)))
+        self._curve_levels = tuple(float(level) for level in levels)
+        daylight = self._current_daylight
+        if daylight is not None:
+            xy = make_curve(float(daylight.twilight), float(daylight.dawn), float(daylight.dusk), float(daylight.dark), self._curve_levels)
+            self._current_daylight = Daylight(daylight.twilight, daylight.dawn, daylight.dusk, daylight.dark, xy, daylight.altitudes)
+        self._reset_prefetch()
+    
+    # +------------------------------------------------------------------------+
+    # | STATE
+    # +------------------------------------------------------------------------+
+    def save_state(self, state):
+        state.values['city'] = self._city
+        state.values['weather_color'] = list(self._weather_color)
+        state.values['weather'] = self._weather_description
+        if self._current_daylight is not None:
+            daylight = self._current_daylight
+            state.values['daylight'] = [float(daylight.twilight), float(daylight.dawn), float(daylight.dusk), float(daylight.dark)]
+        state.save()
+    
+    def restore_state(self, state):
+        '''
+        Pick up the daylight and weather colour from a previous run. The
+        weather service and ephemeris replace them as soon as they have
+        something newer.
+        '''
+        if state.values.get('city') != self._city:
+            return
+        if 'weather_color' in state.values:
+            self._weather_color = tuple(state.values['weather_color'])
+            self._pixel_color = self._weather_color
+            self._weather_description = state.values.get('weather')
+        if 'daylight' in state.values:
+            twilight, dawn, dusk, dark = state.values['daylight']
+            xy = make_curve(twilight, dawn, dusk, dark, self._curve_levels)
+            self._current_daylight = Daylight(ephem.date(twilight), ephem.date(dawn), ephem.date(dusk), ephem.date(dark), xy)
     
     # +------------------------------------------------------------------------+
     # | DEBUG/UTILITY
@@ -221,46 +642,187 @@ class WeatherSky(object):
     def get_sky_time(self, time_format):
         return ephem.localtime(ephem.date(self._last_clock_time)).strftime(time_format)
     
+    # The LCD cape's thread calls these while the render loop may be replacing
+    # the daylight, so read it once.
     def get_sky_phase(self):
-        if None == self._current_daylight:
+        daylight = self._current_daylight
+        if None == daylight:
             return "(none)"
         else:
-            return self._current_daylight.get_phase_for(self._last_clock_time)
+            return daylight.get_phase_for(self._last_clock_time)
     
     def get_sky_progress(self):
-        if None == self._current_daylight:
-            return "(none)"
+        daylight = self._current_daylight
+        if None == daylight:
+            return 0.0
         else:
-            return self._current_daylight.progress(self._last_clock_time)
+            return daylight.progress(self._last_clock_time)
 
     def get_sky_weather(self):
+        # Reports what the sky last applied rather than asking the weather
+        # service, which would consume its new-data flag (and may be called
+        # from the LCD cape's thread).
         if self._weather is not None:
-            return self._weather.get_current_weather()
+            return self._weather_description
         else:
             return "(no data)"
         
     def _draw_debug(self):
         if self._verbose:
-            rhs =  "[{phase}] {progress:.0%}".format(phase=self.get_sky_phase(),
-                                  progress=self.get_sky_progress())
-            center = "weather: {}".format(self.get_sky_weather())
-            lhs = "{city}: {now:50}".format(city=self._city, 
-                                  now=self.get_sky_time(__standard_datetime_format_for_debug__))
-            print "{} | {} | {}".format(lhs, center, rhs)
-        if self._show_daylight_chart:
-            plot_curve(self._current_daylight.day_curve, self._current_daylight.dawn, self._current_daylight.dusk)
-            self._show_daylight_chart = False
+            # Formatted on the log's thread, not here.
+            debug_log.emit("{city}: {now:" + __standard_datetime_format_for_debug__ + "} | weather: {weather} | [{phase}] {progress:.0%}",
+                           city=self._city,
+                           now=ephem.localtime(ephem.date(self._last_clock_time)),
+                           weather=self.get_sky_weather(),
+                           phase=self.get_sky_phase(),
+                           progress=self.get_sky_progress())
+        if self._chart is not None and self._current_daylight is not None:
+            daylight = self._current_daylight
+            now = self._last_clock_time
+            if daylight.is_daylight(now):
+                intensities = daylight.intensities
+                intensity = intensities[min(int(len(intensities) * daylight.progress(now)), len(intensities) - 1)]
+            else:
+                intensity = 0
+            self._chart.update(daylight.day_curve, daylight.dawn, daylight.dusk, now, intensity, self._pixel_color)
+
+class PlaybackSky(WeatherSky):
+    '''
+    WeatherSky that streams frames pre-rendered by batch_render.py (see its
+    --library option) instead of computing them. Each frame is a lookup into a
+    memory-mapped file for the current day. Live weather and the panel's
+    brightness are applied through a per-channel lookup table which is only
+    rebuilt when either changes. Falls back to rendering live when there are no frames for today.
+    '''
+    
+    @classmethod
+    def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
+        playback_args = parser.add_argument_group('playback options')
+        playback_args.add_argument('--playback', default=None, metavar="DIR", help="Play frames pre-rendered into this frame library by batch_render.py instead of computing them.")
+        playback_args.add_argument('--profile', default="default", help="Render profile to play back from the frame library.")
+    
+    def __init__(self, args, wallclock, weather_service):
+        self._library = args.playback
+        self._profile = args.profile
+        self._frame_file = None
+        self._frame_index = None
+        self._missing_day = None
+        self._lut_scale = None
+        self._lut = None
+        self._lut_channels = np.arange(3)
+        super(PlaybackSky, self).__init__(args, wallclock, weather_service)
+    
+    # +------------------------------------------------------------------------+
+    # | LIGHTS
+    # +------------------------------------------------------------------------+
+    def _render_sky(self, panel, now):
+        frame_file = self._frame_file_for(now, panel.pixel_count)
+        self._frame_index = frame_file.index_at(now) if frame_file is not None else None
+        if self._frame_index is None:
+            super(PlaybackSky, self)._render_sky(panel, now)
+            return
+        
+        with stage_metrics.timer("render"):
+            frame = frame_file.frames[self._frame_index]
+            # The colour model can only be baked in by batch_render.py so
+            # live weather is always applied with the classic colours.
+            # put_frame doesn't apply brightness so it goes into the table
+            # too, which keeps --brightness and control changes working.
+            # Frames rendered at less than full brightness are scaled back
+            # up first so it isn't applied twice.
+            brightness = float(panel.brightness) / frame_file.brightness
+            scale = tuple(c * brightness for c in self._pixel_color)
+            if scale != (255,255,255):
+                if scale != self._lut_scale:
+                    self._lut = np.array([np.minimum((np.arange(256) * s) // 255, 255) for s in scale], dtype=np.uint8)
+                    self._lut_scale = scale
+                frame = self._lut[self._lut_channels, frame]
+            panel.put_frame(frame)
+    
+    # +------------------------------------------------------------------------+
+    # | FRAME RATE
+    # +------------------------------------------------------------------------+
+    def get_frame_interval(self, min_interval, max_interval):
+        if self._frame_index is None:
+            return super(PlaybackSky, self).get_frame_interval(min_interval, max_interval)
+        rate = self._clock.get_rate()
+        if rate is None or self._pixel_color != self._weather_color:
+            return min_interval
+        # Pre-rendered frames only change on the file's time grid.
+        next_frame = self._frame_file.time_of(self._frame_index + 1)
+        seconds_to_change = (next_frame - self._last_clock_time) * 60 * 60 * 24
+        return min(max_interval, max(min_interval, seconds_to_change / rate))
+    
+    # +------------------------------------------------------------------------+
+    # | FRAMES
+    # +------------------------------------------------------------------------+
+    def _frame_file_for(self, now, pixel_count):
+        if self._frame_file is not None and self._frame_file.start <= now < self._frame_file.end:
+            return self._frame_file
+        
+        day = FrameFile.day_start(now)
+        if day == self._missing_day:
+            return None
+        if self._frame_file is not None:
+            self._frame_file.close()
+            self._frame_file = None
+        
+        path = FrameFile.library_path(self._library, self._city, day, self._profile)
+        try:
+            frame_file = FrameFile(path)
+            if frame_file.pixel_count != pixel_count:
+                message = "rendered for {} pixels, not {}".format(frame_file.pixel_count, pixel_count)
+                frame_file.close()
+                raise ValueError(message)
+            self._frame_file = frame_file
+            self._missing_day = None
+            if self._verbose:
+                debug_log.emit("Playing frames from {}", path)
+        except (IOError, ValueError) as e:
+            debug_log.emit("No pre-rendered frames for {} ({}). Rendering live.", ephem.date(day), str(e))
+            self._missing_day = day
+        return self._frame_file
+    
+    # +------------------------------------------------------------------------+
+    # | DEBUG/UTILITY
+    # +------------------------------------------------------------------------+
+    def get_sky_phase(self):
+        if self._frame_index is None:
+            return super(PlaybackSky, self).get_sky_phase()
+        return "playback"
+    
+    def get_sky_progress(self):
+        if self._frame_index is None:
+            return super(PlaybackSky, self).get_sky_progress()
+        return self._frame_index / float(len(self._frame_file.frames))
+    
+    def _draw_debug(self):
+        if self._frame_index is None:
+            super(PlaybackSky, self)._draw_debug()
+        elif self._verbose:
+            debug_log.emit("{}: {:" + __standard_datetime_format_for_debug__ + "} | weather: {} | frame {}",
+                           self._city, 
+                           ephem.localtime(ephem.date(self._last_clock_time)),
+                           self.get_sky_weather(),
+                           self._frame_index)
 
 # +---------------------------------------------------------------------------+
 # | MAIN
 # +---------------------------------------------------------------------------+
 
+def _interrupt_on_sigterm(signum, frame):  # @UnusedVariable
+    # systemd and docker stop with SIGTERM. Shut down as for ctrl-c so the
+    # state is saved, the panel blanked and a recording closed properly.
+    raise KeyboardInterrupt()
+
 def main():
     parser = argparse.ArgumentParser(
             prog=__app_name__, 
             description="Open Pixel Controller client providing contextual lighting effects.")
     
     parser.add_argument("--frame-rate", default=1, type=int, help="Frames-per-second to run the sky simulation at.")
+    parser.add_argument("--adaptive-frame-rate", action='store_true', help="Treat --frame-rate as a maximum and only render as often as the light is actually changing.")
+    parser.add_argument("--idle-frame-rate", default=0.2, type=float, help="Lowest frames-per-second used with --adaptive-frame-rate.")
     
     subparsers = parser.add_subparsers(dest="command", help="Clock Modes")
     
@@ -269,61 +831,143 @@ def main():
     
     debug_args = parser.add_argument_group('debug options')
     debug_args.add_argument('--verbose','-v', action='store_true', help="Spew debug stuff.")
-    debug_args.add_argument('--show-daylight-chart', '-D', action='store_true', help="Open a window showing a plot of the daylight curve in-use.")
+    debug_args.add_argument('--show-daylight-chart', '-D', action='store_true', help="Open a window showing a live plot of the daylight curve in-use.")
     debug_args.add_argument('--opc-dont-connect', '-X', action='store_true', help="Skip trying to connect to an OPC server. Allows testing other parts of the skylight without actually running the LEDs.")
     
+    FrameScheduler.on_visit_argparse(parser, subparsers)
     RectangularPixelMatrix.on_visit_argparse(parser, subparsers)
     HyperClock.on_visit_argparse(parser, subparsers)
     WallClock.on_visit_argparse(parser, subparsers)
+    ReplayClock.on_visit_argparse(parser, subparsers)
+    SessionRecorder.on_visit_argparse(parser, subparsers)
+    PlaybackSky.on_visit_argparse(parser, subparsers)
+    StageMetrics.on_visit_argparse(parser, subparsers)
+    SkyState.on_visit_argparse(parser, subparsers)
+    LoopProfiler.on_visit_argparse(parser, subparsers)
     opc.Client.on_visit_argparse(parser, subparsers)
+    FramePipeline.on_visit_argparse(parser, subparsers)
+    ControlServer.on_visit_argparse(parser, subparsers)
     LCDCape.on_visit_argparse(parser, subparsers)
+    DaylightColorModel.on_visit_argparse(parser, subparsers)
+    DaylightPrefetcher.on_visit_argparse(parser, subparsers)
+    DiagnosticLog.on_visit_argparse(parser, subparsers)
         
-    WeatherUnderground.on_visit_argparse(parser, subparsers)
+    WeatherProvider.on_visit_argparse(parser, subparsers)
     
     args = parser.parse_args()
-    opc_client = opc.Client(args)
+    debug_log.configure(args)
+    if args.pipeline:
+        opc_client = FramePipeline(args)
+    else:
+        opc_client = opc.Client(args)
     
-    if not args.opc_dont_connect:
-        dots = ''
-        while(not opc_client.can_connect()):
-            print 'Waiting for OPC server {}{:8}'.format(opc_client._port, dots)
-            dots = dots + '.' if len(dots) < 8 else '.'
-            time.sleep(1)
+    if not args.opc_dont_connect and not args.pipeline:
+        # Don't hold up the first frame waiting for fcserver. It gets sent as
+        # soon as the connection comes up.
+        print 'Waiting for OPC server {}'.format(opc_client._port)
+        opc_client.connect_in_background()
     
+    recorder = None
+    control = None
+    panel0 = None
     try:
-        print 'connected to OPC server on {}'.format(opc_client._port)
-        
         panel0 = RectangularPixelMatrix(args, opc_client)
         
         clock = args.func(args)
         
+        if isinstance(clock, ReplayClock) and clock.session.city not in (None, args.city):
+            print "{} was recorded in {}. Replay it with --city \"{}\".".format(args.session, clock.session.city, clock.session.city)
+            return
+        
         try:
-            weather = WeatherUnderground(args)
+            if isinstance(clock, ReplayClock):
+                weather = create_replay_weather(args, clock.session)
+            else:
+                weather = create_weather_provider(args)
         except ValueError:
             print "Unable to obtain weather information. Check commandline arguments."
             weather = None
         
-        sky = WeatherSky(args, 
-                         clock, 
-                         weather)
+        if args.record is not None:
+            recorder = SessionRecorder(args.record, args.city, weather.PROVIDER if weather is not None else None)
+            clock = RecordingClock(clock, recorder)
+            if weather is not None:
+                weather.set_recorder(recorder)
+        
+        sky_type = PlaybackSky if args.playback is not None else WeatherSky
+        sky = sky_type(args, 
+                       clock, 
+                       weather)
+        state = SkyState(args)
+        sky.restore_state(state)
         
         cape = LCDCape(args, sky)
+        control = ControlServer(args, panel0, sky, weather)
+        control.start()
         
         fps = args.frame_rate
+        paced = not getattr(args, "unpaced", False)
         if args.verbose:
-            print "Running the simulation at {} frame(s) per second".format(fps)
+            if paced:
+                print "Running the simulation at {} frame(s) per second".format(fps)
+            else:
+                print "Running the simulation as fast as possible"
+        scheduler = FrameScheduler(args)
+        stage_metrics.start_export(args)
+        profiler = LoopProfiler(args)
+        profiler.start()
+        frames = 0
+        sky_seconds = 0.0
+        signal.signal(signal.SIGTERM, _interrupt_on_sigterm)
         try:
             while(1):
-                start = time.time()
+                scheduler.wait()
+                control.apply_pending()
+                start = monotonic()
                 sky(panel0)
+                frame_seconds = monotonic() - start
+                stage_metrics.record("frame", frame_seconds)
+                sky_seconds += frame_seconds
+                frames += 1
+                if frames == 1:
+                    time_to_first_frame = seconds_since_process_start()
+                    stage_metrics.record("time_to_first_frame", time_to_first_frame)
+                    if args.verbose:
+                        print "First frame after {:.3f} seconds".format(time_to_first_frame)
+                if state.is_due():
+                    sky.save_state(state)
                 cape()
-                delay_for = (1.0 / float(fps)) - (time.time() - start)
-                time.sleep(delay_for if delay_for > 0 else 1)
+                if args.adaptive_frame_rate:
+                    scheduler.period = sky.get_frame_interval(1.0 / fps, 1.0 / args.idle_frame_rate)
+                if profiler.frame_done():
+                    break
         except KeyboardInterrupt:
+            sky.save_state(state)
+        except EOFError:
+            # end of a replayed session.
+            print "Replayed {} frames in {:.3f} seconds ({:.1f} frames per second)".format(
+                frames, sky_seconds, (frames / sky_seconds) if sky_seconds > 0 else 0)
+        finally:
+            # However the loop ended (including a finished profile).
+            profiler.stop()
+            cape.stop()
+            sky.close()
             panel0.black()
+        if args.verbose:
+            print "Frame timing: {}".format(scheduler.format_statistics())
+            if args.pipeline:
+                print "Pipeline: {}".format(opc_client.format_statistics())
             
     finally:
+        if control is not None:
+            control.stop()
+        stage_metrics.stop_export()
+        if recorder is not None:
+            recorder.close()
+        if panel0 is not None:
+            panel0.close()
         opc_client.disconnect()
+        debug_log.stop()
 
 if __name__ == "__main__":
     main()
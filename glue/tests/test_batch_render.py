@@ -0,0 +1,74 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_render
+from frames import FrameFile
+
+
+class RenderTest(unittest.TestCase):
+    
+    # Sunrise to sunset in Seattle so most frames differ.
+    START_UTC = "2017/6/21 12:00:00"
+    
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+    
+    def _render(self, name, jobs, chunk_frames=None):
+        args = argparse.Namespace(city="Seattle", start=self.START_UTC, step=15 * 60, frames=40,
+                                  output=os.path.join(self._directory, name), jobs=jobs,
+                                  chunk_frames=chunk_frames, weather="Clear", verbose=False,
+                                  show_daylight_chart=False, wukey=None, weather_cache=None,
+                                  daylight_color="classic", opc_debug=False, channel=0, stride=8,
+                                  pixel_count=32, brightness=1.0)
+        frames, _ = batch_render.render(args)
+        self.assertEqual(frames, args.frames)
+        frame_file = FrameFile(args.output)
+        try:
+            return np.array(frame_file.frames)
+        finally:
+            frame_file.close()
+    
+    def test_parallel_chunks_match_a_single_job(self):
+        serial = self._render("serial.npy", 1)
+        self.assertEqual(serial.shape, (40, 32, 3))
+        self.assertGreater(len(np.unique(serial.sum(axis=(1, 2)))), 1)
+        np.testing.assert_array_equal(self._render("parallel.npy", 3), serial)
+        # A chunk size that doesn't divide the frame count leaves a short
+        # last chunk.
+        np.testing.assert_array_equal(self._render("uneven.npy", 2, chunk_frames=7), serial)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clocks
+from clocks import FrameScheduler, SteppedClock
+
+
+class _SteppedTime(object):
+    '''
+    Stands in for the monotonic clock and time.sleep with a SteppedClock so
+    the scheduler runs on simulated time.
+    '''
+    
+    STEP_SECONDS = 0.001
+    
+    def __init__(self):
+        self._clock = SteppedClock("1970/1/1", self.STEP_SECONDS)
+    
+    def monotonic(self):
+        return self._clock.wall_time()
+    
+    def sleep(self, seconds):
+        self._clock.index += max(1, int(round(seconds / self.STEP_SECONDS)))
+    
+    def advance(self, seconds):
+        self._clock.index += int(round(seconds / self.STEP_SECONDS))
+
+
+class FrameSchedulerTest(unittest.TestCase):
+    
+    # A couple of clock steps of slack for the float maths.
+    DELTA = 0.0025
+    
+    def setUp(self):
+        self._time = _SteppedTime()
+        self._monotonic = clocks.monotonic
+        self._sleep = clocks.time.sleep
+        clocks.monotonic = self._time.monotonic
+        clocks.time.sleep = self._time.sleep
+    
+    def tearDown(self):
+        clocks.monotonic = self._monotonic
+        clocks.time.sleep = self._sleep
+    
+    def _scheduler(self, policy, max_catch_up=5):
+        return FrameScheduler(argparse.Namespace(frame_rate=10, overrun_policy=policy, max_catch_up=max_catch_up))
+    
+    def _run(self, scheduler, frame_seconds):
+        '''
+        Runs one frame per entry in frame_seconds and returns the time and
+        lateness of each.
+        '''
+        frames = []
+        for seconds in frame_seconds:
+            lateness = scheduler.wait()
+            frames.append((self._time.monotonic(), lateness))
+            self._time.advance(seconds)
+        return frames
+    
+    def assertFrames(self, frames, expected):
+        self.assertEqual(len(frames), len(expected))
+        for (at, lateness), (expected_at, expected_lateness) in zip(frames, expected):
+            self.assertAlmostEqual(at, expected_at, delta=self.DELTA)
+            self.assertAlmostEqual(lateness, expected_lateness, delta=self.DELTA)
+    
+    def test_on_time(self):
+        scheduler = self._scheduler(FrameScheduler.POLICY_SKIP)
+        self.assertFrames(self._run(scheduler, [0.02, 0.02, 0.02]),
+                          [(0.0, 0.0), (0.1, 0.0), (0.2, 0.0)])
+        statistics = scheduler.get_statistics()
+        self.assertEqual(statistics['frames'], 3)
+        self.assertEqual(statistics['skipped'], 0)
+        self.assertAlmostEqual(statistics['jitter'], 0.0, delta=self.DELTA)
+    
+    def test_skip_drops_missed_deadlines(self):
+        scheduler = self._scheduler(FrameScheduler.POLICY_SKIP)
+        # The second frame is due at 0.1 but the first runs until 0.25, which
+        # also misses the deadline at 0.2.
+        self.assertFrames(self._run(scheduler, [0.25, 0.02, 0.02]),
+                          [(0.0, 0.0), (0.25, 0.15), (0.3, 0.0)])
+        self.assertEqual(scheduler.get_statistics()['skipped'], 1)
+    
+    def test_catch_up_runs_missed_frames_late(self):
+        scheduler = self._scheduler(FrameScheduler.POLICY_CATCH_UP)
+        self.assertFrames(self._run(scheduler, [0.25, 0.02, 0.02, 0.02]),
+                          [(0.0, 0.0), (0.25, 0.15), (0.27, 0.07), (0.3, 0.0)])
+        self.assertEqual(scheduler.get_statistics()['skipped'], 0)
+    
+    def test_catch_up_resynchronises_when_too_far_behind(self):
+        scheduler = self._scheduler(FrameScheduler.POLICY_CATCH_UP, max_catch_up=2)
+        # Finishing at 0.55 misses the deadlines at 0.2 - 0.5.
+        self.assertFrames(self._run(scheduler, [0.55, 0.02, 0.02]),
+                          [(0.0, 0.0), (0.55, 0.45), (0.6, 0.0)])
+        self.assertEqual(scheduler.get_statistics()['skipped'], 4)
+    
+    def test_lateness_and_jitter(self):
+        scheduler = self._scheduler(FrameScheduler.POLICY_SKIP)
+        self._run(scheduler, [0.25, 0.02, 0.02])
+        statistics = scheduler.get_statistics()
+        # Lateness 0, 0.15 and 0. Intervals of 0.25 and 0.05 are 0.15 and
+        # -0.05 off the period: a mean of 0.05 and a deviation of 0.1.
+        self.assertAlmostEqual(statistics['lateness_mean'], 0.05, delta=self.DELTA)
+        self.assertAlmostEqual(statistics['lateness_max'], 0.15, delta=self.DELTA)
+        self.assertAlmostEqual(statistics['jitter'], 0.1, delta=self.DELTA)
+        scheduler.reset_statistics()
+        self.assertEqual(scheduler.get_statistics()['frames'], 0)
+
+
+class SteppedClockTest(unittest.TestCase):
+    
+    def test_index_steps_simulated_time(self):
+        clock = SteppedClock("2017/6/21 12:00:00", 90)
+        self.assertEqual(clock.now(), clock.time_at(0))
+        clock.index = 40
+        self.assertEqual(str(clock.now()), "2017/6/21 13:00:00")
+        self.assertEqual(str(clock.time_at(960)), "2017/6/22 12:00:00")
+    
+    def test_wall_time_follows_the_index(self):
+        clock = SteppedClock("1970/1/1", 0.5)
+        clock.index = 7
+        self.assertAlmostEqual(clock.wall_time(), 3.5, places=3)
+        self.assertIsNone(clock.get_rate())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from control import ControlServer
+from weather import WeatherUnderground, WeatherUndergroundForecast
+
+
+class _Panel(object):
+    brightness = 1.0
+    channel = 0
+
+
+class _Sky(object):
+    twilight = "-6"
+    curve_levels = (0.01, 1.8, 0.3, 1.8, 0.01)
+    
+    def get_sky_weather(self):
+        return None
+
+
+def _args(**overrides):
+    values = dict(city="Seattle", verbose=False, wukey=None, weather="Clear",
+                  weather_cache="", control_port=None)
+    values.update(overrides)
+    return argparse.Namespace(**values)
+
+
+class ControlServerTest(unittest.TestCase):
+    
+    def _server(self, weather):
+        return ControlServer(_args(), _Panel(), _Sky(), weather)
+    
+    def test_fake_weather_is_queued(self):
+        server = self._server(WeatherUnderground(_args()))
+        server.submit({'weather': "Rain"})
+        self.assertTrue(server.apply_pending())
+    
+    def test_fake_weather_rejected_by_forecast_provider(self):
+        server = self._server(WeatherUndergroundForecast(_args(wukey="key", weather=None)))
+        self.assertRaises(ValueError, server.submit, {'weather': "Rain"})
+        self.assertFalse(server.apply_pending())
+    
+    def test_real_weather_needs_a_key(self):
+        server = self._server(WeatherUnderground(_args()))
+        self.assertRaises(ValueError, server.submit, {'weather': None})
+
+    
+    def test_bools_are_not_numbers(self):
+        server = self._server(None)
+        self.assertRaises(ValueError, server.submit, {'brightness': True})
+        self.assertRaises(ValueError, server.submit, {'channel': False})
+        self.assertRaises(ValueError, server.submit, {'twilight': True})
+        self.assertRaises(ValueError, server.submit, {'curve': [0.01, 1.8, True, 1.8, 0.01]})
+        self.assertFalse(server.apply_pending())
+        server.submit({'brightness': 1, 'channel': 2, 'twilight': -6, 'curve': [0.01, 1.8, 0.3, 1.8, 0]})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import os
+import shutil
+import signal
+import StringIO
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diagnostics import DiagnosticLog
+
+
+class DiagnosticLogTest(unittest.TestCase):
+    
+    def setUp(self):
+        self._stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+    
+    def tearDown(self):
+        sys.stdout = self._stdout
+    
+    def _printed(self, log):
+        log.stop()
+        return sys.stdout.getvalue().splitlines()
+    
+    def test_rate_limit_is_per_format(self):
+        log = DiagnosticLog(rate_limit=20.0)
+        for i in range(3):
+            log.emit("tick {}", i)
+        log.emit("tock")
+        # Wait out the rate limit so the next tick is printed.
+        time.sleep(0.1)
+        log.emit("tick {}", 3)
+        self.assertEqual(self._printed(log), ["tick 0", "tock", "tick 3 (2 similar skipped)"])
+    
+    def test_no_rate_limit_prints_everything(self):
+        log = DiagnosticLog()
+        for i in range(3):
+            log.emit("tick {}", i)
+        self.assertEqual(self._printed(log), ["tick 0", "tick 1", "tick 2"])
+    
+    def test_buffer_keeps_the_latest_lines(self):
+        log = DiagnosticLog(buffer_size=3, rate_limit=1.0)
+        for i in range(5):
+            log.emit("tick {}", i)
+        log.stop()
+        # Lines are kept whether or not the rate limit printed them.
+        lines = log.get_lines()
+        self.assertEqual([line.split(" ", 1)[1] for line in lines], ["tick 2", "tick 3", "tick 4"])
+        dumped = StringIO.StringIO()
+        log.dump(dumped)
+        self.assertEqual(dumped.getvalue().splitlines(), lines)
+    
+    def test_dump_on_sigusr1(self):
+        directory = tempfile.mkdtemp()
+        handler = signal.getsignal(signal.SIGUSR1)
+        try:
+            path = os.path.join(directory, "dump.log")
+            log = DiagnosticLog()
+            log.configure(argparse.Namespace(log_rate=0, log_buffer=2, log_dump=path))
+            for i in range(3):
+                log.emit("tick {}", i)
+            log.stop()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            with open(path, 'r') as dump_file:
+                self.assertEqual([line.split(" ", 1)[1] for line in dump_file.read().splitlines()], ["tick 1", "tick 2"])
+        finally:
+            signal.signal(signal.SIGUSR1, handler)
+            shutil.rmtree(directory)
+    
+    def test_unformattable_message_is_kept(self):
+        log = DiagnosticLog()
+        log.emit("missing {}")
+        log.emit("missing {} {}", 1)
+        self.assertEqual(self._printed(log), ["missing {}", "missing {} {} (unable to format: tuple index out of range)"])
+
+
+if __name__ == "__main__":
+    unittest.main()
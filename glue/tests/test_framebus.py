@@ -0,0 +1,144 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from framebus import FrameBusReader, FrameBusWriter
+from lights import RectangularPixelMatrix
+
+
+class FrameBusTest(unittest.TestCase):
+    
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, "bus")
+        self._writer = FrameBusWriter(self._path, pixel_count=4, slot_count=2)
+        self._reader = FrameBusReader(self._path)
+    
+    def tearDown(self):
+        self._reader.close()
+        self._writer.close()
+        shutil.rmtree(self._directory)
+    
+    def _frame(self, value):
+        return np.full((4, 3), value, dtype=np.uint8)
+    
+    def test_nothing_published(self):
+        self.assertIsNone(self._reader.read())
+    
+    def test_read_latest(self):
+        self._writer.publish(self._frame(1))
+        sequence = self._writer.publish(self._frame(2))
+        read_sequence, timestamp, frame = self._reader.read()
+        self.assertEqual(read_sequence, sequence)
+        self.assertGreater(timestamp, 0)
+        self.assertTrue((frame == 2).all())
+        self.assertTrue((self._reader.read(sequence - 1)[2] == 1).all())
+    
+    def test_lapped_reader_gets_nothing(self):
+        first = self._writer.publish(self._frame(1))
+        self._writer.publish(self._frame(2))
+        self._writer.publish(self._frame(3))
+        # Two slots, so the third frame reused the first one's.
+        self.assertIsNone(self._reader.read(first))
+    
+    def test_view_reports_when_overwritten(self):
+        sequence = self._writer.publish(self._frame(1))
+        _, _, frame = self._reader.read(sequence, copy=False)
+        self.assertTrue(self._reader.is_intact(sequence))
+        self._writer.publish(self._frame(2))
+        self._writer.publish(self._frame(3))
+        self.assertFalse(self._reader.is_intact(sequence))
+    
+    def test_reader_sees_the_bus_replaced(self):
+        self.assertFalse(self._reader.is_replaced())
+        FrameBusWriter(self._path, pixel_count=8, slot_count=2)
+        self.assertTrue(self._reader.is_replaced())
+        self.assertEqual(FrameBusReader(self._path).pixel_count, 8)
+    
+    def test_reader_sees_the_bus_removed(self):
+        self._writer.close()
+        self.assertTrue(self._reader.is_replaced())
+
+    def test_short_frame_clears_the_rest_of_the_slot(self):
+        self._writer.publish(self._frame(1))
+        self._writer.publish(self._frame(2))
+        sequence = self._writer.publish(np.full((2, 3), 3, dtype=np.uint8))
+        _, _, frame = self._reader.read(sequence)
+        self.assertTrue((frame[:2] == 3).all())
+        self.assertTrue((frame[2:] == 0).all())
+    
+    def test_long_frame_is_truncated(self):
+        sequence = self._writer.publish(np.full((6, 3), 4, dtype=np.uint8))
+        _, _, frame = self._reader.read(sequence)
+        self.assertEqual(frame.shape, (4, 3))
+        self.assertTrue((frame == 4).all())
+    
+    def test_close_removes_the_bus(self):
+        self._writer.close()
+        self.assertFalse(os.path.exists(self._path))
+
+
+class _ScalingClient(object):
+    
+    SCALES_BRIGHTNESS = True
+    
+    def __init__(self):
+        self.brightness = None
+    
+    def put_pixels(self, pixels, channel=0, brightness=1.0):  # @UnusedVariable
+        self.brightness = brightness
+        return True
+
+
+class PanelFrameBusTest(unittest.TestCase):
+    
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        args = argparse.Namespace(channel=0, stride=2, pixel_count=4, brightness=0.5,
+                                  frame_bus=os.path.join(self._directory, "bus"), frame_bus_slots=2)
+        self._client = _ScalingClient()
+        self._panel = RectangularPixelMatrix(args, self._client)
+        self._reader = FrameBusReader(args.frame_bus)
+    
+    def tearDown(self):
+        self._reader.close()
+        self._panel.close()
+        shutil.rmtree(self._directory)
+    
+    def test_bus_shows_brightness_the_client_applies(self):
+        self._panel.pixels = np.full((4, 3), 200, dtype=np.uint8)
+        self.assertEqual(self._client.brightness, 0.5)
+        self.assertTrue((self._reader.read()[2] == 100).all())
+        self._panel.pixels = np.full((4, 3), 100, dtype=np.uint8)
+        self.assertTrue((self._reader.read()[2] == 50).all())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from instrumentation import StageMetrics, _RollingWindow
+
+
+class RollingWindowTest(unittest.TestCase):
+    
+    def test_empty_window_has_no_summary(self):
+        self.assertIsNone(_RollingWindow(4).summary())
+    
+    def test_quantiles_of_a_partial_window(self):
+        window = _RollingWindow(200)
+        for seconds in range(100, 0, -1):
+            window.add(seconds / 1000.0)
+        summary = window.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['sum'], 5.05)
+        self.assertEqual(summary['p50'], 0.050)
+        self.assertEqual(summary['p99'], 0.099)
+        self.assertEqual(summary['max'], 0.100)
+    
+    def test_quantiles_only_cover_recent_samples(self):
+        window = _RollingWindow(3)
+        for seconds in [9.0, 1.0, 2.0, 3.0]:
+            window.add(seconds)
+        summary = window.summary()
+        # The totals keep every sample but the slow first one has rolled out.
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['sum'], 15.0)
+        self.assertEqual(summary['p50'], 2.0)
+        self.assertEqual(summary['max'], 3.0)
+        self.assertEqual(window.latest, 3.0)
+
+
+class StageMetricsTest(unittest.TestCase):
+    
+    def test_disabled_metrics_record_nothing(self):
+        metrics = StageMetrics()
+        with metrics.timer("send"):
+            pass
+        metrics.record("send", 1.0)
+        self.assertIs(metrics.timer("send"), StageMetrics.NULL_TIMER)
+        self.assertEqual(metrics.snapshot(), {})
+        self.assertIsNone(metrics.latest("send"))
+    
+    def test_format_prometheus(self):
+        metrics = StageMetrics(window_size=8)
+        metrics.enable()
+        metrics.record("send", 0.25)
+        metrics.record("encode", 0.5)
+        metrics.record("encode", 1.5)
+        self.assertEqual(metrics.latest("encode"), (2, 1.5))
+        self.assertEqual(metrics.format_prometheus(), "\n".join([
+            '# HELP skylight_stage_seconds Time spent in each stage of a skylight frame.',
+            '# TYPE skylight_stage_seconds summary',
+            'skylight_stage_seconds{stage="encode",quantile="0.5"} 0.500000000',
+            'skylight_stage_seconds{stage="encode",quantile="0.99"} 0.500000000',
+            'skylight_stage_seconds_sum{stage="encode"} 2.000000000',
+            'skylight_stage_seconds_count{stage="encode"} 2',
+            'skylight_stage_seconds{stage="send",quantile="0.5"} 0.250000000',
+            'skylight_stage_seconds{stage="send",quantile="0.99"} 0.250000000',
+            'skylight_stage_seconds_sum{stage="send"} 0.250000000',
+            'skylight_stage_seconds_count{stage="send"} 1',
+            '# HELP skylight_stage_seconds_max Slowest recent sample of each stage of a skylight frame.',
+            '# TYPE skylight_stage_seconds_max gauge',
+            'skylight_stage_seconds_max{stage="encode"} 1.500000000',
+            'skylight_stage_seconds_max{stage="send"} 0.250000000',
+            '']))
+    
+    def test_timer_records_the_block(self):
+        metrics = StageMetrics()
+        metrics.enable()
+        with metrics.timer("render"):
+            pass
+        with metrics.timer("render"):
+            pass
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["render"]['count'], 2)
+        self.assertGreaterEqual(snapshot["render"]['p50'], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
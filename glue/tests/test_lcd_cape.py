@@ -0,0 +1,182 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import errno
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lcd_cape import LCDCape, NetworkInfo, lcd_columns
+
+
+class _Netlink(object):
+    '''
+    Stands in for the netlink socket. Hands out the queued messages then
+    raises like a non-blocking socket with nothing to read.
+    '''
+    
+    def __init__(self, messages=(), error=errno.EAGAIN):
+        self.messages = list(messages)
+        self.error = error
+        self.closed = False
+    
+    def recv(self, size):  # @UnusedVariable
+        if len(self.messages) > 0:
+            return self.messages.pop(0)
+        raise socket.error(self.error, os.strerror(self.error))
+    
+    def close(self):
+        self.closed = True
+
+
+class _CountingNetworkInfo(NetworkInfo):
+    '''
+    Counts the queries that get past the cache and answers them with canned
+    values.
+    '''
+    
+    def __init__(self, netlink, max_age_seconds=60):
+        self.queries = []
+        self.netlink = netlink
+        super(_CountingNetworkInfo, self).__init__(max_age_seconds)
+    
+    def _open_netlink(self):
+        return self.netlink
+    
+    def _query_interface_address(self, interface):
+        self.queries.append(("address", interface))
+        return "10.0.0.{}".format(len(self.queries))
+    
+    def _query_ssid(self, interface):
+        self.queries.append(("ssid", interface))
+        return "skylight"
+
+
+class _LCD(object):
+    '''
+    Records what the cape does to the display.
+    '''
+    
+    def __init__(self):
+        self.calls = []
+    
+    def clear(self):
+        self.calls.append(("clear",))
+    
+    def set_cursor(self, column, row):
+        self.calls.append(("set_cursor", column, row))
+    
+    def write8(self, value, char_mode=False):  # @UnusedVariable
+        self.calls.append(("write8", chr(value)))
+
+
+class LCDCapeTest(unittest.TestCase):
+    
+    def setUp(self):
+        self._lcd = _LCD()
+        self._cape = LCDCape(argparse.Namespace(interface="eth0", verbose=False))
+        self._cape._lcd = self._lcd
+    
+    def _written(self):
+        return "".join(call[1] for call in self._lcd.calls if call[0] == "write8")
+    
+    def _cursors(self):
+        return [call[1:] for call in self._lcd.calls if call[0] == "set_cursor"]
+    
+    def test_first_write_clears_the_display(self):
+        self._cape._write("hello\nworld")
+        self.assertEqual(self._lcd.calls[0], ("clear",))
+        self.assertEqual(self._cursors(), [(0, 0), (0, 1)])
+        self.assertEqual(self._written(), "helloworld")
+        del self._lcd.calls[:]
+        self._cape._write("jello\nworld")
+        self.assertNotIn(("clear",), self._lcd.calls)
+    
+    def test_unchanged_text_writes_nothing(self):
+        self._cape._write("hello\nworld")
+        del self._lcd.calls[:]
+        self._cape._write("hello\nworld")
+        self.assertEqual(self._lcd.calls, [])
+    
+    def test_only_changed_runs_are_written(self):
+        self._cape._write("12:00 PM\nday")
+        del self._lcd.calls[:]
+        self._cape._write("12:05 AM\nday")
+        self.assertEqual(self._cursors(), [(4, 0), (6, 0)])
+        self.assertEqual(self._written(), "5A")
+    
+    def test_shorter_text_blanks_the_rest(self):
+        self._cape._write("x" * lcd_columns)
+        del self._lcd.calls[:]
+        self._cape._write("x")
+        self.assertEqual(self._cursors(), [(1, 0)])
+        self.assertEqual(self._written(), " " * (lcd_columns - 1))
+
+
+class NetworkInfoTest(unittest.TestCase):
+    
+    def test_answers_are_cached(self):
+        info = _CountingNetworkInfo(_Netlink())
+        self.assertEqual(info.interface_address("eth0"), "10.0.0.1")
+        self.assertEqual(info.interface_address("eth0"), "10.0.0.1")
+        self.assertEqual(info.ssid("wlan0"), "skylight")
+        self.assertEqual(info.ssid("wlan0"), "skylight")
+        self.assertEqual(info.queries, [("address", "eth0"), ("ssid", "wlan0")])
+    
+    def test_netlink_message_invalidates(self):
+        netlink = _Netlink()
+        info = _CountingNetworkInfo(netlink)
+        info.interface_address("eth0")
+        info.ssid("wlan0")
+        netlink.messages.append(b"link changed")
+        self.assertEqual(info.interface_address("eth0"), "10.0.0.3")
+        self.assertEqual(info.ssid("wlan0"), "skylight")
+        self.assertEqual(len(info.queries), 4)
+    
+    def test_netlink_overrun_reopens_and_invalidates(self):
+        netlink = _Netlink(error=errno.ENOBUFS)
+        info = _CountingNetworkInfo(netlink)
+        info.netlink = _Netlink()
+        self.assertEqual(info.interface_address("eth0"), "10.0.0.1")
+        self.assertTrue(netlink.closed)
+        self.assertEqual(info.interface_address("eth0"), "10.0.0.1")
+    
+    def test_expires_without_netlink(self):
+        info = _CountingNetworkInfo(None, max_age_seconds=60)
+        info.interface_address("eth0")
+        info.interface_address("eth0")
+        self.assertEqual(len(info.queries), 1)
+        info._cached_at -= 61
+        self.assertEqual(info.interface_address("eth0"), "10.0.0.2")
+    
+    def test_queries_loopback(self):
+        info = NetworkInfo()
+        self.assertEqual(info.interface_address("lo"), "127.0.0.1")
+        # The loopback interface has no wireless extensions.
+        self.assertEqual(info.ssid("lo"), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import opc
+
+
+class _ClosingServer(object):
+    '''
+    Accepts one connection and resets it straight away.
+    '''
+    
+    def __init__(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(1)
+        self.port = self._listener.getsockname()[1]
+        self.closed = threading.Event()
+        self._thread = threading.Thread(target=self._routine)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def _routine(self):
+        connection, _ = self._listener.accept()
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        connection.close()
+        self._listener.close()
+        self.closed.set()
+
+
+class _SlowSetupClient(opc.Client):
+    '''
+    Holds off the FadeCandy setup until the server has dropped the
+    connection so the setup is what finds out it's gone.
+    '''
+    
+    def __init__(self, args, server):
+        super(_SlowSetupClient, self).__init__(args)
+        self._server = server
+    
+    def _on_connected(self):
+        self._server.closed.wait(5)
+        time.sleep(0.1)
+        super(_SlowSetupClient, self)._on_connected()
+
+
+def _client_args(port):
+    return argparse.Namespace(address="127.0.0.1", port=port, opc_debug=False,
+                              fadecandy_setup=True, fadecandy_gamma=2.5,
+                              fadecandy_whitepoint=[1.0, 1.0, 1.0],
+                              fadecandy_no_dither=False, fadecandy_no_interpolate=False)
+
+
+class ClientTest(unittest.TestCase):
+    
+    def test_put_pixels_when_setup_loses_connection(self):
+        server = _ClosingServer()
+        client = _SlowSetupClient(_client_args(server.port), server)
+        
+        self.assertFalse(client.put_pixels([(255, 0, 0)] * 8))
+        self.assertIsNone(client._socket)
+        client.disconnect()
+
+
+if __name__ == "__main__":
+    unittest.main()
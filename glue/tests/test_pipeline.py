@@ -0,0 +1,70 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import FramePipeline
+
+
+def _args(pixel_count):
+    return argparse.Namespace(address="127.0.0.1", port=1, opc_debug=False, opc_dont_connect=True,
+                              fadecandy_setup=False, pixel_count=pixel_count,
+                              pipeline_slots=1, pipeline_drop=False)
+
+
+class FramePipelineTest(unittest.TestCase):
+    
+    def setUp(self):
+        self._pipeline = FramePipeline(_args(8))
+    
+    def tearDown(self):
+        self._pipeline.disconnect()
+    
+    def test_short_frame_does_not_resend_old_pixels(self):
+        self._pipeline.put_pixels(np.full((8, 3), 255, dtype=np.uint8))
+        self._pipeline.put_pixels(np.full((3, 3), 10, dtype=np.uint8))
+        frame = self._pipeline._frames[0]
+        self.assertTrue((frame[:3] == 10).all())
+        self.assertTrue((frame[3:] == 0).all())
+    
+    def test_long_frame_is_truncated(self):
+        self.assertTrue(self._pipeline.put_pixels(np.full((12, 3), 7, dtype=np.uint8)))
+        self.assertTrue((self._pipeline._frames[0] == 7).all())
+    
+    def test_brightness_is_left_to_the_transmitter(self):
+        self._pipeline.put_pixels(np.full((8, 3), 200, dtype=np.uint8), channel=3, brightness=0.5)
+        self.assertTrue((self._pipeline._frames[0] == 200).all())
+        self.assertEqual(tuple(self._pipeline._meta[0]), (3, 0.5))
+    
+    def test_float_frame_is_clamped(self):
+        self._pipeline.put_pixels(np.full((8, 3), 300.0))
+        self.assertTrue((self._pipeline._frames[0] == 255).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from framebus import FrameBusWriter
+from preview import PreviewSource, encode_png, format_terminal
+
+
+class EncodePngTest(unittest.TestCase):
+    
+    def _chunks(self, png):
+        self.assertEqual(png[:8], b'\x89PNG\r\n\x1a\n')
+        chunks = []
+        offset = 8
+        while offset < len(png):
+            length, = struct.unpack('>I', png[offset:offset + 4])
+            tag = png[offset + 4:offset + 8]
+            data = png[offset + 8:offset + 8 + length]
+            crc, = struct.unpack('>I', png[offset + 8 + length:offset + 12 + length])
+            self.assertEqual(crc, zlib.crc32(tag + data) & 0xffffffff)
+            chunks.append((tag, data))
+            offset += 12 + length
+        return chunks
+    
+    def test_rows_are_unfiltered_rgb(self):
+        image = np.arange(2 * 3 * 3, dtype=np.uint8).reshape((2, 3, 3))
+        chunks = self._chunks(encode_png(image))
+        self.assertEqual([tag for tag, _ in chunks], [b'IHDR', b'IDAT', b'IEND'])
+        self.assertEqual(struct.unpack('>IIBBBBB', chunks[0][1]), (3, 2, 8, 2, 0, 0, 0))
+        self.assertEqual(zlib.decompress(chunks[1][1]),
+                         b'\x00' + image[0].tostring() + b'\x00' + image[1].tostring())
+
+
+class FormatTerminalTest(unittest.TestCase):
+    
+    def test_two_rows_per_line(self):
+        image = np.array([[[1, 2, 3], [4, 5, 6]],
+                          [[7, 8, 9], [10, 11, 12]],
+                          [[13, 14, 15], [16, 17, 18]]], dtype=np.uint8)
+        block = u'\u2580'.encode('utf-8')
+        self.assertEqual(format_terminal(image),
+                         "\x1b[H" +
+                         "\x1b[38;2;1;2;3m\x1b[48;2;7;8;9m" + block +
+                         "\x1b[38;2;4;5;6m\x1b[48;2;10;11;12m" + block + "\x1b[0m\n" +
+                         # An odd last row goes over black.
+                         "\x1b[38;2;13;14;15m\x1b[48;2;0;0;0m" + block +
+                         "\x1b[38;2;16;17;18m\x1b[48;2;0;0;0m" + block + "\x1b[0m\n")
+
+
+class PreviewSourceTest(unittest.TestCase):
+    
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, "bus")
+        self._writer = FrameBusWriter(self._path, pixel_count=4, slot_count=8)
+    
+    def tearDown(self):
+        self._writer.close()
+        shutil.rmtree(self._directory)
+    
+    def _publish(self, value, pixel_count=4):
+        return self._writer.publish(np.full((pixel_count, 3), value, dtype=np.uint8))
+    
+    def _source(self):
+        return PreviewSource(self._path, stride=2, max_fps=1000.0, timeout=0.01)
+    
+    def test_starts_at_the_newest_frame(self):
+        for value in range(5):
+            self._publish(value)
+        source = self._source()
+        image = source.next_frame()
+        self.assertEqual(image.shape, (2, 2, 3))
+        self.assertTrue((image == 4).all())
+        self.assertEqual(source.dropped, 0)
+    
+    def test_counts_frames_published_in_between(self):
+        source = self._source()
+        self._publish(1)
+        self.assertTrue((source.next_frame() == 1).all())
+        for value in range(2, 6):
+            self._publish(value)
+        self.assertTrue((source.next_frame() == 5).all())
+        self.assertEqual(source.dropped, 3)
+    
+    def test_follows_a_restarted_writer(self):
+        source = self._source()
+        self._publish(1)
+        source.next_frame()
+        self._writer.close()
+        self._writer = FrameBusWriter(self._path, pixel_count=8, slot_count=8)
+        self._publish(3, pixel_count=8)
+        image = source.next_frame()
+        self.assertEqual(image.shape, (4, 2, 3))
+        self.assertTrue((image == 3).all())
+        self.assertEqual(source.dropped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
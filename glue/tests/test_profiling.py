@@ -0,0 +1,87 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clocks import monotonic
+from profiling import LoopProfiler
+
+
+def _args(mode, frames=None, seconds=None, output=None):
+    return argparse.Namespace(profile_loop=mode, profile_frames=frames, profile_seconds=seconds,
+                              profile_output=output, profile_interval=1.0, profile_then="exit")
+
+
+def _busy(seconds):
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        pass
+
+
+class LoopProfilerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._output = os.path.join(self._directory, "profile")
+    
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+    
+    def test_disabled_never_ends_the_loop(self):
+        profiler = LoopProfiler(_args(None, frames=1))
+        profiler.start()
+        self.assertFalse(profiler.is_running)
+        self.assertFalse(profiler.frame_done())
+    
+    def test_frame_window(self):
+        profiler = LoopProfiler(_args(LoopProfiler.MODE_DETERMINISTIC, frames=3, output=self._output))
+        profiler.start()
+        self.assertEqual([profiler.frame_done() for _ in range(3)], [False, False, True])
+        self.assertFalse(profiler.is_running)
+        self.assertTrue(os.path.isfile(self._output))
+    
+    def test_seconds_window(self):
+        profiler = LoopProfiler(_args(LoopProfiler.MODE_DETERMINISTIC, seconds=10.0, output=self._output))
+        profiler.start()
+        self.assertFalse(profiler.frame_done())
+        profiler._started_at -= 11.0
+        self.assertTrue(profiler.frame_done())
+    
+    def test_sampling_records_the_main_thread(self):
+        profiler = LoopProfiler(_args(LoopProfiler.MODE_SAMPLING, frames=1, output=self._output))
+        profiler.start()
+        _busy(0.2)
+        profiler.frame_done()
+        with open(self._output, 'r') as folded_file:
+            lines = folded_file.read().splitlines()
+        self.assertGreater(sum(int(line.rsplit(" ", 1)[1]) for line in lines), 0)
+        self.assertTrue(any("_busy:test_profiling.py" in line for line in lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,261 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import ephem
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clocks import HyperClock
+from curve_plot import DEFAULT_CURVE_LEVELS
+from frames import FrameFile
+from lights import RectangularPixelMatrix
+from skylight import DaylightPrefetcher, PlaybackSky, SkyState, WeatherSky, solve_daylight
+
+
+class _NullClient(object):
+    
+    def __init__(self):
+        self.pixels = None
+    
+    def put_pixels(self, pixels, channel=0):  # @UnusedVariable
+        self.pixels = pixels
+        return True
+
+
+def _args(daylight_color, now_utc):
+    return argparse.Namespace(city="Seattle", verbose=False, show_daylight_chart=False, opc_debug=False,
+                              address="127.0.0.1", port=7890, channel=0, stride=32, pixel_count=512,
+                              brightness=0.8, now_utc=now_utc, multiplier=1, wukey=None, weather="Clear",
+                              weather_cache=None, daylight_color=daylight_color)
+
+
+class FrameIntervalTest(unittest.TestCase):
+    
+    def _frame_interval(self, daylight_color, now_utc):
+        args = _args(daylight_color, now_utc)
+        sky = WeatherSky(args, HyperClock(args), None)
+        sky(RectangularPixelMatrix(args, _NullClient()))
+        return sky.get_frame_interval(0.01, 60.0)
+    
+    def test_colour_temperature_shortens_interval_after_sunrise(self):
+        # Shortly after sunrise the curve is flat but the colour temperature
+        # is still warming up quickly.
+        now = "2017/6/21 13:00:00"
+        self.assertEqual(self._frame_interval("classic", now), 60.0)
+        self.assertLess(self._frame_interval("temperature", now), 60.0)
+
+
+class SkyStateTest(unittest.TestCase):
+    
+    NOW_UTC = "2017/6/21 20:00:00"
+    
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._args = _args("classic", self.NOW_UTC)
+        self._args.state_file = os.path.join(self._directory, "state.json")
+        self._args.state_interval = 60.0
+    
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+    
+    def _saved_sky(self):
+        sky = WeatherSky(self._args, HyperClock(self._args), None)
+        sky(RectangularPixelMatrix(self._args, _NullClient()))
+        sky.save_state(SkyState(self._args))
+        return sky
+    
+    def test_round_trip(self):
+        self._saved_sky()
+        state = SkyState(self._args)
+        self.assertEqual(state.values['city'], "Seattle")
+        self.assertEqual(len(state.values['daylight']), 4)
+        restored = WeatherSky(self._args, HyperClock(self._args), None)
+        restored.restore_state(state)
+        # Saving the restored sky, before it renders anything, writes the
+        # same state back.
+        resaved = SkyState(argparse.Namespace(state_file=os.path.join(self._directory, "resaved.json"),
+                                              state_interval=60.0))
+        restored.save_state(resaved)
+        self.assertEqual(resaved.values['daylight'], state.values['daylight'])
+        self.assertEqual(resaved.values['weather_color'], state.values['weather_color'])
+        self.assertEqual(resaved.values['weather'], state.values['weather'])
+    
+    def test_state_for_another_city_is_ignored(self):
+        self._saved_sky()
+        self._args.city = "London"
+        state = SkyState(self._args)
+        sky = WeatherSky(self._args, HyperClock(self._args), None)
+        sky.restore_state(state)
+        self.assertEqual(sky.get_sky_phase(), "(none)")
+    
+    def test_unreadable_state_is_ignored(self):
+        with open(self._args.state_file, 'w') as state_file:
+            state_file.write("{not json")
+        self.assertEqual(SkyState(self._args).values, {})
+    
+    def test_empty_path_disables_saving(self):
+        self._args.state_file = ""
+        self._args.state_interval = 0.0
+        state = SkyState(self._args)
+        self.assertFalse(state.is_due())
+        state.values['city'] = "Seattle"
+        state.save()
+        self.assertEqual(os.listdir(self._directory), [])
+
+class PlaybackSkyTest(unittest.TestCase):
+    
+    NOW_UTC = "2017/6/21 20:00:00"
+    
+    def setUp(self):
+        self._library = tempfile.mkdtemp()
+        self._args = _args("classic", self.NOW_UTC)
+        self._args.playback = self._library
+        self._args.profile = "default"
+        self._args.weather = None
+    
+    def tearDown(self):
+        shutil.rmtree(self._library)
+    
+    def _write_library(self, pixel_count, value):
+        day = FrameFile.day_start(self.NOW_UTC)
+        path = FrameFile.library_path(self._library, self._args.city, day, self._args.profile)
+        FrameFile.create(path, day, 60 * 60 * 24, 1, pixel_count, self._args.city).close()
+        frame_file = FrameFile(path, mode='r+')
+        frame_file.frames[:] = value
+        frame_file.frames.flush()
+        frame_file.close()
+    
+    def test_brightness_applies_to_played_frames(self):
+        self._write_library(self._args.pixel_count, 200)
+        client = _NullClient()
+        panel = RectangularPixelMatrix(self._args, client)
+        sky = PlaybackSky(self._args, HyperClock(self._args), None)
+        sky(panel)
+        self.assertEqual(int(client.pixels.max()), 160)
+        panel.brightness = 0.5
+        sky(panel)
+        self.assertEqual(int(client.pixels.max()), 100)
+    
+    def test_brightness_baked_into_frames_is_not_applied_twice(self):
+        day = FrameFile.day_start(self.NOW_UTC)
+        path = FrameFile.library_path(self._library, self._args.city, day, self._args.profile)
+        FrameFile.create(path, day, 60 * 60 * 24, 1, self._args.pixel_count, self._args.city, brightness=0.5).close()
+        frame_file = FrameFile(path, mode='r+')
+        frame_file.frames[:] = 100
+        frame_file.frames.flush()
+        frame_file.close()
+        client = _NullClient()
+        sky = PlaybackSky(self._args, HyperClock(self._args), None)
+        sky(RectangularPixelMatrix(self._args, client))
+        self.assertEqual(int(client.pixels.max()), 160)
+    
+    def test_frames_without_a_pixel_count_render_live(self):
+        self._write_library(self._args.pixel_count, 200)
+        day = FrameFile.day_start(self.NOW_UTC)
+        metadata_path = FrameFile.library_path(self._library, self._args.city, day, self._args.profile) + ".json"
+        with open(metadata_path, 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+        del metadata['pixels']
+        with open(metadata_path, 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        client = _NullClient()
+        sky = PlaybackSky(self._args, HyperClock(self._args), None)
+        sky(RectangularPixelMatrix(self._args, client))
+        self.assertEqual(sky.get_sky_phase(), "daytime")
+    
+    def test_frames_for_another_pixel_count_render_live(self):
+        self._write_library(self._args.pixel_count * 2, 200)
+        client = _NullClient()
+        sky = PlaybackSky(self._args, HyperClock(self._args), None)
+        sky(RectangularPixelMatrix(self._args, client))
+        self.assertEqual(sky.get_sky_phase(), "daytime")
+        self.assertEqual(client.pixels.shape, (self._args.pixel_count, 3))
+
+
+class DaylightPrefetcherTest(unittest.TestCase):
+    
+    NOW_UTC = "2017/6/21 20:00:00"
+    TWILIGHT = "-7"
+    
+    def setUp(self):
+        self._observer = ephem.city("Seattle")
+        self._sun = ephem.Sun()  # @UndefinedVariable
+        self._prefetcher = DaylightPrefetcher("Seattle", 1.0)
+        self._prefetcher.start(self._observer, self.TWILIGHT, DEFAULT_CURVE_LEVELS)
+    
+    def tearDown(self):
+        self._prefetcher.stop()
+    
+    def _wait_for(self, now, timeout=10.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            daylight = self._prefetcher.get(now)
+            if daylight is not None:
+                return daylight
+            time.sleep(0.01)
+        self.fail("Nothing was prefetched for {}".format(now))
+    
+    def _solve(self, now, twilight):
+        self._observer.horizon = twilight
+        next_dark = self._observer.next_setting(self._sun, start=now)
+        return solve_daylight(self._observer, self._sun, twilight, next_dark)
+    
+    def test_hands_over_the_day_the_sky_would_solve(self):
+        now = ephem.date(self.NOW_UTC)
+        daylight = self._wait_for(now)
+        expected = self._solve(now, self.TWILIGHT)
+        self.assertAlmostEqual(daylight.dark, expected.dark, places=6)
+        self.assertAlmostEqual(daylight.twilight, expected.twilight, places=6)
+        self.assertTrue(daylight.is_daylight(now))
+    
+    def test_hands_over_the_next_day_after_dark(self):
+        now = ephem.date(self.NOW_UTC)
+        today = self._wait_for(now)
+        tomorrow_now = ephem.date(today.dark + 60 * ephem.second)
+        tomorrow = self._wait_for(tomorrow_now)
+        self.assertGreater(tomorrow.dark, today.dark)
+        self.assertAlmostEqual(tomorrow.dark, self._solve(tomorrow_now, self.TWILIGHT).dark, places=6)
+    
+    def test_reset_discards_days_solved_with_old_settings(self):
+        now = ephem.date(self.NOW_UTC)
+        self._wait_for(now)
+        self._prefetcher.reset(self._observer, "-12", DEFAULT_CURVE_LEVELS)
+        daylight = self._wait_for(now)
+        self.assertAlmostEqual(daylight.dark, self._solve(now, "-12").dark, places=6)
+    
+    def test_stop_waits_for_the_thread(self):
+        # Leave it solving when it is stopped.
+        self._prefetcher.get(ephem.date(self.NOW_UTC))
+        self._prefetcher.stop()
+        self.assertFalse(self._prefetcher._thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
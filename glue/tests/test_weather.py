@@ -0,0 +1,210 @@
+#
+# Copyright 2017 Scott A Dixon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+   
+#  ___       _                       _     ____  _          _ _       _     _   
+# |_ _|_ __ | |_ ___ _ __ _ __   ___| |_  / ___|| | ___   _| (_) __ _| |__ | |_ 
+#  | || '_ \| __/ _ \ '__| '_ \ / _ \ __| \___ \| |/ / | | | | |/ _` | '_ \| __|
+#  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
+# |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
+#                                                     |___/     |___/
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session import SessionRecorder, SessionReplay
+from weather import FixtureForecast, ReplayForecast, WeatherUnderground, WeatherUndergroundForecast, create_replay_weather
+
+
+class _Response(object):
+    
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.headers = {}
+        self._body = body
+    
+    def json(self):
+        return self._body
+
+
+def _fake_requests(response):
+    requests = types.ModuleType('requests')
+    requests.RequestException = Exception
+    requests.get = lambda url, headers=None: response
+    return requests
+
+
+class WeatherUndergroundTest(unittest.TestCase):
+    
+    ERROR_BODY = {'response': {'error': {'type': "keynotfound"}}}
+    GOOD_BODY = {'current_observation': {'weather': "Clear", 'temp_c': 12.0, 'pressure_mb': "1010"}}
+    
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._cache_path = os.path.join(self._directory, "weather.json")
+        self._requests = sys.modules.get('requests')
+    
+    def tearDown(self):
+        if self._requests is None:
+            sys.modules.pop('requests', None)
+        else:
+            sys.modules['requests'] = self._requests
+        shutil.rmtree(self._directory)
+    
+    def _provider(self):
+        return WeatherUnderground(argparse.Namespace(city="Seattle", verbose=False, wukey="key",
+                                                     weather=None, weather_cache=self._cache_path))
+    
+    def _fetch(self, provider, status_code, body):
+        sys.modules['requests'] = _fake_requests(_Response(status_code, body))
+        provider._request_routine(provider)
+    
+    def test_error_response_is_not_cached(self):
+        provider = self._provider()
+        self._fetch(provider, 200, self.ERROR_BODY)
+        self.assertFalse(provider.has_new_weather())
+        self.assertIsNone(provider.get_current_conditions())
+        self.assertFalse(os.path.exists(self._cache_path))
+    
+    def test_error_status_keeps_last_good_response(self):
+        provider = self._provider()
+        self._fetch(provider, 200, self.GOOD_BODY)
+        self._fetch(provider, 500, self.ERROR_BODY)
+        self.assertEqual(provider.get_current_weather(), "Clear")
+        with open(self._cache_path, 'r') as cache_file:
+            self.assertEqual(json.load(cache_file)['body'], self.GOOD_BODY)
+    
+    def test_unusable_cache_is_discarded(self):
+        with open(self._cache_path, 'w') as cache_file:
+            json.dump({'body': self.ERROR_BODY, 'fetched_at': 0,
+                       'city': "Seattle", 'url': WeatherUnderground.URL}, cache_file)
+        provider = self._provider()
+        self.assertFalse(provider.has_new_weather())
+        self.assertIsNone(provider.get_last_update_time())
+        self.assertFalse(os.path.exists(self._cache_path))
+    
+    def test_cache_for_another_city_is_ignored(self):
+        provider = self._provider()
+        self._fetch(provider, 200, self.GOOD_BODY)
+        args = argparse.Namespace(city="Boston", verbose=False, wukey="key",
+                                  weather=None, weather_cache=self._cache_path)
+        self.assertFalse(WeatherUnderground(args).has_new_weather())
+        self.assertTrue(self._provider().has_new_weather())
+    
+    def test_missing_observation_is_tolerated(self):
+        provider = self._provider()
+        provider._on_new_data(self.ERROR_BODY)
+        self.assertIsNone(provider.get_current_weather())
+        self.assertEqual(provider.get_pressure_mb(1000.0), 1000.0)
+
+
+class FixtureForecastTest(unittest.TestCase):
+    
+    FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "weather", "fixtures", "hourly_forecast.json")
+    HOUR = 60 * 60
+    
+    def setUp(self):
+        self._provider = FixtureForecast(argparse.Namespace(city="Seattle", verbose=False,
+                                                            weather_fixture=self.FIXTURE))
+        # The fixture is shifted to start when the provider is created.
+        self._start = self._provider._epochs[0]
+        self._hours = 0.0
+        self._provider._now = lambda: self._start + self._hours * self.HOUR
+    
+    def test_conditions_are_interpolated_between_hours(self):
+        # Half way from Clear, 10 C, 1012 mb to Partly Cloudy, 11 C, 1011 mb.
+        self._hours = 1.5
+        conditions = self._provider.get_current_conditions()
+        self.assertEqual(conditions['weather'], "Clear")
+        self.assertAlmostEqual(conditions['temp_c'], 10.5)
+        self.assertAlmostEqual(conditions['pressure_mb'], 1011.5)
+    
+    def test_next_forecast_hour_is_new_weather(self):
+        self.assertTrue(self._provider.has_new_weather())
+        self._provider.get_current_conditions()
+        self._hours = 0.5
+        self.assertFalse(self._provider.has_new_weather())
+        self._hours = 1.0
+        self.assertTrue(self._provider.has_new_weather())
+        self.assertEqual(self._provider.get_current_weather(), "Clear")
+        self.assertFalse(self._provider.has_new_weather())
+    
+    def test_upcoming_weather_is_the_next_change(self):
+        self._hours = 1.5
+        self.assertEqual(self._provider.get_upcoming_weather(), ("Partly Cloudy", 0.5 * self.HOUR))
+        self._hours = 4.25
+        self.assertEqual(self._provider.get_upcoming_weather(), ("Overcast", 1.75 * self.HOUR))
+    
+    def test_no_upcoming_weather_after_the_last_change(self):
+        self._hours = 9.5
+        self.assertIsNone(self._provider.get_upcoming_weather())
+
+
+class ReplayWeatherTest(unittest.TestCase):
+    
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+    
+    def _hour(self, epoch, condition):
+        return {'FCTTIME': {'epoch': str(epoch)}, 'condition': condition,
+                'temp': {'metric': "10"}, 'mslp': {'metric': "1012"}}
+    
+    def test_cached_forecast_replays_through_forecast_parser(self):
+        now = time.time()
+        with open(os.path.join(self._directory, "weather.forecast.json"), 'w') as cache_file:
+            json.dump({'body': {'hourly_forecast': [self._hour(now - 60, "Rain"), self._hour(now + 3600, "Clear")]},
+                       'fetched_at': now, 'city': "Seattle", 'url': WeatherUndergroundForecast.URL}, cache_file)
+        args = argparse.Namespace(city="Seattle", verbose=False, wukey="key", weather=None,
+                                  weather_cache=os.path.join(self._directory, "weather.json"))
+        provider = WeatherUndergroundForecast(args)
+        
+        session_path = os.path.join(self._directory, "session.gz")
+        recorder = SessionRecorder(session_path, args.city, provider.PROVIDER)
+        provider.set_recorder(recorder)
+        recorder.record_clock(time.time(), 0.0)
+        recorder.close()
+        
+        session = SessionReplay(session_path)
+        self.assertEqual(session.provider, "forecast")
+        replay = create_replay_weather(args, session)
+        self.assertIsInstance(replay, ReplayForecast)
+        session.next_clock()
+        self.assertTrue(replay.has_new_weather())
+        self.assertEqual(replay.get_current_conditions()['weather'], "Rain")
+        self.assertEqual(replay._response_time, session.wall_time())
+        session.close()
+    
+    def test_recording_without_a_provider_is_rejected(self):
+        session_path = os.path.join(self._directory, "session.gz")
+        with gzip.open(session_path, 'wb') as session_file:
+            session_file.write(json.dumps({'version': SessionRecorder.FORMAT_VERSION, 'city': "Seattle",
+                                           'started': time.time()}) + "\n")
+        self.assertRaises(ValueError, SessionReplay, session_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
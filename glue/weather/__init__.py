@@ -19,22 +19,155 @@
 #  | || | | | ||  __/ |  | | | |  __/ |_   ___) |   <| |_| | | | (_| | | | | |_ 
 # |___|_| |_|\__\___|_|  |_| |_|\___|\__| |____/|_|\_\\__, |_|_|\__, |_| |_|\__|
 #                                                     |___/     |___/
+import bisect
 import json
+import os
 import re
 import threading
+import time
 
-import requests
+from diagnostics import debug_log
 
 
-class WeatherUnderground(object):
+class WeatherCache(object):
+    '''
+    On-disk copy of the last weather response. Stores the response body along
+    with the wall-clock time it was fetched and the HTTP validators (ETag and
+    Last-Modified) the server sent so a restarted skylight can serve the last
+    known conditions immediately and only spend an API call once they are stale.
+    Entries also note the city and the request they answered and are ignored
+    when either has changed since.
+    '''
+    
+    def __init__(self, path, verbose=False, city=None, url=None):
+        self._path = os.path.expanduser(path) if path is not None else None
+        self._verbose = verbose
+        self._city = city
+        self._url = url
+        self._entry = None
+        self._load()
+    
+    @property
+    def body(self):
+        return self._entry['body'] if self._entry is not None else None
+    
+    @property
+    def fetched_at(self):
+        return self._entry['fetched_at'] if self._entry is not None else None
+    
+    def age(self, now_seconds=None):
+        if self._entry is None:
+            return None
+        if now_seconds is None:
+            now_seconds = time.time()
+        return now_seconds - self._entry['fetched_at']
+    
+    def is_fresh(self, max_age_seconds, now_seconds=None):
+        age = self.age(now_seconds)
+        # A negative age means the system clock went backwards since the fetch
+        # (e.g. a board that booted without RTC before NTP sync). Don't trust it.
+        return age is not None and 0 <= age < max_age_seconds
+    
+    def conditional_headers(self):
+        headers = {}
+        if self._entry is not None:
+            if self._entry.get('etag') is not None:
+                headers['If-None-Match'] = self._entry['etag']
+            if self._entry.get('last_modified') is not None:
+                headers['If-Modified-Since'] = self._entry['last_modified']
+        return headers
+    
+    def store(self, body, etag=None, last_modified=None, now_seconds=None):
+        self._entry = { 'body': body,
+                        'city': self._city,
+                        'url': self._url,
+                        'fetched_at': now_seconds if now_seconds is not None else time.time(),
+                        'etag': etag,
+                        'last_modified': last_modified }
+        self._save()
+    
+    def discard(self):
+        '''
+        Forget the cached body (e.g. because it turned out to be unusable).
+        '''
+        self._entry = None
+        if self._path is not None and os.path.isfile(self._path):
+            try:
+                os.remove(self._path)
+            except OSError as e:
+                print "Unable to remove weather cache {}: {}".format(self._path, str(e))
+    
+    def touch(self, now_seconds=None):
+        '''
+        Mark the cached body as revalidated (i.e. the server answered 304).
+        '''
+        if self._entry is not None:
+            self._entry['fetched_at'] = now_seconds if now_seconds is not None else time.time()
+            self._save()
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _load(self):
+        if self._path is None or not os.path.isfile(self._path):
+            return
+        try:
+            with open(self._path, 'r') as cache_file:
+                entry = json.load(cache_file)
+            if entry.get('city') != self._city or entry.get('url') != self._url:
+                if self._verbose:
+                    print "Ignoring cached weather in {} for another city or request.".format(self._path)
+            elif 'body' in entry and 'fetched_at' in entry:
+                self._entry = entry
+                if self._verbose:
+                    print "Loaded cached weather from {} ({:.0f} seconds old)".format(self._path, self.age())
+        except (IOError, ValueError) as e:
+            print "Ignoring unreadable weather cache {}: {}".format(self._path, str(e))
+    
+    def _save(self):
+        if self._path is None:
+            return
+        # write-then-rename so a power cut never leaves a truncated cache behind.
+        temp_path = self._path + ".tmp"
+        try:
+            with open(temp_path, 'w') as cache_file:
+                json.dump(self._entry, cache_file)
+            os.rename(temp_path, self._path)
+        except (IOError, OSError) as e:
+            print "Unable to write weather cache {}: {}".format(self._path, str(e))
+
+
+class WeatherProvider(object):
+    '''
+    Base class for the sources of weather the sky can use. Subclasses provide
+    conditions through get_current_conditions() as a dictionary shaped like
+    the weather underground's current_observation ('weather', 'temp_c' and
+    'pressure_mb') and this class takes care of classifying them and of
+    fetching off of the render thread.
+    '''
     
     MAX_API_CALLS_PER_DAY = 400
     
+    # Key every good response from the service has at its top level.
+    RESPONSE_KEY = 'current_observation'
+    
+    # Which of the PROVIDERS can parse the responses this provider records.
+    PROVIDER = "conditions"
+    
+    # Where the provider's responses come from. Formatted with the API key and
+    # the city.
+    URL = "http://api.wunderground.com/api/{key}/conditions/q/CA/{city}.json"
+    
+    PROVIDERS = ("conditions", "forecast", "fixture")
+    
     @classmethod
     def on_visit_argparse(cls, parser, subparsers):  # @UnusedVariable
         group = parser.add_argument_group("weather options")
         group.add_argument('--wukey', help="API key for the weather underground")
         group.add_argument('--weather', default=None, help="Fake weather conditions for testing.")
+        group.add_argument('--weather-cache', default="~/.skylight_weather.json", help="File used to persist the last weather response across restarts. Set to an empty string to disable.")
+        group.add_argument('--weather-provider', default="conditions", choices=cls.PROVIDERS, help="Where weather comes from: current conditions, an hourly forecast interpolated locally, or an offline forecast fixture.")
+        group.add_argument('--weather-fixture', default=None, help="Hourly forecast JSON file used by the fixture weather provider.")
     
     EMERGENCY_WEATHER   = { "(light|heavy) Hail",
                             "(light|heavy) Volcanic Ash",
@@ -97,37 +230,59 @@ class WeatherUnderground(object):
                             "Scattered Clouds"
                           }
     
+    WEATHER_CLASS_SUNNY     = "sunny"
+    WEATHER_CLASS_EMERGENCY = "emergency"
+    WEATHER_CLASS_SNOWING   = "snowing"
+    WEATHER_CLASS_CLOUDY    = "cloudy"
+    
     @staticmethod
     def _request_routine(self):
-        if self._fake_weather is not None:
-            conditions = { 'current_observation': {'weather': self._fake_weather}}
-        else:
-            r = requests.get("http://api.wunderground.com/api/{}/conditions/q/CA/{}.json".format(self._key, self._city))
-            conditions = r.json()
+        conditions = self._fetch()
+        if conditions is None:
+            return
         with self._request_lock:
             if self._verbose:
-                print "New conditions received: {}".format(conditions)
-            self._conditions = conditions
+                debug_log.emit("New conditions received: {}", conditions)
+            self._accept_response(conditions)
             self._new_data_flag = True
-
+    
     def __init__(self, args):
-        self._key = args.wukey
         self._city = args.city
-        self._conditions = None
         self._verbose = args.verbose
         self._request_thread = None
         self._request_lock = threading.RLock()
         self._new_data_flag = False
-        self._fake_weather = args.weather
-        if self._fake_weather is None:
-            if self._key is None:
-                raise ValueError("wukey argument is required if not using fake conditions.")
-        elif self._verbose:
-            print "Using fake weather conditions {}".format(self._fake_weather)
+        self._cache = None
+        self._weather_classes = dict()
+        self._recorder = None
+        self._response = None
+        self._response_time = None
     
     def get_max_updates_per_day(self):
         return self.MAX_API_CALLS_PER_DAY
     
+    def set_recorder(self, recorder):
+        '''
+        Log every response received from now on to a session.SessionRecorder.
+        The response already in use (from the cache or a fixture) is logged
+        first so a replay starts from the same weather.
+        '''
+        with self._request_lock:
+            self._recorder = recorder
+            if recorder is not None and self._response is not None:
+                recorder.record_weather(self._response_time, self._response)
+    
+    def get_last_update_time(self):
+        '''
+        Wall-clock time (seconds since the epoch) of the last successful fetch
+        or None if there hasn't been one recently enough to count against the
+        next. This survives restarts when a weather cache is in use.
+        '''
+        update_period = (60 * 60 * 24) / float(self.get_max_updates_per_day())
+        if self._cache is None or not self._cache.is_fresh(update_period, self._now()):
+            return None
+        return self._cache.fetched_at
+    
     def start_weather_update(self):
         with self._request_lock:
             if self._request_thread is None or not self._request_thread.is_alive():
@@ -141,6 +296,51 @@ class WeatherUnderground(object):
         with self._request_lock:
             return self._new_data_flag
     
+    def get_current_conditions(self):
+        raise NotImplementedError()
+    
+    def get_upcoming_weather(self):
+        '''
+        Returns a tuple of (weather, seconds until it arrives) for the next
+        expected change in conditions or None if the provider can't say.
+        '''
+        return None
+    
+    def check_fake_weather(self, weather):  # @UnusedVariable
+        '''
+        Raises ValueError if set_fake_weather(weather) can't be done by this
+        provider.
+        '''
+        raise ValueError("{} doesn't support fake weather".format(type(self).__name__))
+    
+    def set_fake_weather(self, weather):
+        '''
+        Replace the weather with the given conditions (as for --weather) or go
+        back to the real weather if None. Providers that can't do this raise
+        ValueError.
+        '''
+        self.check_fake_weather(weather)
+    
+    def classify(self, weather):
+        '''
+        Reduce a weather string to one of the WEATHER_CLASS_ values. Results are
+        memoized since the pattern sets are matched one regex at a time.
+        '''
+        weather_class = self._weather_classes.get(weather)
+        if weather_class is None:
+            if weather is None:
+                weather_class = self.WEATHER_CLASS_EMERGENCY
+            elif self._is_weather(self.SUNNY_WEATHER, weather):
+                weather_class = self.WEATHER_CLASS_SUNNY
+            elif self._is_weather(self.EMERGENCY_WEATHER, weather):
+                weather_class = self.WEATHER_CLASS_EMERGENCY
+            elif self._is_weather(self.SNOWING, weather):
+                weather_class = self.WEATHER_CLASS_SNOWING
+            else:
+                weather_class = self.WEATHER_CLASS_CLOUDY
+            self._weather_classes[weather] = weather_class
+        return weather_class
+    
     @property
     def is_sunny(self):
         conditions = self.get_current_conditions()
@@ -165,15 +365,10 @@ class WeatherUnderground(object):
             return True
         else:
             return self._is_weather(self.EMERGENCY_WEATHER, conditions['weather'])
-        
-    def get_current_conditions(self):
-        with self._request_lock:
-            self._new_data_flag = False
-            return (self._conditions['current_observation'] if self._conditions is not None else None)
     
     def get_current_weather(self):
         conditions = self.get_current_conditions()
-        return (conditions['weather'] if conditions is not None else None)
+        return (conditions.get('weather') if conditions is not None else None)
     
     def get_pressure_mb(self, default_value=1013.25):
         try:
@@ -195,10 +390,365 @@ class WeatherUnderground(object):
     # +-----------------------------------------------------------------+
     # | PRIVATE
     # +-----------------------------------------------------------------+
+    def _fetch(self):
+        raise NotImplementedError()
+    
+    def _on_new_data(self, data):
+        raise NotImplementedError()
+    
+    def _now(self):
+        return time.time()
+    
+    def _accept_response(self, data):
+        self._response = data
+        self._response_time = self._now()
+        if self._recorder is not None:
+            self._recorder.record_weather(self._response_time, data)
+        self._on_new_data(data)
+    
+    def _open_cache(self, args, suffix=None):
+        cache_path = getattr(args, 'weather_cache', None)
+        if not cache_path:
+            return
+        if suffix is not None:
+            root, ext = os.path.splitext(cache_path)
+            cache_path = "{}.{}{}".format(root, suffix, ext)
+        # The URL is stored without the API key filled in so the key never
+        # ends up on disk.
+        self._cache = WeatherCache(cache_path, self._verbose, self._city, self.URL)
+        if self._cache.body is not None and not self._is_valid_response(self._cache.body):
+            print "Ignoring cached weather without {} in it.".format(self.RESPONSE_KEY)
+            self._cache.discard()
+        if self._cache.body is not None:
+            # Serve the last known data right away. The sky will only ask for
+            # an update once the cache entry is stale.
+            self._accept_response(self._cache.body)
+            self._new_data_flag = True
+    
+    def _fetch_json(self, url):
+        # requests is slow to import and only ever needed on the fetch thread
+        # so keep it off of the startup path.
+        import requests
+        headers = self._cache.conditional_headers() if self._cache is not None else {}
+        try:
+            r = requests.get(url, headers=headers)
+        except requests.RequestException as e:
+            debug_log.emit("Weather request failed: {}", str(e))
+            return None
+        if r.status_code == 304 and self._cache is not None and self._cache.body is not None:
+            if self._verbose:
+                debug_log.emit("Weather not modified since last request.")
+            self._cache.touch()
+            return self._cache.body
+        if r.status_code != 200:
+            debug_log.emit("Weather service returned HTTP {}", r.status_code)
+            return None
+        try:
+            data = r.json()
+        except ValueError:
+            debug_log.emit("Weather service returned an unreadable response ({})", r.status_code)
+            return None
+        if not self._is_valid_response(data):
+            # e.g. an error for a bad key or city. Don't let it replace
+            # good data in memory or on disk.
+            debug_log.emit("Weather service response has no {}: {}", self.RESPONSE_KEY, data)
+            return None
+        if self._cache is not None:
+            self._cache.store(data, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return data
+    
+    def _is_valid_response(self, data):
+        return isinstance(data, dict) and self.RESPONSE_KEY in data
+    
     @staticmethod
     def _is_weather(pattern_map, current_weather):
         for weather in pattern_map:
             if re.match(weather, current_weather, re.IGNORECASE):
                 return True
         return False
+
+
+class WeatherUnderground(WeatherProvider):
+    '''
+    Polls the weather underground for current conditions.
+    '''
+
+    def __init__(self, args):
+        super(WeatherUnderground, self).__init__(args)
+        self._key = args.wukey
+        self._conditions = None
+        self._fake_weather = args.weather
+        if self._fake_weather is None:
+            if self._key is None:
+                raise ValueError("wukey argument is required if not using fake conditions.")
+            self._open_cache(args)
+        elif self._verbose:
+            print "Using fake weather conditions {}".format(self._fake_weather)
+    
+    def start_weather_update(self):
+        if self._fake_weather is not None:
+            # Nothing to wait for so skip the thread. This also keeps offline
+            # renders deterministic.
+            self._request_routine(self)
+            return True
+        return super(WeatherUnderground, self).start_weather_update()
+    
+    def check_fake_weather(self, weather):
+        if weather is None and self._key is None:
+            raise ValueError("wukey argument is required if not using fake conditions.")
+    
+    def set_fake_weather(self, weather):
+        self.check_fake_weather(weather)
+        self._fake_weather = weather
+        self.start_weather_update()
         
+    def get_current_conditions(self):
+        with self._request_lock:
+            self._new_data_flag = False
+            return (self._conditions.get(self.RESPONSE_KEY) if self._conditions is not None else None)
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _fetch(self):
+        if self._fake_weather is not None:
+            return { 'current_observation': {'weather': self._fake_weather}}
+        return self._fetch_json(self.URL.format(key=self._key, city=self._city))
+    
+    def _on_new_data(self, data):
+        self._conditions = data
+
+
+class WeatherUndergroundForecast(WeatherProvider):
+    '''
+    Fetches the weather underground's hourly forecast in one request and
+    interpolates conditions, temperature and pressure locally whenever the sky
+    asks for them. Since one forecast covers well over a day we only refresh it
+    every couple of hours which is a fraction of the calls the conditions
+    provider makes.
+    '''
+    
+    MAX_API_CALLS_PER_DAY = 12
+    RESPONSE_KEY = 'hourly_forecast'
+    PROVIDER = "forecast"
+    URL = "http://api.wunderground.com/api/{key}/hourly/q/CA/{city}.json"
+    
+    def __init__(self, args):
+        super(WeatherUndergroundForecast, self).__init__(args)
+        self._key = args.wukey
+        self._epochs = []
+        self._samples = []
+        self._reported_index = None
+        if self._key is None:
+            raise ValueError("wukey argument is required for the forecast weather provider.")
+        self._open_cache(args, "forecast")
+    
+    def has_new_weather(self):
+        with self._request_lock:
+            # Crossing into the next forecast hour counts as new weather even
+            # though nothing was fetched.
+            return self._new_data_flag or \
+                (len(self._epochs) > 0 and self._reported_index != self._index_at(self._now()))
+    
+    def get_current_conditions(self):
+        with self._request_lock:
+            self._new_data_flag = False
+            if len(self._epochs) == 0:
+                return None
+            now = self._now()
+            self._reported_index = self._index_at(now)
+            return self._interpolate(now)
+    
+    def get_upcoming_weather(self):
+        with self._request_lock:
+            if len(self._epochs) == 0:
+                return None
+            now = self._now()
+            index = self._index_at(now)
+            current = self._samples[max(0, index - 1)][0]
+            for i in range(index, len(self._samples)):
+                if self._samples[i][0] != current:
+                    return (self._samples[i][0], self._epochs[i] - now)
+            return None
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _fetch(self):
+        return self._fetch_json(self.URL.format(key=self._key, city=self._city))
+    
+    def _on_new_data(self, data):
+        epochs = []
+        samples = []
+        try:
+            for hour in data['hourly_forecast']:
+                epochs.append(float(hour['FCTTIME']['epoch']))
+                samples.append((hour['condition'],
+                                float(hour['temp']['metric']),
+                                float(hour['mslp']['metric'])))
+        except (KeyError, TypeError, ValueError) as e:
+            print "Ignoring unreadable forecast: {}".format(str(e))
+            return
+        self._epochs = epochs
+        self._samples = samples
+        self._reported_index = None
+    
+    def _index_at(self, now):
+        return bisect.bisect_right(self._epochs, now)
+    
+    def _interpolate(self, now):
+        index = self._index_at(now)
+        if index == 0:
+            weather, temp_c, pressure_mb = self._samples[0]
+        elif index == len(self._samples):
+            weather, temp_c, pressure_mb = self._samples[-1]
+        else:
+            t0 = self._epochs[index - 1]
+            t1 = self._epochs[index]
+            before = self._samples[index - 1]
+            after = self._samples[index]
+            t = (now - t0) / (t1 - t0) if t1 > t0 else 0.0
+            # Conditions are categorical so they hold until the next forecast
+            # hour. Temperature and pressure are continuous.
+            weather = before[0]
+            temp_c = before[1] + (after[1] - before[1]) * t
+            pressure_mb = before[2] + (after[2] - before[2]) * t
+        return {'weather': weather, 'temp_c': temp_c, 'pressure_mb': pressure_mb}
+
+
+class FixtureForecast(WeatherUndergroundForecast):
+    '''
+    Offline forecast provider that reads an hourly forecast (in the weather
+    underground's format) from a file. The forecast is shifted in time so its
+    first hour starts when the provider is created which makes any recorded
+    forecast usable as a test fixture.
+    '''
+    
+    MAX_API_CALLS_PER_DAY = 24 * 60
+    
+    def __init__(self, args):
+        WeatherProvider.__init__(self, args)
+        self._epochs = []
+        self._samples = []
+        self._reported_index = None
+        self._fixture_path = args.weather_fixture
+        if self._fixture_path is None:
+            raise ValueError("weather-fixture argument is required for the fixture weather provider.")
+        data = self._fetch()
+        self._on_new_data(data)
+        if len(self._epochs) > 0:
+            offset = time.time() - self._epochs[0]
+            self._epochs = [epoch + offset for epoch in self._epochs]
+            # Keep the shifted forecast as the response so a recording of it
+            # replays through the plain forecast provider.
+            for hour in data['hourly_forecast']:
+                hour['FCTTIME']['epoch'] = str(float(hour['FCTTIME']['epoch']) + offset)
+        with self._request_lock:
+            self._response = data
+            self._response_time = time.time()
+        self._new_data_flag = True
+    
+    def start_weather_update(self):
+        return False
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _fetch(self):
+        try:
+            with open(self._fixture_path, 'r') as fixture_file:
+                return json.load(fixture_file)
+        except (IOError, ValueError) as e:
+            raise ValueError("Unable to load weather fixture {}: {}".format(self._fixture_path, str(e)))
+
+
+class ReplayWeather(WeatherProvider):
+    '''
+    Feeds the responses from a recorded session back through the parser of the
+    provider that recorded them. Responses become visible when the replayed
+    wall clock passes the time they were originally received so the replay is
+    deterministic. Use create_replay_weather to pick the parser for a session.
+    '''
+    
+    def __init__(self, args, session):
+        WeatherProvider.__init__(self, args)
+        self._session = session
+    
+    def start_weather_update(self):
+        # Responses arrive on the recorded schedule, not on request.
+        return False
+    
+    def check_fake_weather(self, weather):
+        WeatherProvider.check_fake_weather(self, weather)
+    
+    def set_fake_weather(self, weather):
+        WeatherProvider.set_fake_weather(self, weather)
+    
+    def has_new_weather(self):
+        return self._session.has_weather() or super(ReplayWeather, self).has_new_weather()
+    
+    def get_current_conditions(self):
+        response = self._session.pop_weather()
+        if response is not None:
+            with self._request_lock:
+                self._accept_response(response)
+        return super(ReplayWeather, self).get_current_conditions()
+    
+    # +-----------------------------------------------------------------+
+    # | PRIVATE
+    # +-----------------------------------------------------------------+
+    def _now(self):
+        # Everything runs on the recorded wall clock.
+        return self._session.wall_time()
+
+
+class ReplayConditions(ReplayWeather, WeatherUnderground):
+    '''
+    Replays a session recorded with the current conditions provider.
+    '''
+    
+    def __init__(self, args, session):
+        ReplayWeather.__init__(self, args, session)
+        self._key = None
+        self._conditions = None
+        self._fake_weather = None
+
+
+class ReplayForecast(ReplayWeather, WeatherUndergroundForecast):
+    '''
+    Replays a session recorded with one of the forecast providers. The forecast
+    is interpolated at the recorded wall time instead of the current one.
+    '''
+    
+    def __init__(self, args, session):
+        ReplayWeather.__init__(self, args, session)
+        self._key = None
+        self._epochs = []
+        self._samples = []
+        self._reported_index = None
+
+
+def create_weather_provider(args):
+    '''
+    Build the weather provider selected on the commandline.
+    '''
+    provider = getattr(args, 'weather_provider', "conditions")
+    if provider == "fixture":
+        return FixtureForecast(args)
+    elif provider == "forecast" and args.weather is None:
+        return WeatherUndergroundForecast(args)
+    else:
+        return WeatherUnderground(args)
+
+
+def create_replay_weather(args, session):
+    '''
+    Build the weather provider that replays the responses in a
+    session.SessionReplay.
+    '''
+    if session.provider == ReplayForecast.PROVIDER:
+        return ReplayForecast(args, session)
+    elif session.provider == ReplayConditions.PROVIDER:
+        return ReplayConditions(args, session)
+    else:
+        raise ValueError("Unable to replay weather from the {} provider.".format(session.provider))